@@ -146,6 +146,20 @@ HOME_PAGE_DAYS_SOON = 90
 # Days to consider as recent on home page
 HOME_PAGE_DAYS_RECENT = 30
 
+# Seconds to keep home page snapshots (snapshots are also invalidated when projects, allocations or RSEs change).
+# Invalidation only reaches the process which made the change when the cache is local memory, so the timeout is kept
+# short to limit how long other worker processes show a stale home page. It can be increased with a shared cache backend.
+HOME_PAGE_CACHE_TIMEOUT = 60
+
+# Cache for home page snapshots. Local memory is per process so use a shared backend (e.g. memcached) with multiple workers
+# to ensure that invalidation reaches every process. See https://docs.djangoproject.com/en/4.2/topics/cache/
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'rseadmin',
+    }
+}
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # When true allocations can only be made within the projects start and end date
@@ -9,5 +9,6 @@ admin.site.register(RSE)
 admin.site.register(DirectlyIncurredProject)
 admin.site.register(ServiceProject)
 admin.site.register(RSEAllocation)
+admin.site.register(RSEAllocationHistory)
 admin.site.register(FinancialYear)
 admin.site.register(SalaryGradeChange)
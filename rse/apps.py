@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RseConfig(AppConfig):
     name = 'rse'
+
+    def ready(self):
+        # connect signal receivers
+        from rse import signals
@@ -0,0 +1,613 @@
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from copy import copy
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Count, F, Q, QuerySet, Sum
+from django.utils import timezone
+
+from rse.models import RSE, AllocationCost, Project, RSEAllocation, SalaryBand, SalaryGradeChange, SalaryValue
+
+
+def next_salary_change(d: date) -> date:
+    """
+    Returns the date of the next possible salary change after a date.
+    Before August this is the financial year change (1st August), otherwise it is the grade point increment (1st January).
+    """
+    if d.month < 8:
+        return date(d.year, 8, 1)
+    else:
+        return date(d.year + 1, 1, 1)
+
+
+def is_salary_change_date(d: date) -> bool:
+    """ Returns True if the date is a financial year change (1st August) or a grade point increment (1st January) """
+    return (d.month, d.day) in ((8, 1), (1, 1))
+
+
+def next_month(d: date) -> date:
+    """ First day of the month following the date """
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+
+def salary_days_cost(salary_days: Decimal, percentage: float = 100.0) -> Decimal:
+    """
+    Converts an accumulated salary multiplied by days into a staff cost for a given FTE percentage (including on costs).
+    Equivalent to `SalaryBand.salaryCost` but applied once to a sum of salary periods.
+    """
+    return Decimal(salary_days) / Decimal(365) * Decimal(percentage / 100.0) * Decimal(settings.ONCOSTS_SALARY_MULTIPLIER)
+
+
+def skips_first_increment(sgc: SalaryGradeChange, starting_salary: bool, from_date: date) -> bool:
+    """
+    Returns True if the first increment following a salary grade change is skipped when salary bands are resolved from a
+    date. The increment is skipped if the salary grade change is the starting salary in the last six months of the year
+    (see `SalaryGradeChange.eliagable_for_increment`). A July start only skips the increment if it has already been passed
+    at the date, which gives the same salary bands as `SalaryGradeChange.salary_band_at_future_date` at any date and the
+    same costs as `RSE.staff_cost` from any date.
+    """
+    if not starting_salary:
+        return False
+    return sgc.date.month > 7 or (sgc.date.month == 7 and from_date >= date(sgc.date.year + 1, 1, 1))
+
+
+class SalaryBandRegistry():
+    """
+    Index of all salary bands by (grade, grade point, year).
+    The whole salary band table is loaded on first use. The registry is cleared at the start of every request and whenever
+    a salary band or financial year is saved or deleted (see `rse.signals`) so lookups are scoped to a single request.
+    """
+
+    def __init__(self):
+        self._index = None  # type: Optional[Dict[Tuple[int, int, int], SalaryBand]]
+
+    @property
+    def index(self) -> Dict[Tuple[int, int, int], SalaryBand]:
+        """ Salary bands by (grade, grade point, year). These objects are shared and must not be modified. """
+        if self._index is None:
+            self._index = {(sb.grade, sb.grade_point, sb.year_id): sb for sb in SalaryBand.objects.select_related('year')}
+        return self._index
+
+    def get(self, grade: int, grade_point: int, year: int) -> Optional[SalaryBand]:
+        """ Returns a copy of the salary band (which the caller may modify) or None if there is no salary band """
+        sb = self.index.get((grade, grade_point, year))
+        return copy(sb) if sb else None
+
+    def for_year(self, year: int) -> List[SalaryBand]:
+        """ Returns copies of all salary bands for a financial year """
+        return [copy(sb) for (grade, grade_point, sb_year), sb in self.index.items() if sb_year == year]
+
+    def clear(self):
+        """ Clears the registry so that salary bands are reloaded on next use """
+        self._index = None
+
+
+salary_band_registry = SalaryBandRegistry()
+
+
+class SalaryChain():
+    """
+    The salary bands which follow on from a starting salary band at a given date.
+    Bands are stored as piecewise constant segments (sorted by start date) with a prefix sum of salary multiplied by days
+    at the start of each segment. Segments are generated on demand as later dates are requested.
+    """
+
+    def __init__(self, salary_bands: Dict[Tuple[int, int, int], SalaryBand], start: date, salary_band: SalaryBand, skip_first_increment: bool = False):
+        self.index = salary_bands
+        self.starts = [start]
+        self.salary_bands = [salary_band]
+        self.salary_days = [Decimal(0)]
+        self.skip_increment = skip_first_increment
+
+    def extend(self, until: date):
+        """ Generates segments until the last segment contains the until date """
+        while next_salary_change(self.starts[-1]) <= until:
+            start = self.starts[-1]
+            salary_band = self.salary_bands[-1]
+            next_start = next_salary_change(start)
+            # August is the financial year change and January is the increment (which may be skipped in the first year)
+            if start.month < 8:
+                next_salary_band = salary_band.salary_band_next_financial_year(self.index)
+            elif self.skip_increment:
+                self.skip_increment = False
+                next_salary_band = salary_band
+            else:
+                next_salary_band = salary_band.salary_band_after_increment(self.index)
+
+            self.salary_days.append(self.salary_days[-1] + Decimal(salary_band.salary) * (next_start - start).days)
+            self.starts.append(next_start)
+            self.salary_bands.append(next_salary_band)
+
+    def salary_band_at(self, d: date) -> SalaryBand:
+        """ Returns the salary band in the segment containing the date """
+        self.extend(d)
+        return self.salary_bands[bisect_right(self.starts, d) - 1]
+
+    def salary_days_until(self, d: date) -> Decimal:
+        """ Returns the accumulated salary multiplied by days from the start of the chain until the date """
+        self.extend(d)
+        i = bisect_right(self.starts, d) - 1
+        return self.salary_days[i] + Decimal(self.salary_bands[i].salary) * (d - self.starts[i]).days
+
+    def periods(self, start: date, end: date, include_end: bool = True) -> Iterator[Tuple[date, date, SalaryBand]]:
+        """
+        Yields (from, until, salary band) for each segment between start and end.
+        If include_end is True then a segment starting on the end date is included (as an empty period).
+        """
+        self.extend(end)
+        i = bisect_right(self.starts, start) - 1
+        j = (bisect_right(self.starts, end) if include_end else bisect_left(self.starts, end)) - 1
+        for k in range(i, j + 1):
+            period_from = max(start, self.starts[k])
+            period_until = self.starts[k + 1] if k < j else end
+            yield period_from, period_until, self.salary_bands[k]
+
+
+class SalaryChainCache():
+    """
+    Least recently used cache of the salary chain following each salary grade change (see
+    `SalaryGradeChange.salary_band_at_future_date`). Each chain holds the resolved salary band at every increment and
+    financial year boundary reached so far, so a later lookup starts from the nearest boundary rather than replaying all
+    increments from the date of the salary grade change.
+    Like the salary band registry, the cache is cleared at the start of every request (as other processes may have changed
+    salary data) and chains are invalidated when salary grade changes, salary bands or financial years are saved or deleted
+    (see `rse.signals`). Salary bands of chains are shared and must not be modified.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._chains = OrderedDict()  # type: OrderedDict[int, Tuple[int, bool, Dict[bool, SalaryChain]]]
+
+    def chain(self, sgc: SalaryGradeChange, from_date: date) -> SalaryChain:
+        """ Gets (or creates) the chain of salary bands following a salary grade change to resolve salary bands from a date """
+        if sgc.id in self._chains:
+            self._chains.move_to_end(sgc.id)
+            rse_id, starting_salary, chains = self._chains[sgc.id]
+        else:
+            starting_salary, chains = sgc.is_starting_salary(), {}
+            if sgc.id is not None:
+                self._chains[sgc.id] = (sgc.rse_id, starting_salary, chains)
+                if len(self._chains) > self.maxsize:
+                    self._chains.popitem(last=False)
+
+        # a July start has chains with and without the first increment (see `skips_first_increment`)
+        skip_increment = skips_first_increment(sgc, starting_salary, from_date)
+        if skip_increment not in chains:
+            chains[skip_increment] = SalaryChain(salary_band_registry.index, sgc.date, sgc.salary_band, skip_increment)
+        return chains[skip_increment]
+
+    def invalidate(self, rse_id: int):
+        """ Removes the chains for all salary grade changes of an RSE """
+        for sgc_id in [sgc_id for sgc_id, (chain_rse_id, starting_salary, chains) in self._chains.items() if chain_rse_id == rse_id]:
+            del self._chains[sgc_id]
+
+    def clear(self):
+        """ Removes all chains """
+        self._chains.clear()
+
+
+salary_chain_cache = SalaryChainCache()
+
+
+class BudgetCurve():
+    """
+    Cumulative salary curve from a start date used to calculate how many days a budget can afford (see `RSE.days_from_budget`).
+    The date and accumulated salary multiplied by days are held at each salary change boundary (financial year, increment or
+    salary grade change). The curve is monotone so the days afforded by a budget are found with a binary search.
+    """
+
+    def __init__(self, timeline: SalaryTimeline, start: date):
+        self.timeline = timeline
+        self.starts = [start]
+        self.salary_bands = [timeline.salary_band_at(start)]
+        self.salary_days = [Decimal(0)]
+
+    def extend(self, salary_days: Decimal):
+        """ Generates segments until the accumulated salary days exceed the value """
+        while self.salary_days[-1] < salary_days:
+            start = self.starts[-1]
+            salary_band = self.salary_bands[-1]
+            self.check_salary(salary_band)
+            # next possible salary change (either by financial or calendar year or a salary grade change)
+            end = next_salary_change(start)
+            i = bisect_right(self.timeline.sgc_dates, start)
+            if i < len(self.timeline.sgc_dates) and self.timeline.sgc_dates[i] < end:
+                end = self.timeline.sgc_dates[i]
+
+            self.salary_days.append(self.salary_days[-1] + Decimal(salary_band.salary) * (end - start).days)
+            self.starts.append(end)
+            self.salary_bands.append(self.timeline.salary_band_at(end))
+
+    def days(self, budget: Decimal, percentage: float) -> int:
+        """ Number of whole days from the start of the curve which the budget can afford at a given FTE percentage """
+        if budget <= 0 or percentage <= 0:
+            return 0
+        # salary days which cost the budget (see `salary_days_cost`)
+        salary_days = Decimal(budget) * 365 * 100 / (Decimal(percentage) * Decimal(settings.ONCOSTS_SALARY_MULTIPLIER))
+        self.extend(salary_days)
+        i = bisect_right(self.salary_days, salary_days) - 1
+        self.check_salary(self.salary_bands[i])
+        return (self.starts[i] - self.starts[0]).days + int((salary_days - self.salary_days[i]) / Decimal(self.salary_bands[i].salary))
+
+    @staticmethod
+    def check_salary(salary_band: SalaryBand):
+        """ A budget can never be spent on a salary band without a positive salary so the days afforded are undefined """
+        if salary_band.salary <= 0:
+            raise ValueError(f'Salary band {salary_band} does not have a positive salary so days from a budget can not be calculated')
+
+
+class SalaryTimeline():
+    """
+    Precomputed salary timeline for a single RSE.
+    All salary grade changes for the RSE are loaded once and salary bands are resolved from the salary band registry. Salary bands are then held as sorted
+    segments with prefix sums (see `SalaryChain`) so that staff costs are answered with a bisect and a prefix sum lookup
+    without any further database queries.
+    Costs follow exactly the same rules for increments, financial years and salary grade changes as the chargeable period
+    iteration of `SalaryGradeChange.salary_band_at_future_date`.
+    """
+
+    def __init__(self, rse: RSE, salary_bands: Dict[Tuple[int, int, int], SalaryBand] = None, sgcs: List[SalaryGradeChange] = None):
+        self.rse = rse
+        # salary grade changes sorted by date (may be provided if loaded in bulk)
+        if sgcs is None:
+            sgcs = SalaryGradeChange.objects.filter(rse=rse).select_related('salary_band__year').order_by('date', 'id')
+        self.sgcs = list(sgcs)
+        self.sgc_dates = [sgc.date for sgc in self.sgcs]
+        # index of all salary bands by (grade, grade point, year)
+        if salary_bands is None:
+            salary_bands = salary_band_registry.index
+        self.salary_bands = salary_bands
+        self.chains = {}  # type: Dict[Tuple[int, bool], SalaryChain]
+        self.budget_curves = {}  # type: Dict[date, BudgetCurve]
+
+    @property
+    def employed_from(self) -> Optional[date]:
+        return self.sgc_dates[0] if self.sgcs else None
+
+    def employed_in_period(self, from_date: date, until_date: date) -> bool:
+        """ In memory equivalent of `RSE.employed_in_period` """
+        if not self.employed_from:
+            return False
+        return self.employed_from < until_date and self.rse.employed_until > from_date
+
+    @property
+    def current_employment(self) -> bool:
+        """ In memory equivalent of `RSE.current_employment` """
+        if not self.employed_from:
+            return False
+        now = timezone.now().date()
+        return self.employed_from < now and self.rse.employed_until > now
+
+    def first_salary_date(self) -> date:
+        """ Start of the financial year of the first salary grade change (raises ValueError if there is no salary data) """
+        if not self.sgcs:
+            raise ValueError('No Salary Data exists for this RSE')
+        return self.sgcs[0].salary_band.year.start_date()
+
+    def last_salary_grade_change(self, d: date) -> SalaryGradeChange:
+        """ In memory equivalent of `RSE.lastSalaryGradeChange` """
+        i = bisect_right(self.sgc_dates, d)
+        if i == 0:
+            raise ValueError('No Salary Data exists before specified date period for this RSE')
+        return self.sgcs[i - 1]
+
+    def latest_salary_grade_change(self, start: date, end: date) -> Optional[SalaryGradeChange]:
+        """ In memory equivalent of `SalaryGradeChange.next_salary_grade_change` (the latest change after start up to and including end) """
+        i = bisect_right(self.sgc_dates, end)
+        if i > 0 and self.sgc_dates[i - 1] > start:
+            return self.sgcs[i - 1]
+        return None
+
+    def chain(self, sgc: SalaryGradeChange, skip_first_increment: bool = False) -> SalaryChain:
+        """ Gets (or creates) the chain of salary bands following a salary grade change """
+        key = (sgc.id, skip_first_increment)
+        if key not in self.chains:
+            self.chains[key] = SalaryChain(self.salary_bands, sgc.date, sgc.salary_band, skip_first_increment)
+        return self.chains[key]
+
+    def salary_band_at(self, d: date) -> SalaryBand:
+        """ In memory equivalent of `RSE.futureSalaryBand` (i.e. `SalaryGradeChange.salary_band_at_future_date` from the last salary grade change) """
+        sgc = self.last_salary_grade_change(d)
+        if d < sgc.salary_band.year.start_date():
+            raise ValueError('Future salary can not be calculated from dates in the past')
+        skip_increment = skips_first_increment(sgc, sgc.date == self.employed_from, d)
+        return self.chain(sgc, skip_increment).salary_band_at(d)
+
+    def budget_curve(self, start: date) -> BudgetCurve:
+        """ Gets (or creates) the cumulative salary curve from a start date """
+        if start not in self.budget_curves:
+            self.budget_curves[start] = BudgetCurve(self, start)
+        return self.budget_curves[start]
+
+    def resolve(self, from_date: date, until_date: date) -> Tuple[date, date, SalaryChain, Optional[SalaryGradeChange]]:
+        """
+        Restricts a cost query to the employment period of the RSE and resolves the salary chain at the start of the query
+        along with any salary grade change which is applied within the period.
+        """
+        # Restrict from and until dates based off employment start and end
+        if self.employed_from > from_date:
+            from_date = self.employed_from
+        if self.rse.employed_until < until_date:
+            until_date = self.rse.employed_until
+
+        # Get the last salary grade change for the RSE at the start of the cost query
+        sgc = self.last_salary_grade_change(from_date)
+        if from_date < sgc.salary_band.year.start_date():
+            raise ValueError('Future salary can not be calculated from dates in the past')
+
+        skip_first_increment = skips_first_increment(sgc, sgc.date == self.employed_from, from_date)
+
+        # Only the most recent salary grade change within the period is applied and only if it does not occur on an
+        # increment or financial year change date
+        next_sgc = None
+        if until_date > from_date:
+            next_sgc = self.latest_salary_grade_change(from_date, until_date)
+            if next_sgc and is_salary_change_date(next_sgc.date):
+                next_sgc = None
+
+        return from_date, until_date, self.chain(sgc, skip_first_increment), next_sgc
+
+    def periods(self, from_date: date, until_date: date) -> Iterator[Tuple[date, date, SalaryBand]]:
+        """ Yields the chargeable periods (from, until, salary band) between two dates """
+        if not self.sgcs:
+            return
+        from_date, until_date, chain, next_sgc = self.resolve(from_date, until_date)
+
+        # Period with no duration (or negative) is costed using the salary band at the start
+        if until_date <= from_date:
+            yield from_date, until_date, chain.salary_band_at(from_date)
+        elif next_sgc:
+            yield from chain.periods(from_date, next_sgc.date, include_end=False)
+            yield from self.chain(next_sgc).periods(next_sgc.date, until_date)
+        else:
+            yield from chain.periods(from_date, until_date)
+
+    def salary_days(self, from_date: date, until_date: date) -> Decimal:
+        """ Returns the accumulated salary multiplied by days between two dates using prefix sums """
+        if not self.sgcs:
+            return Decimal(0)
+        from_date, until_date, chain, next_sgc = self.resolve(from_date, until_date)
+
+        if until_date <= from_date:
+            return Decimal(chain.salary_band_at(from_date).salary) * (until_date - from_date).days
+        elif next_sgc:
+            next_chain = self.chain(next_sgc)
+            return (chain.salary_days_until(next_sgc.date) - chain.salary_days_until(from_date)
+                    + next_chain.salary_days_until(until_date) - next_chain.salary_days_until(next_sgc.date))
+        else:
+            return chain.salary_days_until(until_date) - chain.salary_days_until(from_date)
+
+    def cost(self, from_date: date, until_date: date, percentage: float = 100.0) -> Decimal:
+        """ Returns the staff cost (including on costs) between two dates without any breakdown """
+        return salary_days_cost(self.salary_days(from_date, until_date), percentage)
+
+    def staff_cost(self, from_date: date, until_date: date, percentage: float = 100.0) -> SalaryValue:
+        """
+        Calculates the staff cost between a given period (see `RSE.staff_cost`).
+        The total is calculated from prefix sums and the breakdown lists each chargeable period.
+        """
+        salary_value = SalaryValue()
+        for period_from, period_until, salary_band in self.periods(from_date, until_date):
+            cost_in_period = SalaryBand.salaryCost(days=(period_until - period_from).days, salary=salary_band.salary, percentage=percentage)
+            salary_value.add_period(period_from, period_until, percentage, salary_band, cost_in_period)
+        salary_value.staff_cost = self.cost(from_date, until_date, percentage) if salary_value.staff_costs else 0
+        return salary_value
+
+
+class StaffCosts():
+    """
+    Batch staff costing for reports across a team of RSEs.
+    Salary grade changes for all RSEs are loaded with a single query and salary bands are resolved from the registry, giving
+    each RSE a salary timeline without any further queries. The cost of an allocation is then the difference of two prefix
+    sums of the RSEs daily salary (i.e. the daily salary multiplied by the allocation percentage for each day) so a report
+    over many RSEs and allocations is a single pass. Decimal costs are only formed once per RSE or allocation.
+    """
+
+    def __init__(self, rses: Iterable[RSE] = None):
+        if rses is None:
+            rses = RSE.objects.select_related('user')
+        self.rses = {rse.id: rse for rse in rses}
+
+        # load salary grade changes for all RSEs and build timelines
+        sgcs = defaultdict(list)
+        for sgc in SalaryGradeChange.objects.filter(rse__in=list(self.rses)).select_related('salary_band__year').order_by('date', 'id'):
+            sgcs[sgc.rse_id].append(sgc)
+        self.timelines = {rse_id: SalaryTimeline(rse, sgcs=sgcs[rse_id]) for rse_id, rse in self.rses.items()}
+
+    def allocations(self, q: Q = Q(), projects: Dict[int, Project] = None) -> List[RSEAllocation]:
+        """
+        Returns allocations for the RSEs matching a filter.
+        RSEs and (polymorphic) projects are attached to the allocations using a fixed number of queries. Projects are
+        only loaded if not provided.
+        """
+        allocations = list(RSEAllocation.objects.filter(q, rse__in=list(self.rses)).order_by('id'))
+        if projects is None:
+            projects = Project.objects.in_bulk({a.project_id for a in allocations})
+        for a in allocations:
+            a.rse = self.rses[a.rse_id]
+            a.project = projects[a.project_id]
+        return allocations
+
+    def rse_allocations(self, q: Q = Q()) -> Dict[int, List[RSEAllocation]]:
+        """ Returns allocations matching a filter grouped by RSE id (every RSE has an entry) """
+        rse_allocations = {rse_id: [] for rse_id in self.rses}
+        for a in self.allocations(q):
+            rse_allocations[a.rse_id].append(a)
+        return rse_allocations
+
+    def project_allocations(self, projects: Iterable[Project]) -> Dict[int, List[RSEAllocation]]:
+        """ Returns allocations for the projects grouped by project id (every project has an entry) """
+        projects = {p.id: p for p in projects}
+        project_allocations = {p_id: [] for p_id in projects}
+        for a in self.allocations(Q(project__in=list(projects)), projects):
+            project_allocations[a.project_id].append(a)
+        return project_allocations
+
+    def rse_cost(self, rse: RSE, from_date: date, until_date: date) -> Decimal:
+        """ Staff cost of an RSE between two dates (see `RSE.staff_cost`) """
+        return self.timelines[rse.id].cost(from_date, until_date)
+
+    def allocation_costs(self, allocations: Iterable[RSEAllocation], from_date: date, until_date: date, clamp_to_project: bool = False) -> Dict[int, Optional[Decimal]]:
+        """
+        Staff costs of allocations between two dates by allocation id (see `RSEAllocation.staff_cost`). If clamped to
+        projects then the period is also limited to the project duration (as in `Project.staff_cost`). An allocation has a
+        cost of None if it is missing salary data.
+        Costs depend on the start of the period so ledger totals (full allocation costs) are only used for allocations
+        within the period. Allocations which overlap the start or end of the period (or have not been costed by the
+        ledger) are costed from the salary timelines.
+        """
+        ledger_costs = cost_ledger.allocation_costs(self.rses, from_date, until_date, clamp_to_project)
+        costs = {}  # type: Dict[int, Optional[Decimal]]
+        for a in allocations:
+            # limit the period to the allocation (and project)
+            start, end = max(from_date, a.start), min(until_date, a.end)
+            if clamp_to_project:
+                start, end = max(start, a.project.start), min(end, a.project.end)
+            if (start, end) == (a.start, a.end) and a.id in ledger_costs:
+                costs[a.id] = ledger_costs[a.id]
+                continue
+            try:
+                costs[a.id] = self.timelines[a.rse_id].cost(start, end, a.percentage)
+            except ValueError:
+                costs[a.id] = None
+        return costs
+
+    def project_costs(self, projects: Iterable[Project], from_date: date, until_date: date) -> Dict[int, Optional[Decimal]]:
+        """
+        Staff costs of projects (including internal projects) between two dates by project id (see `Project.staff_cost`).
+        Allocations of the projects must be by RSEs in the batch. A project has a cost of None if any allocation is
+        missing salary data.
+        """
+        projects = list(projects)
+        project_allocations = self.project_allocations(projects)
+        # only allocations within the period limited to the project duration
+        for p in projects:
+            project_allocations[p.id] = [a for a in project_allocations[p.id] if a.end > max(from_date, p.start) and a.start < min(until_date, p.end)]
+        allocation_costs = self.allocation_costs((a for p in projects for a in project_allocations[p.id]), from_date, until_date, clamp_to_project=True)
+
+        project_costs = {}  # type: Dict[int, Optional[Decimal]]
+        for p in projects:
+            costs = [allocation_costs[a.id] for a in project_allocations[p.id]]
+            project_costs[p.id] = None if None in costs else sum(costs, Decimal(0))
+        return project_costs
+
+    def project_salary_value(self, project: Project, allocations: Iterable[RSEAllocation], from_date: date = None, until_date: date = None, consider_internal: bool = False) -> SalaryValue:
+        """
+        Staff cost of a projects allocations with breakdowns by allocation (see `Project.staff_cost`).
+        Allocations should be all allocations for the project (e.g. from `project_allocations`).
+        """
+        salary_value = SalaryValue()
+        # don't consider internal projects
+        if not consider_internal and project.internal:
+            return salary_value
+
+        # limit specified time period to project
+        if from_date is None or from_date < project.start:
+            from_date = project.start
+        if until_date is None or until_date > project.end:
+            until_date = project.end
+
+        allocations = [a for a in allocations if a.end > from_date and a.start < until_date]
+        # limit time period to each allocation (see `RSEAllocation.staff_cost`)
+        salary_value.merge((self.timelines[a.rse_id].staff_cost(max(from_date, a.start), min(until_date, a.end), a.percentage) for a in allocations), allocations)
+        return salary_value
+
+
+class CostLedger():
+    """
+    Materialised staff costs of allocations (see `AllocationCost`).
+    Each allocation is costed over its full duration using the salary timeline of the RSE (i.e. as
+    `RSEAllocation.staff_cost`) and split into rows for each month and salary band. The cost of an allocation over part of
+    its duration depends on the start of the costed period (see `SalaryTimeline.resolve`) so ledger totals are only used
+    for allocations which lie within a report period (see `StaffCosts.allocation_costs`).
+    Allocations are costed again when they or the salary data of their RSE change (see `rse.signals`). Changes to salary
+    bands or financial years affect all RSEs so only remove rows, and allocations without rows are costed from salary
+    timelines by reports until the ledger is rebuilt (see the `rebuild_costs` command). Reports never write to the ledger.
+    """
+
+    def invalidate(self, rse_ids: Iterable[int] = None, from_date: date = None):
+        """ Removes the rows of allocations (of RSEs) which end after a date so that they are costed again """
+        allocations = RSEAllocation.objects.all(deleted=True)
+        if rse_ids is not None:
+            allocations = allocations.filter(rse__in=list(rse_ids))
+        if from_date is not None:
+            allocations = allocations.filter(end__gt=from_date)
+        with transaction.atomic():
+            # allocations are locked so that rows being costed concurrently (see `update`) are removed once they are written
+            allocation_ids = list(allocations.select_for_update().values_list('id', flat=True))
+            AllocationCost.objects.filter(allocation__in=allocation_ids).delete()
+
+    def allocation_rows(self, allocation: RSEAllocation, timeline: SalaryTimeline) -> List[AllocationCost]:
+        """
+        Costs an allocation as rows for each month and salary band. An allocation which is missing salary data has rows
+        with no cost.
+        """
+        try:
+            periods = list(timeline.periods(allocation.start, allocation.end))
+        except ValueError:
+            periods = [(allocation.start, allocation.end, None)]
+
+        rows = []
+        for period_from, period_until, salary_band in periods:
+            # split period by months (a period outside of employment has a negative duration and is a single row)
+            while period_from != period_until:
+                month_end = min(next_month(period_from), period_until) if period_from < period_until else period_until
+                days = (month_end - period_from).days
+                row = AllocationCost(allocation=allocation, rse_id=allocation.rse_id, project_id=allocation.project_id, month=period_from.replace(day=1), start=period_from, end=month_end, days=days)
+                if salary_band is not None:
+                    row.salary_band_id = salary_band.salary_band.id if salary_band.estimated else salary_band.id
+                    row.salary = salary_band.salary
+                    row.estimated = salary_band.estimated
+                    row.cost = SalaryBand.salaryCost(days=days, salary=salary_band.salary, percentage=allocation.percentage)
+                rows.append(row)
+                period_from = month_end
+
+        # allocations with no cost (e.g. an RSE without salary grade changes) have a single empty row
+        if not rows:
+            rows.append(AllocationCost(allocation=allocation, rse_id=allocation.rse_id, project_id=allocation.project_id, month=allocation.start.replace(day=1), start=allocation.start, end=allocation.start, days=0, cost=0))
+        return rows
+
+    def update(self, allocations: QuerySet):
+        """
+        Replaces the rows of allocations with their current costs (deleted allocations only have their rows removed).
+        Allocations are locked while they are costed so that a concurrent invalidation waits for the rows to be written
+        (and then removes them) and rows which another process is writing are not duplicated.
+        """
+        with transaction.atomic():
+            allocations = list(allocations.select_for_update(of=('self',)).order_by('id'))
+            AllocationCost.objects.filter(allocation__in=[a.id for a in allocations]).delete()
+            allocations = [a for a in allocations if a.deleted_date is None]
+            if not allocations:
+                return
+            costs = StaffCosts(RSE.objects.filter(id__in={a.rse_id for a in allocations}))
+            AllocationCost.objects.bulk_create([row for a in allocations for row in self.allocation_rows(a, costs.timelines[a.rse_id])])
+
+    def ensure(self):
+        """ Costs any allocations which do not have rows """
+        self.update(RSEAllocation.objects.filter(costs__isnull=True))
+
+    def allocation_costs(self, rse_ids: Iterable[int], from_date: date = None, until_date: date = None, clamp_to_project: bool = False) -> Dict[int, Optional[Decimal]]:
+        """
+        Full staff costs of the allocations of RSEs by allocation id, summed in the database. Only allocations within a
+        period (and their project duration if clamped) are included if dates are given. An allocation has a cost of None
+        if it is missing salary data and allocations without rows are not included.
+        """
+        q = Q(rse__in=list(rse_ids), allocation__deleted_date__isnull=True)
+        if from_date is not None:
+            q &= Q(allocation__start__gte=from_date)
+        if until_date is not None:
+            q &= Q(allocation__end__lte=until_date)
+        if clamp_to_project:
+            q &= Q(allocation__start__gte=F('project__start'), allocation__end__lte=F('project__end'))
+        rows = AllocationCost.objects.filter(q).values('allocation').annotate(total=Sum('cost'), missing=Count('id', filter=Q(cost__isnull=True))).order_by()
+        return {r['allocation']: None if r['missing'] else r['total'] for r in rows}
+
+
+cost_ledger = CostLedger()
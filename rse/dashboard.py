@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterable
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db.models import Q
+
+from rse.models import RSE, Project, RSEAllocation
+
+
+class DashboardCache():
+    """
+    Cache of home page dashboard snapshots using the Django cache framework (see `CACHES` setting).
+    Each snapshot depends on named keys (e.g. 'projects' or 'allocations:<rse id>') which each have a version held in the
+    cache. A snapshot is stored with the versions of its keys and is only used if they are unchanged, so saving or deleting
+    a project or allocation (see `rse.signals`) invalidates only the affected snapshots by incrementing the key versions.
+    The snapshot and key versions are read together so a cached snapshot costs a single cache read.
+    """
+
+    PREFIX = 'rse:dashboard'
+
+    def __init__(self, alias: str = DEFAULT_CACHE_ALIAS):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def version_key(self, key: str) -> str:
+        return f"{self.PREFIX}:version:{key}"
+
+    @staticmethod
+    def new_version() -> int:
+        # versions are unique so that a key version which has been evicted from the cache is never reused
+        return time.time_ns()
+
+    def get(self, name: str, keys: Iterable[str], build: Callable[[], Dict[str, object]]) -> Dict[str, object]:
+        """
+        Returns the snapshot with the given name, building and storing it if it is not cached or any of the keys it
+        depends on have changed.
+        """
+        version_keys = [self.version_key(key) for key in keys]
+        snapshot_key = f"{self.PREFIX}:{name}"
+        values = self.cache.get_many([snapshot_key] + version_keys)
+        versions = tuple(values.get(k) for k in version_keys)
+        cached = values.get(snapshot_key)
+        if cached is not None and None not in versions and cached[0] == versions:
+            return cached[1]
+
+        # keys without a version are given a new one (add keeps any version set concurrently)
+        for k, version in zip(version_keys, versions):
+            if version is None:
+                self.cache.add(k, self.new_version(), timeout=None)
+        versions = tuple(self.cache.get(k) for k in version_keys)
+        snapshot = build()
+        self.cache.set(snapshot_key, (versions, snapshot), settings.HOME_PAGE_CACHE_TIMEOUT)
+        return snapshot
+
+    def invalidate(self, *keys: str):
+        """ Invalidates all snapshots which depend on any of the keys """
+        for key in keys:
+            try:
+                self.cache.incr(self.version_key(key))
+            except ValueError:
+                # no version so no snapshot can be valid for the key
+                pass
+
+    def clear(self):
+        """ Invalidates all snapshots (every snapshot depends on projects) """
+        self.cache.delete(self.version_key('projects'))
+
+
+dashboard_cache = DashboardCache()
+
+
+def admin_snapshot(now: date) -> Dict[str, object]:
+    """
+    Highlights, lists, warnings and dangers for the admin home page at a date.
+    Depends on all projects, allocations and RSEs.
+    """
+
+    def build() -> Dict[str, object]:
+        soon = now + timedelta(days=settings.HOME_PAGE_DAYS_SOON)
+        snapshot = {}  # type: Dict[str, object]
+
+        # HIGHTLIGHT: team capacity
+        # employment and capacity are annotated so that no queries are required for each RSE
+        rses = list(RSE.objects.current_employment().with_capacity(now).select_related('user'))
+        try:
+            average_capacity = sum(rse.capacity for rse in rses) / len(rses)
+        except ZeroDivisionError:
+            average_capacity = 0
+        snapshot['rses'] = rses
+        snapshot['average_capacity'] = average_capacity
+
+        # RSE capacity
+        snapshot['rses_capacity_low'] = [rse for rse in rses if rse.capacity < settings.HOME_PAGE_RSE_MIN_CAPACITY_WARNING_LEVEL]
+
+        # HIGHTLIGHTS, WARNINGS and DANGERS: project counts (active, under review, outstanding invoices etc.)
+        snapshot.update(Project.objects.dashboard_counts(now, soon))
+
+        # Latest projects added
+        snapshot['lastest_projects'] = list(Project.objects.all().select_related('creator').order_by('-created')[0:settings.HOME_PAGE_NUMBER_ITEMS])
+
+        # Projects starting
+        snapshot['starting_projects'] = list(Project.objects.filter(start__gt=now).select_related('creator').order_by('start')[0:settings.HOME_PAGE_NUMBER_ITEMS])
+
+        return snapshot
+
+    return dashboard_cache.get(f"admin:{now.isoformat()}", ('projects', 'allocations', 'rses'), build)
+
+
+def rse_snapshot(rse: RSE, now: date) -> Dict[str, object]:
+    """
+    Highlights and allocations for an RSEs home page at a date.
+    Depends on all projects and the allocations of the RSE.
+    """
+
+    def build() -> Dict[str, object]:
+        snapshot = {}  # type: Dict[str, object]
+
+        # HIGHLIGHT: Current Capacity
+        snapshot['highlight_current_capacity'] = RSE.objects.with_capacity(now).get(id=rse.id).capacity
+
+        # HIGHLIGHT: Active allocations
+        snapshot['highlight_active_allocations'] = RSEAllocation.objects.filter(rse=rse, start__lte=now, end__gte=now, project__status=Project.FUNDED).count()
+
+        # HIGHLIGHT: funded and possible projects (anything not rejected that has not completed)
+        snapshot['highlight_possible_allocations'] = RSEAllocation.objects.filter(rse=rse, end__gte=now).filter(Q(project__status=Project.REVIEW)|Q(project__status=Project.PREPARATION)|Q(project__status=Project.FUNDED)).count()
+
+        # HIGHTLIGHT: active projects
+        soon = now + timedelta(days=settings.HOME_PAGE_DAYS_SOON)
+        snapshot['highlight_active_funded_projects'] = Project.objects.dashboard_counts(now, soon)['active_funded_projects']
+
+        # active allocation progress and first X non active projects due (projects are loaded so that the snapshot is complete)
+        active_allocations = list(RSEAllocation.objects.filter(rse=rse, start__lte=now, end__gte=now, project__status=Project.FUNDED))
+        future_allocations = list(RSEAllocation.objects.filter(rse=rse, start__gte=now).filter(Q(project__status=Project.REVIEW)|Q(project__status=Project.PREPARATION)|Q(project__status=Project.FUNDED)).order_by('start')[0:settings.HOME_PAGE_NUMBER_ITEMS])
+        projects = Project.objects.in_bulk({a.project_id for a in active_allocations + future_allocations})
+        for a in active_allocations + future_allocations:
+            a.project = projects[a.project_id]
+        snapshot['active_allocations'] = active_allocations
+        snapshot['future_allocations'] = future_allocations
+
+        snapshot['MAX_END_DATE_FILTER_RANGE'] = Project.max_end_date()
+        snapshot['MIN_START_DATE_FILTER_RANGE'] = Project.min_start_date()
+
+        return snapshot
+
+    return dashboard_cache.get(f"rse:{rse.id}:{now.isoformat()}", ('projects', f"allocations:{rse.id}"), build)
@@ -8,6 +8,7 @@ from django.utils.html import format_html
 import logging
 
 from .models import *
+from .costing import salary_band_registry
 
 logger = logging.getLogger(__name__)
 
@@ -806,7 +807,7 @@ class NewFinancialYearForm(forms.ModelForm):
             # copy salary band data
             if self.cleaned_data["copy_from"]:
                 copy_year = self.cleaned_data["copy_from"]
-                sbs = SalaryBand.objects.filter(year=copy_year)
+                sbs = salary_band_registry.for_year(copy_year.year)
                 for sb in sbs:
                     sb.pk = None  # remove pk to save as new item in database
                     sb.year = financial_year
@@ -0,0 +1,58 @@
+"""
+Management command to archive deleted allocations.
+Allocations are never deleted (edits flag the allocation as deleted and create a new one) so the allocation table grows
+with every edit. Allocations deleted more than a number of years ago are moved to the `RSEAllocationHistory` table.
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from rse.models import RSEAllocation, RSEAllocationHistory
+
+
+# fields copied from allocations to the history table
+HISTORY_FIELDS = [f.attname for f in RSEAllocationHistory._meta.concrete_fields]
+
+
+class Command(BaseCommand):
+    help = 'Moves allocations deleted more than a number of years ago to the allocation history table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=2, help='Archive allocations deleted more than this many years ago.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of allocations moved in each transaction.')
+        parser.add_argument('--dry-run', action='store_true', help='Report the number of allocations which would be archived without moving them.')
+
+    def handle(self, *args, **options):
+        if options['years'] < 0:
+            raise CommandError('Years must not be negative')
+        before = timezone.now() - timedelta(days=365 * options['years'])
+        deleted = RSEAllocation.objects.all(deleted=True).filter(deleted_date__lt=before)
+        total = deleted.count()
+        if options['dry_run']:
+            self.stdout.write(f'{total} allocations deleted before {before:%Y-%m-%d} would be archived')
+            return
+
+        archived = 0
+        while True:
+            ids = list(deleted.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            try:
+                self.archive(ids)
+            except IntegrityError as e:
+                raise CommandError(f'Allocations {ids[0]} to {ids[-1]} could not be archived as they are already in the history table ({e})')
+            archived += len(ids)
+            self.stdout.write(f'{archived}/{total} allocations', ending='\r' if archived < total else '\n')
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} allocations deleted before {before:%Y-%m-%d}'))
+
+    @transaction.atomic
+    def archive(self, ids):
+        """
+        Copies allocations to the history table and removes them (and their cost ledger rows).
+        An allocation which is already in the history table aborts the batch so that no allocations are lost.
+        """
+        allocations = RSEAllocation.objects.all(deleted=True).filter(id__in=ids)
+        RSEAllocationHistory.objects.bulk_create([RSEAllocationHistory(**values) for values in allocations.values(*HISTORY_FIELDS)])
+        allocations.delete()
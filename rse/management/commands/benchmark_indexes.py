@@ -0,0 +1,162 @@
+"""
+Management command to benchmark the allocation, time sheet and project indexes.
+A temporary test database is seeded with synthetic RSEs, projects, allocations (including deleted allocations) and time sheet
+entries. The query plans and timings of common view queries are reported without the indexes and again with them.
+The configured database is never modified.
+"""
+import random
+import statistics
+import time
+from datetime import date, time as dtime, timedelta
+from typing import Callable, Dict, List, Tuple
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from rse.models import RSE, Client, Project, RSEAllocation, ServiceProject
+from timetracking.models import TimeSheetEntry
+
+
+# models with indexes which are benchmarked
+INDEXED_MODELS = [Project, RSEAllocation, TimeSheetEntry]
+
+# first date of seeded data
+EPOCH = date(2015, 1, 1)
+
+
+class Sample():
+    """ Random parameters of a benchmarked query """
+
+    def __init__(self, rng: random.Random, rse_ids: List[int], project_ids: List[int], days: int):
+        self.rse = rng.choice(rse_ids)
+        self.project = rng.choice(project_ids)
+        self.at = EPOCH + timedelta(days=rng.randrange(days))
+        self.from_date = self.at - timedelta(days=90)
+        self.until_date = self.at + timedelta(days=90)
+
+
+# common queries of views by description
+QUERIES = {
+    'RSE capacity at a date': lambda s: RSEAllocation.objects.filter(rse=s.rse, start__lte=s.at, end__gt=s.at, project__status=Project.FUNDED),
+    'Project allocations up to a date': lambda s: RSEAllocation.objects.filter(project=s.project, start__lte=s.at),
+    'RSE allocations in a period': lambda s: RSEAllocation.objects.filter(rse=s.rse, end__gte=s.from_date, start__lte=s.until_date),
+    'RSE time sheet in a period': lambda s: TimeSheetEntry.objects.filter(rse=s.rse, date__gte=s.from_date, date__lt=s.until_date),
+    'Project time sheet in a period': lambda s: TimeSheetEntry.objects.filter(project=s.project, date__gte=s.from_date, date__lt=s.until_date),
+    'Active funded projects': lambda s: Project.objects.non_polymorphic().filter(status=Project.FUNDED, start__lte=s.at, end__gt=s.at),
+}  # type: Dict[str, Callable[[Sample], QuerySet]]
+
+
+class Command(BaseCommand):
+    help = 'Reports query plans and timings of common queries without and with database indexes on a seeded temporary database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--allocations', type=int, default=100000, help='Number of seeded allocations (a third are deleted).')
+        parser.add_argument('--entries', type=int, default=100000, help='Number of seeded time sheet entries.')
+        parser.add_argument('--rses', type=int, default=50, help='Number of seeded RSEs.')
+        parser.add_argument('--projects', type=int, default=1000, help='Number of seeded projects.')
+        parser.add_argument('--years', type=int, default=10, help='Number of years spanned by the seeded data.')
+        parser.add_argument('--samples', type=int, default=50, help='Number of random parameters that each query is timed with.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            rng = random.Random(options['seed'])
+            started = time.perf_counter()
+            indexes = self.drop_indexes()
+            rse_ids, project_ids, days = self.seed(rng, options)
+            self.stdout.write(f"Seeded {options['allocations']} allocations and {options['entries']} time sheet entries in {time.perf_counter() - started:.1f}s")
+            samples = [Sample(rng, rse_ids, project_ids, days) for _ in range(options['samples'])]
+
+            before = self.benchmark(samples)
+            self.create_indexes(indexes)
+            after = self.benchmark(samples)
+
+            for name in QUERIES:
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                self.stdout.write(f'  without indexes ({before[name][1]:.2f}ms):')
+                self.stdout.write(self.indent(before[name][0]))
+                self.stdout.write(f'  with indexes ({after[name][1]:.2f}ms):')
+                self.stdout.write(self.indent(after[name][0]))
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'Median query time ({connection.vendor}, {len(samples)} samples)'))
+            for name in QUERIES:
+                speedup = before[name][1] / after[name][1] if after[name][1] > 0 else 0
+                self.stdout.write(f'  {name:<36} {before[name][1]:>9.2f}ms {after[name][1]:>9.2f}ms {speedup:>7.1f}x')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    @staticmethod
+    def indent(plan: str) -> str:
+        return '\n'.join(f'    {line}' for line in plan.splitlines())
+
+    def drop_indexes(self) -> List[Tuple[type, object]]:
+        """ Removes the declared indexes of the benchmarked models returning them so they can be created again """
+        indexes = [(model, index) for model in INDEXED_MODELS for index in model._meta.indexes]
+        with connection.schema_editor() as schema_editor:
+            for model, index in indexes:
+                schema_editor.remove_index(model, index)
+        return indexes
+
+    def create_indexes(self, indexes: List[Tuple[type, object]]):
+        with connection.schema_editor() as schema_editor:
+            for model, index in indexes:
+                schema_editor.add_index(model, index)
+
+    def seed(self, rng: random.Random, options: Dict) -> Tuple[List[int], List[int], int]:
+        """ Creates synthetic data returning the RSE ids, project ids and number of days spanned """
+        days = 365 * options['years']
+        now = timezone.now()
+
+        users = User.objects.bulk_create([User(username=f'benchmark{i}') for i in range(options['rses'])])
+        rses = RSE.objects.bulk_create([RSE(user=u, employed_until=EPOCH + timedelta(days=days)) for u in users])
+        rse_ids = [r.id for r in rses]
+
+        # projects are multi table inherited models which can not be created in bulk
+        creator = users[0]
+        client = Client.objects.create(name='benchmark', department='benchmark')
+        statuses = [Project.FUNDED] * 6 + [Project.PREPARATION, Project.REVIEW, Project.REJECTED]
+        project_ids = []
+        for i in range(options['projects']):
+            start = EPOCH + timedelta(days=rng.randrange(days))
+            p = ServiceProject.objects.create(creator=creator, created=now, name=f'benchmark{i}', client=client, start=start,
+                                              end=start + timedelta(days=rng.randrange(30, 1000)), status=rng.choice(statuses), days=10, rate=100)
+            project_ids.append(p.id)
+
+        allocations = []
+        for i in range(options['allocations']):
+            start = EPOCH + timedelta(days=rng.randrange(days))
+            # a third of allocations are deleted (i.e. edits)
+            deleted = now if i % 3 == 0 else None
+            allocations.append(RSEAllocation(rse_id=rng.choice(rse_ids), project_id=rng.choice(project_ids), percentage=rng.choice((10, 25, 50, 100)),
+                                             start=start, end=start + timedelta(days=rng.randrange(7, 400)), created_date=now, deleted_date=deleted))
+        RSEAllocation.objects.bulk_create(allocations, batch_size=5000)
+
+        entries = [TimeSheetEntry(rse_id=rng.choice(rse_ids), project_id=rng.choice(project_ids), date=EPOCH + timedelta(days=rng.randrange(days)),
+                                  all_day=False, start_time=dtime(9), end_time=dtime(12)) for _ in range(options['entries'])]
+        TimeSheetEntry.objects.bulk_create(entries, batch_size=5000)
+        return rse_ids, project_ids, days
+
+    def benchmark(self, samples: List[Sample]) -> Dict[str, Tuple[str, float]]:
+        """ Query plan (of the first sample) and median time in milliseconds of each query """
+        if connection.vendor in ('sqlite', 'postgresql'):
+            # update planner statistics
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+        results = {}
+        for name, query in QUERIES.items():
+            plan = query(samples[0]).explain()
+            times = []
+            with connection.cursor() as cursor:
+                for sample in samples:
+                    # only the database is timed (i.e. not the creation of model instances)
+                    sql, params = query(sample).query.sql_with_params()
+                    started = time.perf_counter()
+                    cursor.execute(sql, params)
+                    cursor.fetchall()
+                    times.append((time.perf_counter() - started) * 1000)
+            results[name] = (plan, statistics.median(times))
+        return results
@@ -0,0 +1,182 @@
+"""
+Management command to rebuild (or verify) the staff costs of allocations held in the cost ledger.
+Allocations are partitioned by RSE and costed by a pool of worker processes with all database writes made in bulk by
+the command process. Changes to salary bands or financial years only remove ledger costs, so the command should be run
+with `--missing` after salary data is updated (e.g. from a scheduled job).
+"""
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from rse.costing import SalaryTimeline, cost_ledger
+from rse.models import RSE, AllocationCost, RSEAllocation
+
+
+# fields of ledger rows written by the command (all fields except the primary key)
+ROW_FIELDS = [f.attname for f in AllocationCost._meta.concrete_fields if not f.primary_key]
+
+
+def parse_date(value: str) -> date:
+    """ Parses a date argument in ISO format (YYYY-MM-DD) """
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f'Invalid date {value} (expected YYYY-MM-DD)')
+
+
+def rse_allocations(rse_id: int, from_date: date, until_date: date, missing: bool = False):
+    """ Allocations of an RSE which overlap a period (and only those without ledger rows if missing) """
+    allocations = RSEAllocation.objects.filter(rse_id=rse_id, end__gt=from_date, start__lt=until_date)
+    if missing:
+        allocations = allocations.filter(costs__isnull=True)
+    return allocations
+
+
+def cost_rse(rse_id: int, from_date: date, until_date: date, missing: bool = False) -> Tuple[List[int], List[Dict]]:
+    """ Worker function which costs the allocations of an RSE returning the allocation ids and the field values of ledger rows """
+    timeline = SalaryTimeline(RSE.objects.get(id=rse_id))
+    allocations = list(rse_allocations(rse_id, from_date, until_date, missing))
+    rows = [{f: getattr(row, f) for f in ROW_FIELDS} for a in allocations for row in cost_ledger.allocation_rows(a, timeline)]
+    return [a.id for a in allocations], rows
+
+
+def verify_rse(rse_id: int, from_date: date, until_date: date) -> Tuple[int, List[Tuple[RSEAllocation, Optional[Decimal], Optional[Decimal]]]]:
+    """
+    Worker function which compares the ledger costs of the allocations of an RSE (over their full duration) with the live
+    costs of `RSEAllocation.staff_cost`. Returns the number of allocations and any mismatches as (allocation, ledger, live).
+    """
+    rse = RSE.objects.select_related('user').get(id=rse_id)
+    allocations = list(rse_allocations(rse_id, from_date, until_date).select_related('project'))
+    ledger = cost_ledger.allocation_costs([rse_id])
+
+    mismatches = []
+    for a in allocations:
+        a.rse = rse
+        try:
+            live = a.staff_cost().staff_cost
+        except ValueError:
+            live = None
+        cost = ledger.get(a.id, Decimal(0))
+        if (cost is None) != (live is None) or cost is not None and abs(cost - live) >= Decimal('0.01'):
+            mismatches.append((a, cost, live))
+    return len(allocations), mismatches
+
+
+def setup_worker():
+    """ Worker processes need Django configured if they are not forked from the command process """
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the staff costs of allocations in the cost ledger (or verifies them against live staff costs)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', type=parse_date, help='Start of the period of allocations to cost (YYYY-MM-DD). Defaults to the first allocation start.')
+        parser.add_argument('--until', dest='until_date', type=parse_date, help='End of the period of allocations to cost (YYYY-MM-DD). Defaults to the last allocation end.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of worker processes. A single worker costs allocations without a process pool.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of allocations written to the database in each batch.')
+        parser.add_argument('--verify', action='store_true', help='Compare ledger costs with live staff costs and report mismatches rather than rebuilding.')
+        parser.add_argument('--missing', action='store_true', help='Only cost allocations without ledger costs (e.g. after salary bands or financial years change).')
+
+    def handle(self, *args, **options):
+        from_date = options['from_date'] or RSEAllocation.min_allocation_start()
+        until_date = options['until_date'] or RSEAllocation.max_allocation_end()
+        if from_date is None or until_date is None:
+            self.stdout.write('No allocations to cost')
+            return
+        if from_date >= until_date:
+            raise CommandError(f'Start date {from_date} must be before end date {until_date}')
+
+        # partition by RSE (largest first so that workers finish together)
+        allocations = RSEAllocation.objects.filter(end__gt=from_date, start__lt=until_date)
+        if options['missing'] and not options['verify']:
+            allocations = allocations.filter(costs__isnull=True)
+        rse_counts = Counter(allocations.values_list('rse', flat=True))
+        total = sum(rse_counts.values())
+        partitions = [rse_id for rse_id, _ in rse_counts.most_common()]
+
+        if options['verify']:
+            # cost any allocations missing from the ledger once before workers read it
+            cost_ledger.ensure()
+            handler, worker = self.handle_verified, verify_rse
+        else:
+            handler, worker = self.handle_costed, partial(cost_rse, missing=options['missing'])
+        self.pending = []
+        self.mismatches = []
+        self.done = 0
+        self.batch_size = options['batch_size']
+
+        started = time.perf_counter()
+        worker = partial(worker, from_date=from_date, until_date=until_date)
+        if options['workers'] > 1:
+            # connections can not be shared with worker processes
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=setup_worker) as pool:
+                for result in pool.map(worker, partitions):
+                    handler(result, total)
+        else:
+            for result in map(worker, partitions):
+                handler(result, total)
+        self.write_rows()
+        elapsed = time.perf_counter() - started
+
+        for a, cost, live in self.mismatches:
+            self.stdout.write(self.style.ERROR(f'Allocation {a.id} ({a} from {a.start} to {a.end}): ledger cost {cost}, staff cost {live}'))
+        rate = total / elapsed if elapsed > 0 else 0
+        action = 'Verified' if options['verify'] else 'Costed'
+        self.stdout.write(self.style.SUCCESS(f'{action} {total} allocations of {len(partitions)} RSEs from {from_date} to {until_date} in {elapsed:.1f}s ({rate:.1f} allocations/sec)'))
+        if options['verify']:
+            if self.mismatches:
+                raise CommandError(f'{len(self.mismatches)} allocations have ledger costs which differ from staff costs')
+            self.stdout.write(self.style.SUCCESS('All ledger costs match staff costs'))
+
+    def progress(self, allocations: int, total: int):
+        self.done += allocations
+        self.stdout.write(f'{self.done}/{total} allocations', ending='\r' if self.done < total else '\n')
+
+    def handle_costed(self, result: Tuple[List[int], List[Dict]], total: int):
+        allocation_ids, rows = result
+        self.pending.append(result)
+        if sum(len(ids) for ids, _ in self.pending) >= self.batch_size:
+            self.write_rows()
+        self.progress(len(allocation_ids), total)
+
+    def handle_verified(self, result: Tuple[int, List], total: int):
+        allocations, mismatches = result
+        self.mismatches.extend(mismatches)
+        self.progress(allocations, total)
+
+    @transaction.atomic
+    def write_rows(self):
+        """
+        Writes pending rows replacing the existing rows of the allocations. Existing rows for the same allocation period
+        are updated, any new periods are created and any periods which no longer exist are removed.
+        """
+        allocation_ids = [i for ids, _ in self.pending for i in ids]
+        rows = [AllocationCost(**row) for _, rows in self.pending for row in rows]
+        self.pending = []
+        if not allocation_ids:
+            return
+
+        existing = {(r.allocation_id, r.start): r for r in AllocationCost.objects.filter(allocation__in=allocation_ids)}
+        updated = []
+        created = []
+        for row in rows:
+            previous = existing.pop((row.allocation_id, row.start), None)
+            if previous:
+                row.id = previous.id
+                updated.append(row)
+            else:
+                created.append(row)
+        AllocationCost.objects.filter(id__in=[r.id for r in existing.values()]).delete()
+        AllocationCost.objects.bulk_update(updated, [f for f in ROW_FIELDS if f not in ('allocation_id', 'start')], batch_size=self.batch_size)
+        AllocationCost.objects.bulk_create(created, batch_size=self.batch_size)
@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-18 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rse', '0010_alter_serviceproject_days'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllocationCost',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('start', models.DateField()),
+                ('end', models.DateField()),
+                ('days', models.IntegerField()),
+                ('salary', models.DecimalField(decimal_places=2, max_digits=8, null=True)),
+                ('estimated', models.BooleanField(default=False)),
+                ('cost', models.DecimalField(decimal_places=4, max_digits=12, null=True)),
+                ('allocation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='costs', to='rse.rseallocation')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rse.project')),
+                ('rse', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rse.rse')),
+                ('salary_band', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='rse.salaryband')),
+            ],
+        ),
+    ]
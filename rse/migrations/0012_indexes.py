@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rse', '0011_allocationcost'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='project',
+            index=models.Index(fields=['status', 'start', 'end'], name='rse_project_status_dates_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rseallocation',
+            index=models.Index(condition=models.Q(('deleted_date__isnull', True)), fields=['rse', 'start', 'end'], name='rse_allocation_live_rse_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rseallocation',
+            index=models.Index(condition=models.Q(('deleted_date__isnull', True)), fields=['project', 'start', 'end'], name='rse_allocation_live_proj_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rse', '0012_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RSEAllocationHistory',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('percentage', models.FloatField()),
+                ('start', models.DateField()),
+                ('end', models.DateField()),
+                ('created_date', models.DateTimeField()),
+                ('deleted_date', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rseallocation',
+            index=models.Index(condition=models.Q(('deleted_date__isnull', True)), fields=['start', 'end'], name='rse_allocation_live_dates_idx'),
+        ),
+        migrations.AddField(
+            model_name='rseallocationhistory',
+            name='project',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rse.project'),
+        ),
+        migrations.AddField(
+            model_name='rseallocationhistory',
+            name='rse',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rse.rse'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:48
+
+from django.db import migrations, models
+
+
+def clear_cost_ledger(apps, schema_editor):
+    """ Existing rows may be duplicated so are removed (allocations are costed again on next use) """
+    AllocationCost = apps.get_model('rse', 'AllocationCost')
+    AllocationCost.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rse', '0013_rseallocationhistory'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_cost_ledger, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='allocationcost',
+            constraint=models.UniqueConstraint(fields=('allocation', 'start'), name='allocation_cost_unique_start'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+# Plain composite indexes matching the partial allocation indexes (see `RSEAllocation.Meta`). Django skips indexes with a
+# condition on databases without partial index support (e.g. MySQL) so these are only created on those databases.
+FALLBACK_INDEXES = [
+    models.Index(fields=['rse', 'start', 'end'], name='rse_allocation_rse_idx'),
+    models.Index(fields=['project', 'start', 'end'], name='rse_allocation_proj_idx'),
+    models.Index(fields=['start', 'end'], name='rse_allocation_dates_idx'),
+]
+
+
+def add_fallback_indexes(apps, schema_editor):
+    if schema_editor.connection.features.supports_partial_indexes:
+        return
+    RSEAllocation = apps.get_model('rse', 'RSEAllocation')
+    for index in FALLBACK_INDEXES:
+        schema_editor.add_index(RSEAllocation, index)
+
+
+def remove_fallback_indexes(apps, schema_editor):
+    if schema_editor.connection.features.supports_partial_indexes:
+        return
+    RSEAllocation = apps.get_model('rse', 'RSEAllocation')
+    for index in FALLBACK_INDEXES:
+        schema_editor.remove_index(RSEAllocation, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rse', '0014_allocationcost_unique_start'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_fallback_indexes, remove_fallback_indexes),
+    ]
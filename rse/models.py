@@ -1,10 +1,12 @@
 from __future__ import annotations
 
 import math
+from bisect import bisect_right
 from datetime import date, timedelta
 from django.utils import timezone
+from django.utils.functional import cached_property
 from math import floor
-from typing import Optional, Dict
+from typing import Optional, Dict, List, NamedTuple, Tuple
 from decimal import Decimal
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
@@ -12,11 +14,14 @@ from django.db.utils import OperationalError, ProgrammingError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.utils.translation import gettext_lazy as _
+from polymorphic.managers import PolymorphicManager
 from polymorphic.models import PolymorphicModel
-from django.db.models import Max, Min, QuerySet
-from typing import Iterator, Union, TypeVar, Generic
+from polymorphic.query import PolymorphicQuerySet
+from django.db.models import Count, Max, Min, OuterRef, Q, QuerySet, Subquery, Sum
+from django.db.models.functions import Coalesce
+from typing import Iterable, Iterator, Union, TypeVar, Generic
 import itertools as it
-from copy import deepcopy
+from copy import copy, deepcopy
 from django.conf import settings
 
 # import the logging library for debugging
@@ -38,26 +43,94 @@ class TypedQuerySet(Generic[T]):
         pass
 
 
+class BreakdownAllocation(NamedTuple):
+    """ Allocation of chargeable periods in a salary value breakdown (without holding the allocation model instance) """
+    id: int
+    rse: 'RSE'
+
+
 class SalaryValue():
     """
     Class to represent a salary calculation.
-    Has a salary aa dictionary for each to log how the salary/overhead was calculated (for each chargeable period)
+    Logs how the salary/overhead was calculated as a breakdown of chargeable periods. The breakdown is held as parallel
+    arrays (one entry per chargeable period) along with the id of any allocation for each period, so that values for many
+    allocations can be merged by extending lists.
     """
+    __slots__ = ('staff_cost', 'from_dates', 'until_dates', 'percentages', 'salary_bands', 'staff_costs', 'allocation_ids', 'allocation_rses', 'oncosts_multiplier')
+
+    BREAKDOWN_FIELDS = ('from_date', 'until_date', 'percentage', 'salary_band', 'staff_cost')
+
     def __init__(self):
         self.staff_cost = 0
-        self.cost_breakdown = []
-        self.allocation_breakdown = {}
+        self.from_dates = []  # type: List[date]
+        self.until_dates = []  # type: List[date]
+        self.percentages = []  # type: List[float]
+        self.salary_bands = []  # type: List[SalaryBand]
+        self.staff_costs = []  # type: List[Decimal]
+        self.allocation_ids = []  # type: List[Optional[int]]
+        self.allocation_rses = {}  # type: Dict[int, RSE]
         self.oncosts_multiplier = settings.ONCOSTS_SALARY_MULTIPLIER
 
+    def add_period(self, from_date: date, until_date: date, percentage: float, salary_band, staff_cost: Decimal, allocation_id: int = None):
+        """ Adds a chargeable period to the breakdown (without changing the total staff cost) """
+        self.from_dates.append(from_date)
+        self.until_dates.append(until_date)
+        self.percentages.append(percentage)
+        self.salary_bands.append(salary_band)
+        self.staff_costs.append(staff_cost)
+        self.allocation_ids.append(allocation_id)
+
     def add_staff_cost(self, salary_band, from_date: date, until_date: date, percentage: float = 100.0):
         cost_in_period = SalaryBand.salaryCost(days=(until_date - from_date).days, salary=salary_band.salary, percentage=percentage)
         self.staff_cost += cost_in_period
-        self.cost_breakdown.append({'from_date': from_date, 'until_date': until_date, 'percentage': percentage, 'salary_band': deepcopy(salary_band), 'staff_cost': cost_in_period})
+        self.add_period(from_date, until_date, percentage, salary_band, cost_in_period)
 
     def add_salary_value_with_allocation(self, allocation, salary_value):
-        self.staff_cost += salary_value.staff_cost
-        self.allocation_breakdown[allocation] = salary_value.cost_breakdown
-        self.cost_breakdown.extend(salary_value.cost_breakdown)
+        self.merge([salary_value], [allocation])
+
+    def merge(self, salary_values: Iterable[SalaryValue], allocations: Iterable = None):
+        """
+        Merges the staff costs and breakdowns of many salary values. If allocations are given (one for each salary value)
+        then the chargeable periods of each value are logged against the allocation.
+        """
+        if allocations is None:
+            allocations = it.repeat(None)
+        for salary_value, allocation in zip(salary_values, allocations):
+            self.staff_cost += salary_value.staff_cost
+            self.from_dates.extend(salary_value.from_dates)
+            self.until_dates.extend(salary_value.until_dates)
+            self.percentages.extend(salary_value.percentages)
+            self.salary_bands.extend(salary_value.salary_bands)
+            self.staff_costs.extend(salary_value.staff_costs)
+            if allocation is None:
+                self.allocation_ids.extend(salary_value.allocation_ids)
+                self.allocation_rses.update(salary_value.allocation_rses)
+            else:
+                self.allocation_ids.extend(it.repeat(allocation.id, len(salary_value.staff_costs)))
+                self.allocation_rses[allocation.id] = allocation.rse
+
+    def breakdown_arrays(self) -> Dict[str, list]:
+        """ Exports the breakdown as parallel arrays by field (with an array of allocation ids) e.g. for JSON """
+        return {'from_date': self.from_dates, 'until_date': self.until_dates, 'percentage': self.percentages,
+                'salary_band': self.salary_bands, 'staff_cost': self.staff_costs, 'allocation': self.allocation_ids}
+
+    def _breakdown(self, indices: Iterable[int]) -> List[Dict]:
+        fields = (self.from_dates, self.until_dates, self.percentages, self.salary_bands, self.staff_costs)
+        return [dict(zip(self.BREAKDOWN_FIELDS, (f[i] for f in fields))) for i in indices]
+
+    @property
+    def cost_breakdown(self) -> List[Dict]:
+        """ The breakdown as a dictionary for each chargeable period """
+        return self._breakdown(range(len(self.staff_costs)))
+
+    @property
+    def allocation_breakdown(self) -> Dict[BreakdownAllocation, List[Dict]]:
+        """ The breakdown of chargeable periods grouped by allocation (in the order allocations were added) """
+        indices = {allocation_id: [] for allocation_id in self.allocation_rses}
+        for i, allocation_id in enumerate(self.allocation_ids):
+            if allocation_id is not None:
+                indices[allocation_id].append(i)
+        return {BreakdownAllocation(allocation_id, self.allocation_rses[allocation_id]): self._breakdown(allocation_indices) for allocation_id, allocation_indices in indices.items()}
 
     @property
     def value(self) -> Decimal:
@@ -133,7 +206,28 @@ class SalaryBand(models.Model):
     def short_str(self) -> str:
         return f"{self.grade}.{self.grade_point} ({self.year})"
 
-    def salary_band_after_increment(self):
+    @property
+    def estimated(self) -> bool:
+        """ Salary bands are never estimated (estimated salaries for future years are represented by a `SalaryPoint`) """
+        return False
+
+    @property
+    def inflation_years(self) -> int:
+        """ Number of years of estimated inflation applied to the salary (always 0 for a salary band) """
+        return 0
+
+    @staticmethod
+    def lookup(grade: int, grade_point: int, year: int, salary_bands: Dict = None) -> Optional[SalaryBand]:
+        """
+        Finds a salary band by grade, grade point and financial year.
+        Salary bands are resolved from the salary band registry unless an index of salary bands by (grade, grade point, year) is provided.
+        """
+        if salary_bands is None:
+            from rse.costing import salary_band_registry
+            return salary_band_registry.get(grade, grade_point, year)
+        return salary_bands.get((grade, grade_point, year))
+
+    def salary_band_after_increment(self, salary_bands: Dict = None):
         """
         Provides the next salary band object after a single increment.
         Grades which increments will use the next available grade point.  Grades which do not increment (exceptional range) will return the same salary band.
@@ -142,21 +236,10 @@ class SalaryBand(models.Model):
         # check first to see if salary band can increment
         if self.increments:
             # Find next salary band with incremented year
-            g = self.grade
-            gp = self.grade_point + 1
-            y = self.year.year
-            sbs = SalaryBand.objects.filter(grade=g, grade_point=gp, year__year=y)  # order by year?
-
-            # Result of database query should be unique if next years data is available
-            if sbs:
-                sb = sbs[0]
-
-                # adjust object if current salary band is based off estimates (this can occur for salaries projecting into future)
-                if hasattr(self, 'estimated'):
-                    sb.estimated = True
-                    sb.inflation_years = self.inflation_years
-                    sb.salary = round(Decimal(float(sb.salary) * (1.03**sb.inflation_years)), 2)  # compound interest
+            sb = SalaryBand.lookup(self.grade, self.grade_point + 1, self.year_id, salary_bands)
 
+            # Result should be unique if next years data is available
+            if sb:
                 return sb
             raise ObjectDoesNotExist('Incomplete salary data in database. Could not find a valid increment for current salary band.')
 
@@ -164,33 +247,22 @@ class SalaryBand(models.Model):
         else:
             return self
 
-    def salary_band_next_financial_year(self):
+    def salary_band_next_financial_year(self, salary_bands: Dict = None):
         """
         Provides the salary band for the next financial year
         Normal behaviour is to use the next years financial data. If there is no next year financial data then the current years financial data is used.
         Grade point should not change as this represents just the salary change in August which is the inflation adjustment.
         """
-        # Query database to find a salary band for next years financial data
-        g = self.grade
-        gp = self.grade_point
-        y = self.year.year + 1
-        sbs = SalaryBand.objects.filter(grade=g, grade_point=gp, year__year=y)
+        # Find a salary band for next years financial data
+        sb = SalaryBand.lookup(self.grade, self.grade_point, self.year_id + 1, salary_bands)
 
         # Should be unique if next years data is available
-        if sbs:
-            return sbs[0]
+        if sb:
+            return sb
         # There is no more salary band data (probably not released yet)
         else:
-            # Return current salary band
-            # Assume 3% inflation (modify salary but DO NOT SAVE)
-            self.salary = round(Decimal(float(self.salary) * 1.03), 2)
-            self.estimated = True
-            # track years fo compound inflation
-            if hasattr(self, 'inflation_years'):
-                self.inflation_years += 1
-            else:
-                self.inflation_years = 1
-            return self
+            # Return an estimate from the current salary band assuming 3% inflation
+            return SalaryPoint(self, round(Decimal(float(self.salary) * 1.03), 2), 1)
 
     @staticmethod
     def spans_financial_year(start: date, end: date) -> bool:
@@ -274,7 +346,6 @@ class SalaryBand(models.Model):
             # Update salary cost
             salary_value.add_staff_cost(salary_band=next_sb, from_date=next_increment, until_date=temp_next_increment, percentage=percentage)
             # Calculate the next salary band
-            # This cant be done before cost calculation salary_band_next_financial_year may modify the next_sb object
             if next_increment.month < 8:  # If date is before financial year then date range spans financial year
                 next_sb = next_sb.salary_band_next_financial_year()
             else:  # Doesn't span financial year so must span calendar year
@@ -322,6 +393,48 @@ class Client(models.Model):
         ordering = ["name"]
 
 
+class RSEQuerySet(models.QuerySet):
+    """
+    Query set for RSEs. RSEs from the default manager are annotated with the date that their employment starts (`employed_from`)
+    so that the employment of many RSEs can be checked or filtered without a query for each RSE.
+    """
+
+    def current_employment(self, in_employment: bool = True) -> RSEQuerySet:
+        """ Queryset equivalent of `RSE.current_employment`. If `in_employment` is False then RSEs not currently employed are returned. """
+        now = timezone.now().date()
+        if in_employment:
+            return self.filter(employed_from__lt=now, employed_until__gt=now)
+        # RSEs without salary data are not in employment
+        return self.filter(Q(employed_from__isnull=True) | Q(employed_from__gte=now) | Q(employed_until__lte=now))
+
+    def employed_in_period(self, from_date: date, until_date: date) -> RSEQuerySet:
+        """ Queryset equivalent of `RSE.employed_in_period` """
+        return self.filter(employed_from__lt=until_date, employed_until__gt=from_date)
+
+    def employed_in_financial_year(self, year: int) -> RSEQuerySet:
+        """ Queryset equivalent of `RSE.employed_in_financial_year` (i.e. employment starts in the financial year) """
+        return self.filter(employed_from__gte=date(year, 8, 1), employed_from__lt=date(year + 1, 8, 1))
+
+    def with_capacity(self, at: date = None) -> RSEQuerySet:
+        """
+        Annotates RSEs with their capacity at a date (`capacity`) as a percentage of FTE from funded projects
+        (see `RSE.current_capacity`). Defaults to the capacity today.
+        """
+        if at is None:
+            at = timezone.now().date()
+        allocated = RSEAllocation.objects.filter(rse=OuterRef('pk'), start__lte=at, end__gt=at, project__status='F').order_by().values('rse').annotate(total=Sum('percentage')).values('total')
+        return self.annotate(capacity=Coalesce(Subquery(allocated), 0, output_field=models.FloatField()))
+
+
+class RSEManager(models.Manager.from_queryset(RSEQuerySet)):
+    """
+    Manager for RSEs which annotates the first salary grade change date as `employed_from`
+    """
+
+    def get_queryset(self) -> RSEQuerySet:
+        return super().get_queryset().annotate(employed_from=Min('salarygradechange__date'))
+
+
 class RSE(models.Model):
     """
     RSE represents a RSE staff member within the RSE team
@@ -329,14 +442,24 @@ class RSE(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     employed_until = models.DateField()
 
+    objects = RSEManager()
+
     @property 
     def employed_from(self):
+        """ Date of the first salary grade change. Uses the annotated value if loaded from `RSE.objects`. """
+        if '_employed_from' in self.__dict__:
+            return self._employed_from
         sgcs = SalaryGradeChange.objects.filter(rse=self).order_by('date')
         if len(sgcs) > 0:
             return sgcs[0].date
         else:
            return None
 
+    @employed_from.setter
+    def employed_from(self, value: Optional[date]):
+        # set by query set annotation
+        self._employed_from = value
+
     @property
     def current_employment(self):
         """
@@ -418,137 +541,143 @@ class RSE(models.Model):
         else:
             return False
 
+    @cached_property
+    def salary_timeline(self):
+        """
+        Salary timeline for the RSE built on first use and held for the lifetime of this object.
+        Delete the attribute to rebuild the timeline if salary data changes.
+        """
+        from rse.costing import SalaryTimeline
+        return SalaryTimeline(self)
+
     def staff_cost(self, from_date: date, until_date: date, percentage: float = 100):
         """
         Calculates the staff cost  between a given period. This function must consider any increments, changes in financial
-        year as well as any additional salary grade changes. It works by iterating through chargeable periods looking for 
-        changes in staff salary. 
+        year as well as any additional salary grade changes. It works by iterating through chargeable periods looking for
+        changes in staff salary.
 
         This is different to a salary bad staff cost as it also considers salary grade changes which may be the result of
         promotion or exceptional increments.
+
+        Costs are calculated by the RSEs salary timeline (see `rse.costing.SalaryTimeline`) which loads all salary data once
+        so that repeated calls on the same RSE object do not query the database.
         """
+        return self.salary_timeline.staff_cost(from_date, until_date, percentage)
 
-        # catch early case where there are no salary grade changes
-        if not self.employed_from:
-            return SalaryValue()
+    def days_from_budget(self, start: date, budget: Decimal, percent: float) -> int:
+        """
+        Get the number of days which this RSE can be charged given a budget and FTE
 
-        # Restrict from and until dates based off employment start and end
-        if self.employed_from > from_date:
-            from_date = self.employed_from
-        if self.employed_until < until_date:
-            until_date = self.employed_until
+        Salary periods are held as a cumulative cost curve (see `rse.costing.BudgetCurve`) using the salary band at each
+        increment, financial year change and salary grade change (as `futureSalaryBand`), so the days are found by a binary
+        search. Costs include on costs in the same way as `staff_cost` so that a budget calculated from staff costs can be
+        converted to days.
+        """
 
-        # Get the last salary grade charge for the RSE at the start of the cost query
-        sgc = self.lastSalaryGradeChange(from_date)
+        return self.salary_timeline.budget_curve(start).days(budget, percent)
 
-        # Get the salary band at the start date of the cost query (will skip increments if required)
-        sb = sgc.salary_band_at_future_date(from_date)
+    @property
+    def colour_rbg(self) -> Dict[str, int]:
+        r = hash(self.user.first_name) % 255
+        g = hash(self.user.last_name) % 255
+        b = hash(self.user.first_name + self.user.last_name) % 255
+        return {"r": r, "g": g, "b": b}
 
-        # Now calculate the staff costs through iteration of chargeable periods (applying any increments)
-        # Note salary band data may be estimated in future years so the date of increment must be tracked rather than just the salary band
-        next_increment = from_date
-        next_sb = sb
-        salary_value = SalaryValue()
 
-        # Salary can change due to increment or a salary grade change
-        while SalaryBand.spans_salary_change(next_increment, until_date) or sgc.spans_salary_grade_change(next_increment, until_date):
+class SalaryPoint():
+    """
+    Immutable salary point estimated from a salary band.
+    Where there is no salary band data for a future financial year the salary is estimated from the last available salary band
+    assuming 3% inflation for each year (compounded). Salary points are never modified after creation so (unlike salary band
+    model instances) they can be safely shared between cost calculations.
+    Provides the same interface as a salary band for increments, financial years and display.
+    """
+    __slots__ = ('salary_band', 'salary', 'inflation_years')
 
-            # Need to know if grade change occurs before increment
-            temp_sgc = sgc.next_salary_grade_change(next_increment, until_date)
-            # if there is another salary grade change and this occurs before any increment
-            if temp_sgc and not SalaryBand.spans_salary_change(next_increment, temp_sgc.date):
-                temp_next_increment = temp_sgc.date
-                # calculate cost up to sgc
-                salary_value.add_staff_cost(salary_band=next_sb, from_date=next_increment, until_date=temp_next_increment, percentage=percentage)
-                # set the salary band and update the current salary grade change
-                next_sb = temp_sgc.salary_band
-                sgc = temp_sgc
+    def __init__(self, salary_band: SalaryBand, salary: Decimal, inflation_years: int):
+        object.__setattr__(self, 'salary_band', salary_band)
+        object.__setattr__(self, 'salary', salary)
+        object.__setattr__(self, 'inflation_years', inflation_years)
 
-            # Calculate next increment date
-            elif next_increment.month < 8:   # If date is before financial year then date range spans financial year  
-                temp_next_increment = date(next_increment.year, 8, 1)  # calculate next increment date and salary band
-                # Update salary cost
-                salary_value.add_staff_cost(salary_band=next_sb, from_date=next_increment, until_date=temp_next_increment, percentage=percentage)
-                # Calculate the next salary band - this cant be done before cost calculation salary_band_next_financial_year may modify the next_sb object
-                next_sb = next_sb.salary_band_next_financial_year()
+    def __setattr__(self, name, value):
+        raise AttributeError('Salary points are immutable')
 
-            else: # Doesn't span financial year so must span calendar year
-                temp_next_increment = date(next_increment.year + 1, 1, 1)
-                # Update salary cost
-                salary_value.add_staff_cost(salary_band=next_sb, from_date=next_increment, until_date=temp_next_increment, percentage=percentage)
-                # only update the salary band if eliable for increment
-                if sgc.eliagable_for_increment(temp_next_increment):
-                    # Calculate the next salary band - this cant be done before cost calculation salary_band_next_financial_year may modify the next_sb object
-                    next_sb = next_sb.salary_band_after_increment()
-                
+    def __delattr__(self, name):
+        raise AttributeError('Salary points are immutable')
 
-            # update chargeable period date and band
-            next_increment = temp_next_increment
+    def __copy__(self) -> SalaryPoint:
+        return self
 
-        # Final salary cost for period not spanning a salary change
-        salary_value.add_staff_cost(salary_band=next_sb, from_date=next_increment, until_date=until_date, percentage=percentage)
+    def __deepcopy__(self, memo) -> SalaryPoint:
+        return self
 
-        return salary_value
+    def __reduce__(self):
+        return (SalaryPoint, (self.salary_band, self.salary, self.inflation_years))
 
-    def days_from_budget(self, start: date, budget: Decimal, percent: float) -> int:
-        """
-        Get the number of days which this RSE can be charged given a budget and FTE
-        """
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SalaryPoint):
+            return NotImplemented
+        return (self.salary_band.pk, self.salary, self.inflation_years) == (other.salary_band.pk, other.salary, other.inflation_years)
 
-        # Get the last salary grade charge for the RSE at the start of the cost query
-        sgc = self.lastSalaryGradeChange(start)
-        # Get the salary band at the start date of the cost query (will skip increments if required)
-        sb = sgc.salary_band_at_future_date(start)
+    def __hash__(self) -> int:
+        return hash((self.salary_band.pk, self.salary, self.inflation_years))
 
-        total_days = 0
-        temp_budget = budget
-        temp_start = start
-        temp_salary_band = sb
+    def __str__(self) -> str:
+        return f"{self.grade}.{self.grade_point} ({self.year}): £{self.salary}"
 
-        # Loop through salary periods to calculate how many days the budget can afford
-        # Apply increments, financial year changes and salary grade changes
-        while temp_budget > 0:
-            # calculate date of next possible salary change (either by financial or calendar  year)
-            if temp_start.month < 8:
-                span_end = date(temp_start.year, 8, 1)
-                next_sb = temp_salary_band.salary_band_next_financial_year()
-            else:
-                span_end = date(temp_start.year + 1, 1, 1)
-                next_sb = temp_salary_band.salary_band_after_increment()
-
-            # if salary grade change before the next increment/FY change
-            temp_sgc = sgc.next_salary_grade_change(temp_start, span_end)
-            if temp_sgc:
-                span_end = temp_sgc.date
-                next_sb = temp_sgc.salary_band
-                sgc = temp_sgc
-
-            # daily salary rate in span
-            span_dr = Decimal(temp_salary_band.salary) / 365.0
-            span_days = (span_end - temp_start).days
-            span_spend = span_dr * span_days * (percent / 100.0)
-
-            # can budget be spent within this period
-            if span_spend >= temp_budget:
-                # calculate exactly how many days can be afforded within this period and end loop
-                total_days += int(temp_budget / (span_dr * (percent / 100.0)))
-                temp_budget = 0     # end loop
-                break
-            else:
-                # accumulate days and deduct cost for this period and move to next
-                total_days += span_days
-                temp_budget -= span_spend
-                temp_start = span_end
-                temp_salary_band = next_sb
+    def __repr__(self) -> str:
+        return f"<SalaryPoint: {self} (estimated {self.inflation_years} years)>"
 
-        return total_days
+    @property
+    def estimated(self) -> bool:
+        return True
 
     @property
-    def colour_rbg(self) -> Dict[str, int]:
-        r = hash(self.user.first_name) % 255
-        g = hash(self.user.last_name) % 255
-        b = hash(self.user.first_name + self.user.last_name) % 255
-        return {"r": r, "g": g, "b": b}
+    def grade(self) -> int:
+        return self.salary_band.grade
+
+    @property
+    def grade_point(self) -> int:
+        return self.salary_band.grade_point
+
+    @property
+    def year(self) -> FinancialYear:
+        """ Financial year of the salary band used for the estimate (i.e. the last year with salary data) """
+        return self.salary_band.year
+
+    @property
+    def year_id(self) -> int:
+        return self.salary_band.year_id
+
+    @property
+    def increments(self) -> bool:
+        return self.salary_band.increments
+
+    @property
+    def short_str(self) -> str:
+        return self.salary_band.short_str
+
+    def salary_band_after_increment(self, salary_bands: Dict = None):
+        """
+        Provides the salary point after a single increment.
+        The incremented salary band is estimated using the same number of years of inflation.
+        """
+        if not self.increments:
+            return self
+        sb = SalaryBand.lookup(self.grade, self.grade_point + 1, self.year_id, salary_bands)
+        if sb:
+            return SalaryPoint(sb, round(Decimal(float(sb.salary) * (1.03**self.inflation_years)), 2), self.inflation_years)  # compound interest
+        raise ObjectDoesNotExist('Incomplete salary data in database. Could not find a valid increment for current salary band.')
+
+    def salary_band_next_financial_year(self, salary_bands: Dict = None):
+        """
+        Provides the salary point for the next financial year.
+        Uses next years financial data if it is available otherwise a further year of inflation is applied to the estimate.
+        """
+        sb = SalaryBand.lookup(self.grade, self.grade_point, self.year_id + 1, salary_bands)
+        if sb:
+            return sb
+        return SalaryPoint(self.salary_band, round(Decimal(float(self.salary) * 1.03), 2), self.inflation_years + 1)
 
 
 class SalaryGradeChange(models.Model):
@@ -604,31 +733,13 @@ class SalaryGradeChange(models.Model):
             # there is a more recent salary grade change so use it
             return sgc.salary_band_at_future_date(future_date)
 
-        # Get the salary band and start date of the salary grade change
-        # Note salary band data may be estimated in future years so the date of increment must be tracked
-        next_increment = sgc.date  #  date of the salary grade change
-        next_sb = sgc.salary_band
-        # First increment should be skipped if this salary grade change is the first and represents employment in last six months of the year
+        # Get the salary band from the chain of increments following the salary grade change
+        # Chains are cached so that only increments beyond the last resolved boundary need to be calculated
+        # First increment is skipped if this salary grade change is the first and represents employment in last six months of the year (see `rse.costing.skips_first_increment`)
         # Note: August adjustment is not skipped if employed in June
-        skip_increment = False
-        if sgc.is_starting_salary() and sgc.date.month >=7:
-            skip_increment = True
-
-        # If the salary can change between the date range then advance increment or year
-        while (SalaryBand.spans_salary_change(next_increment, future_date)):
-            # If date is before financial year then date range spans financial year
-            if next_increment.month < 8:
-                next_increment = date(next_increment.year, 8, 1)
-                next_sb = next_sb.salary_band_next_financial_year()
-            # Doesn't span financial year so must span calendar year
-            else:
-                next_increment = date(next_increment.year + 1, 1, 1)
-                if skip_increment:
-                    skip_increment = False 
-                else:
-                    next_sb = next_sb.salary_band_after_increment()
-
-        return next_sb
+        # Cached salary bands are shared so a copy is returned (which the caller may modify)
+        from rse.costing import salary_chain_cache
+        return copy(salary_chain_cache.chain(sgc, future_date).salary_band_at(future_date))
 
     def spans_salary_grade_change(self, start: date, end: date) -> bool:
         """
@@ -661,6 +772,30 @@ class SalaryGradeChange(models.Model):
                 f"({self.salary_band.year})")
 
 
+class ProjectQuerySet(PolymorphicQuerySet):
+    """
+    Query set for (polymorphic) projects
+    """
+
+    def dashboard_counts(self, now: date, soon: date) -> Dict[str, int]:
+        """
+        Counts of projects shown on the home pages (highlights, warnings and dangers) computed with a single aggregate query.
+        Service project fields are reached through the multi table inheritance join so that every count is a conditional
+        count over projects.
+        """
+        not_funded = Q(status=Project.PREPARATION) | Q(status=Project.REVIEW)
+        not_invoiced = Q(serviceproject__isnull=False, internal=False, serviceproject__invoice_received=None)
+        return self.non_polymorphic().aggregate(
+            active_funded_projects=Count('pk', filter=Q(start__lte=now, end__gt=now, status=Project.FUNDED)),
+            review_projects=Count('pk', filter=Q(status=Project.REVIEW)),
+            outstanding_invoices=Count('pk', filter=not_invoiced),
+            warning_starting_not_funded=Count('pk', filter=not_funded & Q(start__gt=now, start__lte=soon)),
+            warning_service_started_not_invoiced=Count('pk', filter=not_invoiced & Q(start__lte=now, end__gt=now)),
+            danger_started_not_funded=Count('pk', filter=not_funded & Q(start__lte=now, end__gte=now)),
+            danger_service_ended_not_invoiced=Count('pk', filter=not_invoiced & Q(status=Project.FUNDED, end__lt=now)),
+        )
+
+
 class Project(PolymorphicModel):
     """
     Project represents a project undertaken by RSE team.
@@ -697,6 +832,14 @@ class Project(PolymorphicModel):
     )
     status = models.CharField(max_length=1, choices=STATUS_CHOICES)
 
+    objects = PolymorphicManager.from_queryset(ProjectQuerySet)()
+
+    class Meta(PolymorphicModel.Meta):
+        """ Projects are filtered by status and active date range """
+        indexes = [
+            models.Index(fields=['status', 'start', 'end'], name='rse_project_status_dates_idx'),
+        ]
+
     SCHEDULE_ACTIVE = "Active"
     SCHEDULE_COMPLETED = "Completed"
     SCHEDULE_SCHEDULED = "Scheduled"
@@ -730,18 +873,26 @@ class Project(PolymorphicModel):
     
     def scheduled_working_days_to_today(self, rse = None) -> float:
         """ Returns the total working days of the project upto today """
+        return Project.scheduled_working_days_to_today_for([self], rse=rse)[self.id]
+
+    @staticmethod
+    def scheduled_working_days_to_today_for(projects: Iterable[Project], rse: RSE = None) -> Dict[int, float]:
+        """
+        Returns the total working days of many projects upto today by project id (see `scheduled_working_days_to_today`).
+        Allocations of all projects are loaded with a single query.
+        """
         now = timezone.now().date()
-        allocated_days_sum = 0
+        starts = {p.id: p.start for p in projects}
+        allocated_days_sums = dict.fromkeys(starts, 0)
         # get allocations (all or by RSE if specified)
-        if not rse:
-            active = RSEAllocation.objects.filter(project=self, start__lte=now)
-        else:
-            active = RSEAllocation.objects.filter(project=self, rse=rse, start__lte=now)
-        for a in active:
-            # allocated day need to be converted into equivalent working days
-            allocated_days_sum += a.working_days(self.start, now)
-        
-        return allocated_days_sum
+        active = RSEAllocation.objects.filter(project__in=list(starts), start__lte=now)
+        if rse:
+            active = active.filter(rse=rse)
+        for project_id, start, end, percentage in active.values_list('project', 'start', 'end', 'percentage'):
+            # allocated day need to be converted into equivalent working days (allocations limited to project start and today, see `RSEAllocation.working_days`)
+            allocated_days_sums[project_id] += Project.fte_days_to_working_days((min(end, now) - max(start, starts[project_id])).days) * percentage / 100.0
+
+        return allocated_days_sums
 
     def value(self) -> Optional[int]:
         """ Implemented by concrete classes."""
@@ -873,9 +1024,9 @@ class Project(PolymorphicModel):
 
         # Filter allocations by start and end date
         if rse:
-            allocations = RSEAllocation.objects.filter(project=self, end__gt=from_date, start__lt=until_date, rse=rse)
+            allocations = RSEAllocation.objects.filter(project=self, end__gt=from_date, start__lt=until_date, rse=rse).order_by('id')
         else:
-            allocations = RSEAllocation.objects.filter(project=self, end__gt=from_date, start__lt=until_date)
+            allocations = RSEAllocation.objects.filter(project=self, end__gt=from_date, start__lt=until_date).order_by('id')
 
         # Iterate allocations and calculate staff costs
         salary_cost = SalaryValue()
@@ -889,6 +1040,29 @@ class Project(PolymorphicModel):
 
         return salary_cost
 
+    @staticmethod
+    def staff_costs_for(projects: Iterable[Project], from_date: date = None, until_date: date = None, rse: RSE = None, consider_internal: bool = False) -> Dict[int, Optional[SalaryValue]]:
+        """
+        Returns the staff costs of many projects by project id (see `staff_cost`).
+        Allocations, RSEs and salary data for all projects are loaded with a fixed number of queries (see
+        `rse.costing.StaffCosts`). A project has a value of None if its allocations are missing salary data.
+        """
+        from rse.costing import StaffCosts
+        projects = list(projects)
+        rses = RSE.objects.filter(rseallocation__project__in=projects).distinct().select_related('user')
+        if rse:
+            rses = rses.filter(id=rse.id)
+        costs = StaffCosts(rses)
+        project_allocations = costs.project_allocations(projects)
+
+        project_costs = {}  # type: Dict[int, Optional[SalaryValue]]
+        for p in projects:
+            try:
+                project_costs[p.id] = costs.project_salary_value(p, project_allocations[p.id], from_date, until_date, consider_internal)
+            except ValueError:
+                project_costs[p.id] = None
+        return project_costs
+
     @property
     def colour_rbg(self) -> Dict[str, int]:
         r = hash(self.name) % 255
@@ -1113,6 +1287,27 @@ class RSEAllocation(models.Model):
 
     objects = RSEAllocationManager()
 
+    class Meta:
+        """
+        Live (not deleted) allocations are filtered by RSE or project and a date range (or only a date range for reports).
+        Partial indexes are skipped on MySQL so plain indexes on the same fields are created there instead (see migration
+        0015_allocation_fallback_indexes).
+        """
+        indexes = [
+            models.Index(fields=['rse', 'start', 'end'], name='rse_allocation_live_rse_idx', condition=Q(deleted_date__isnull=True)),
+            models.Index(fields=['project', 'start', 'end'], name='rse_allocation_live_proj_idx', condition=Q(deleted_date__isnull=True)),
+            models.Index(fields=['start', 'end'], name='rse_allocation_live_dates_idx', condition=Q(deleted_date__isnull=True)),
+        ]
+
+    @staticmethod
+    def changes_since(since: date) -> List[Union[RSEAllocation, RSEAllocationHistory]]:
+        """
+        Returns allocations created or deleted since a date (or date and time) including deleted allocations which have been
+        archived (see `RSEAllocationHistory`)
+        """
+        q = Q(created_date__gte=since) | Q(deleted_date__gte=since)
+        return list(RSEAllocation.objects.all(deleted=True).filter(q)) + list(RSEAllocationHistory.objects.filter(q))
+
     def __str__(self) -> str:
         return f"{self.rse} on {self.project} at {self.percentage}%"
 
@@ -1204,7 +1399,12 @@ class RSEAllocation(models.Model):
             return timezone.now().date()
 
     @staticmethod
-    def commitment_summary(allocations: 'RSEAllocation', from_date: date = None, until_date: date = None):
+    def commitment_summary(allocations: 'RSEAllocation', from_date: date = None, until_date: date = None) -> CommitmentSummary:
+        """
+        Returns a commitment summary of (date, effort, [RSEAllocation]) for each unique start or end date of the allocations
+        (restricted to the from and until dates). Active allocations are stored as changes at each date and only
+        reconstructed as the summary is iterated (see `CommitmentSummary`).
+        """
 
         # Helpful lambda function for max where a value may be None
         # lambda function returns a if b is None or f(a,b) if b is not none
@@ -1217,43 +1417,51 @@ class RSEAllocation(models.Model):
         # Combine start and end dates and sort
         events = sorted(starts + ends, key=lambda x: x[0])
 
-        # lists of unique
-        unique_cumulative_allocations = []
-        unique_dates = []
-        unique_effort = []
+        # unique dates with cumulative effort and the allocations added and removed at each date
+        dates = []
+        effort = []
+        added = []
+        removed = []
 
-        # temporary cumulative variables
-        active_allocations = []
-        effort = 0
+        # temporary cumulative variable
+        total_effort = 0
 
         # use itertools groupby to process by unique day
-        for k, g in it.groupby(events, lambda x: x[0]):
+        for d, g in it.groupby(events, lambda x: x[0]):
+            date_added = []
+            date_removed = []
 
-            # iterate dates (d), percentages (p), effort (e), and allocations (a) and accumulate allocations
-            for d, p, a in g:  # k will be the same a d
+            # iterate dates, percentages (p) and allocations (a) and accumulate effort
+            for _, p, a in g:
                 # add or remove allocation depending on percentage
                 if p > 0:
-                    active_allocations.append(a)
+                    date_added.append(a)
                 if p < 0:
-                    active_allocations.remove(a)
+                    date_removed.append(a)
 
                 # accumulate effort
-                effort += p
+                total_effort += p
 
-            # add date to unique
-            unique_dates.append(d)
-            unique_effort.append(effort)
-            # add list of allocations to to unique cumulative allocations (make a copy)
-            unique_cumulative_allocations.append(list(active_allocations))
+            dates.append(d)
+            effort.append(total_effort)
+            added.append(date_added)
+            removed.append(date_removed)
 
-        # Return list of unique (date, effort, [RSEAllocation])
-        return list(zip(unique_dates, unique_effort, unique_cumulative_allocations))
+        return CommitmentSummary(dates, effort, added, removed)
 
     @staticmethod
     def stacked_commitment_summary(allocations: 'RSEAllocation' | list,
                                    from_date: date = None,
                                    until_date: date = None,
                                    percent_scaling = 1.0):
+        """
+        Returns a step series of commitment points ({"x": date, "y": percentage}) for each allocation for a stacked
+        commitment graph. Every series has a point at each start or end date of any allocation within its duration so
+        that series can be stacked.
+        Allocations may be RSEAllocation objects or raw (key, start, end, percentage) tuples (e.g. from `values_list`)
+        with series keyed by allocation or by the first tuple value. A list of querysets or lists is combined.
+        Series are built in a single sweep over sorted start and end dates.
+        """
         default_delta = timedelta(days=30*6)
         if from_date is None:
             from_date = date.today() - default_delta
@@ -1262,43 +1470,209 @@ class RSEAllocation(models.Model):
             until_date = date.today() + default_delta
 
         if not isinstance(allocations, QuerySet):
-            # If it's a list item instead of a query object
-            # means multiple allocations have been passed
-            all_allocations = []
-            for allocation in allocations:
-                for item in allocation:
-                    all_allocations.append(item)
-            allocations = all_allocations
-
+            # If it's a list item instead of a query object it may be a list of allocations or
+            # a list of querysets or lists of allocations (which are combined)
+            allocations = [item for allocation in allocations for item in (allocation if isinstance(allocation, (QuerySet, list)) else [allocation])]
+
+        # (key, start, end, percentage) of each allocation
+        items = [item if isinstance(item, tuple) else (item, item.start, item.end, item.percentage) for item in allocations]
+
+        # allocation indices by start and end date
+        starts = {}  # type: Dict[date, List[int]]
+        ends = {}  # type: Dict[date, List[int]]
+        for i, (_, start, end, _) in enumerate(items):
+            starts.setdefault(start, []).append(i)
+            ends.setdefault(end, []).append(i)
+        all_dates = sorted(starts.keys() | ends.keys() | {from_date, until_date, date.today()})
+
+        series = [[] for _ in items]
+        active = {}  # type: Dict[int, float] (ordered by start)
+        for d in all_dates:
+            for i in ends.get(d, []):
+                if i in active:
+                    del active[i]
+                elif items[i][1] == d:
+                    # allocations with no duration are ended with their start
+                    continue
+                elif items[i][1] >= from_date:
+                    # allocations ending before they start only have a start and an end point
+                    series[i].append({"x": items[i][1], "y": items[i][3] * percent_scaling})
+                if d <= until_date:
+                    # Don't add if after until_date
+                    series[i].append({"x": d, "y": 0})
+            # allocations within their duration at the date (but not starting or ending)
+            if from_date <= d <= until_date:
+                for i, y in active.items():
+                    series[i].append({"x": d, "y": y})
+            for i in starts.get(d, []):
+                if items[i][2] < d:
+                    continue
+                if d >= from_date:
+                    # Don't add if before from_date
+                    series[i].append({"x": d, "y": items[i][3] * percent_scaling})
+                if items[i][2] > d:
+                    active[i] = items[i][3] * percent_scaling
+                elif d <= until_date:
+                    series[i].append({"x": d, "y": 0})
+
+        return {item[0]: item_alloc for item, item_alloc in zip(items, series)}
 
-        # Get all dates
-        all_dates = {from_date, until_date, date.today()}
-        for item in allocations:
-            all_dates.add(item.start)
-            all_dates.add(item.end)
+    @staticmethod
+    def commitment_matrix(allocations: Iterable[Tuple[object, date, date, float]], from_date: date, until_date: date) -> Tuple[List[date], Dict[object, List[float]]]:
+        """
+        Returns the start date of each week (from the Monday of the from date until the until date) and the average committed
+        FTE percentage in each week for each key of raw (key, start, end, percentage) allocation tuples (e.g. RSE ids from
+        `values_list`). Partial weeks at the start and end are averaged over their days within the date range. Allocations
+        are accumulated in a daily difference array for each key so that the cost is linear in the number of allocations
+        and days.
+        """
+        first_day = from_date - timedelta(days=from_date.weekday())
+        weeks = max(math.ceil((until_date - first_day).days / 7), 0)
+        days = weeks * 7
+
+        # days of each week within the date range
+        from_day = (from_date - first_day).days
+        until_day = (until_date - first_day).days
+        week_days = [(max(week, from_day), min(week + 7, until_day)) for week in range(0, days, 7)]
+
+        # difference arrays (percentage added at start and removed at end)
+        differences = {}  # type: Dict[object, List[float]]
+        for key, start, end, percentage in allocations:
+            difference = differences.setdefault(key, [0.0] * (days + 1))
+            start_day = max((start - first_day).days, 0)
+            end_day = min((end - first_day).days, days)
+            if start_day < end_day:
+                difference[start_day] += percentage
+                difference[end_day] -= percentage
+
+        matrix = {}
+        for key, difference in differences.items():
+            daily = list(it.accumulate(difference[:days]))
+            matrix[key] = [round(sum(daily[start:end]) / (end - start), 2) if end > start else 0 for start, end in week_days]
+
+        return [first_day + timedelta(days=week * 7) for week in range(weeks)], matrix
 
-        # Convert to list and sort earliest first
-        all_dates = list(all_dates)
-        all_dates.sort()
+    @staticmethod
+    def monthly_fte(allocations: Iterable[Tuple[object, date, date, float]], from_date: date, until_date: date) -> Tuple[List[date], Iterator[Tuple[object, List[float]]]]:
+        """
+        Returns the first day of each month (from the month of the from date until the until date inclusive) and a generator
+        of the FTE in each month for each key of raw (key, start, end, percentage) allocation tuples. FTE is the allocated
+        percentage (as a fraction) averaged over the days of each month within the date range and is found from the overlap
+        of each allocation with each month. Allocations must be ordered by key so that only the allocations of a single key
+        are held at a time (e.g. when streaming from `values_list(...).iterator()`).
+        """
+        months = []
+        month = date(from_date.year, from_date.month, 1)
+        while month <= until_date:
+            months.append(month)
+            month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        # month boundaries limited to the date range
+        bounds = [from_date] + months[1:] + [until_date + timedelta(days=1)]
+
+        def rows() -> Iterator[Tuple[object, List[float]]]:
+            for key, key_allocations in it.groupby(allocations, key=lambda a: a[0]):
+                percentage_days = [0.0] * len(months)
+                for _, start, end, percentage in key_allocations:
+                    # months from the month containing the allocation start until the allocation end
+                    for i in range(max(bisect_right(bounds, start) - 1, 0), len(months)):
+                        if bounds[i] >= end:
+                            break
+                        overlap = (min(end, bounds[i + 1]) - max(start, bounds[i])).days
+                        if overlap > 0:
+                            percentage_days[i] += percentage * overlap
+                yield key, [round(p / 100.0 / (bounds[i + 1] - bounds[i]).days, 3) for i, p in enumerate(percentage_days)]
+
+        return months, rows()
+
+
+class CommitmentSummary():
+    """
+    Commitment summary of an RSE (see `RSEAllocation.commitment_summary`).
+    Active allocations are delta encoded as the allocations added and removed at each date rather than a full copy of
+    the active allocations for every date. Iterating the summary gives (date, effort, [RSEAllocation]) for each date with
+    active allocations reconstructed from a keyed active set.
+    """
 
-        out_allocs = {}
-        for item in allocations:
-            item_alloc = []
-            if item.start >= from_date:
-                # Don't add if before from_date
-                item_alloc.append({"x": item.start, "y": item.percentage * percent_scaling})
-            for alloc_date in all_dates:
-                if item.start < alloc_date < item.end and from_date <= alloc_date <= until_date:
-                    # Add allocation percentage for all dates between start and end
-                    item_alloc.append({"x": alloc_date, "y": item.percentage * percent_scaling})
-            if item.end <= until_date:
-                # Don't add if after until_date
-                item_alloc.append({"x": item.end, "y": 0})
-            out_allocs[item] = item_alloc
+    def __init__(self, dates: List[date], effort: List[float], added: List[List[RSEAllocation]], removed: List[List[RSEAllocation]]):
+        self.dates = dates
+        self.effort = effort
+        self.added = added
+        self.removed = removed
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def active(self) -> Iterator[Dict[RSEAllocation, RSEAllocation]]:
+        """ Yields the active allocations (keyed by allocation) at each date. The same set is updated between dates. """
+        active = {}
+        for date_added, date_removed in zip(self.added, self.removed):
+            for a in date_added:
+                active[a] = a
+            for a in date_removed:
+                active.pop(a, None)
+            yield active
+
+    def __iter__(self) -> Iterator[Tuple[date, float, List[RSEAllocation]]]:
+        for d, effort, active in zip(self.dates, self.effort, self.active()):
+            yield d, effort, list(active)
+
+    def project_percentages(self, projects: Iterable[Project]) -> Iterator[Tuple[date, float, List[float]]]:
+        """ Yields (date, effort, [percentage]) with the sum of active allocation percentages of each project at each date """
+        project_ids = [p.id for p in projects]
+        for d, effort, active in zip(self.dates, self.effort, self.active()):
+            percentages = dict.fromkeys(project_ids, 0)
+            for a in active:
+                if a.project_id in percentages:
+                    percentages[a.project_id] += a.percentage
+            yield d, effort, list(percentages.values())
+
+
+class RSEAllocationHistory(models.Model):
+    """
+    Archived deleted allocation.
+    Allocations are never deleted (edits flag the allocation as deleted and create a new one) so old deleted allocations are
+    moved from `RSEAllocation` to this table by the `archive_allocations` management command to keep the allocation table
+    small. Ids are those of the original allocations.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    rse = models.ForeignKey(RSE, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    percentage = models.FloatField()
+    start = models.DateField()
+    end = models.DateField()
 
-        return out_allocs
+    created_date = models.DateTimeField()
+    deleted_date = models.DateTimeField()
 
+    def __str__(self) -> str:
+        return f"{self.rse} on {self.project} at {self.percentage}%"
 
 
+class AllocationCost(models.Model):
+    """
+    Materialised staff cost of an allocation.
+    The staff cost of each allocation is split into rows for each month and chargeable period (i.e. a single salary band)
+    so that reports can sum costs in the database rather than recalculating them. Rows are removed when allocations or
+    salary data change and are rebuilt on next use (see `rse.costing.CostLedger`).
+    Rows with no cost represent a period in which the RSE has no salary data.
+    """
+    allocation = models.ForeignKey(RSEAllocation, on_delete=models.CASCADE, related_name='costs')
+    rse = models.ForeignKey(RSE, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    month = models.DateField()                                                  # First day of the month of the period
+    start = models.DateField()
+    end = models.DateField()
+    days = models.IntegerField()
+    salary_band = models.ForeignKey(SalaryBand, null=True, on_delete=models.CASCADE)   # Salary band used (or estimated from)
+    salary = models.DecimalField(max_digits=8, decimal_places=2, null=True)
+    estimated = models.BooleanField(default=False)
+    cost = models.DecimalField(max_digits=12, decimal_places=4, null=True)
 
+    class Meta:
+        constraints = [
+            # periods of an allocation never overlap so a row is written at most once for each period start
+            models.UniqueConstraint(fields=['allocation', 'start'], name='allocation_cost_unique_start'),
+        ]
 
+    def __str__(self) -> str:
+        return f"{self.allocation} from {self.start} until {self.end}: £{self.cost}"
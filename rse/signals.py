@@ -0,0 +1,128 @@
+"""
+Signal receivers for the rse Django app.
+Receivers are connected when the app is ready (see `rse.apps.RseConfig`).
+"""
+from datetime import date
+
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from rse.costing import cost_ledger, salary_band_registry, salary_chain_cache
+from rse.dashboard import dashboard_cache
+from rse.models import RSE, DirectlyIncurredProject, FinancialYear, Project, RSEAllocation, SalaryBand, SalaryGradeChange, ServiceProject
+
+
+@receiver(request_started)
+@receiver(post_save, sender=SalaryBand)
+@receiver(post_delete, sender=SalaryBand)
+@receiver(post_save, sender=FinancialYear)
+@receiver(post_delete, sender=FinancialYear)
+def clear_salary_band_registry(sender, **kwargs):
+    """ Salary band lookups are scoped to a single request and must be reloaded if any salary data changes """
+    salary_band_registry.clear()
+
+
+@receiver(request_started)
+@receiver(post_save, sender=SalaryBand)
+@receiver(post_delete, sender=SalaryBand)
+@receiver(post_save, sender=FinancialYear)
+@receiver(post_delete, sender=FinancialYear)
+def clear_salary_chain_cache(sender, **kwargs):
+    """
+    Cached salary chains may include any salary band so all chains are removed if salary data changes. Chains are scoped
+    to a single request as salary data may have been changed by another process.
+    """
+    salary_chain_cache.clear()
+
+
+@receiver(post_save, sender=SalaryGradeChange)
+@receiver(post_delete, sender=SalaryGradeChange)
+def invalidate_salary_chains(sender, instance, **kwargs):
+    """ A salary grade change may change the chains of all other salary grade changes for the RSE (e.g. the starting salary) """
+    salary_chain_cache.invalidate(instance.rse_id)
+
+
+@receiver(pre_save, sender=SalaryGradeChange)
+@receiver(pre_save, sender=SalaryBand)
+def store_previous_values(sender, instance, **kwargs):
+    """ Keeps the saved values of a salary grade change or salary band so that any costs based on them can be invalidated """
+    instance._previous = sender.objects.filter(pk=instance.pk).first() if instance.pk else None
+
+
+@receiver(post_save, sender=RSEAllocation)
+def update_allocation_costs(sender, instance, **kwargs):
+    """ Allocations are costed when saved (deleted allocations are never used so only have their costs removed) """
+    cost_ledger.update(RSEAllocation.objects.all(deleted=True).filter(id=instance.id))
+
+
+@receiver(post_save, sender=RSE)
+def update_rse_costs(sender, instance, **kwargs):
+    """ Employment dates of an RSE limit the costs of all of their allocations """
+    cost_ledger.update(RSEAllocation.objects.all(deleted=True).filter(rse=instance))
+
+
+@receiver(post_save, sender=SalaryGradeChange)
+@receiver(post_delete, sender=SalaryGradeChange)
+def update_salary_grade_change_costs(sender, instance, signal, **kwargs):
+    """
+    A salary grade change affects costs of the RSE from the date of the change (or its previous date). Deleted salary
+    grade changes may be part of deleting the RSE (and their allocations) so costs are only removed.
+    """
+    previous = getattr(instance, '_previous', None)
+    rse_ids = {instance.rse_id}
+    from_date = instance.date
+    if previous:
+        rse_ids.add(previous.rse_id)
+        from_date = min(from_date, previous.date)
+    if signal is post_delete:
+        cost_ledger.invalidate(rse_ids=rse_ids, from_date=from_date)
+    else:
+        cost_ledger.update(RSEAllocation.objects.all(deleted=True).filter(rse__in=rse_ids, end__gt=from_date))
+
+
+@receiver(post_save, sender=SalaryBand)
+@receiver(post_delete, sender=SalaryBand)
+def invalidate_salary_band_costs(sender, instance, **kwargs):
+    """
+    A salary band affects costs from the start of its financial year (including any estimates for later years). Changes
+    affect all RSEs (e.g. copying salary bands into a new year) so allocations are not costed again until the ledger is
+    rebuilt (see `rse.costing.CostLedger`).
+    """
+    previous = getattr(instance, '_previous', None)
+    year = min(instance.year_id, previous.year_id) if previous else instance.year_id
+    cost_ledger.invalidate(from_date=date(year, 8, 1))
+
+
+@receiver(post_save, sender=FinancialYear)
+@receiver(post_delete, sender=FinancialYear)
+def invalidate_financial_year_costs(sender, instance, **kwargs):
+    """ Costs are invalidated from the start of a changed financial year (see `invalidate_salary_band_costs`) """
+    cost_ledger.invalidate(from_date=instance.start_date())
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=DirectlyIncurredProject)
+@receiver(post_delete, sender=DirectlyIncurredProject)
+@receiver(post_save, sender=ServiceProject)
+@receiver(post_delete, sender=ServiceProject)
+def invalidate_project_dashboards(sender, **kwargs):
+    """ Project counts and lists are shown on every home page """
+    dashboard_cache.invalidate('projects')
+
+
+@receiver(post_save, sender=RSEAllocation)
+@receiver(post_delete, sender=RSEAllocation)
+def invalidate_allocation_dashboards(sender, instance, **kwargs):
+    """ Allocations affect the team capacity and the home page of the allocated RSE """
+    dashboard_cache.invalidate('allocations', f"allocations:{instance.rse_id}")
+
+
+@receiver(post_save, sender=RSE)
+@receiver(post_delete, sender=RSE)
+@receiver(post_save, sender=SalaryGradeChange)
+@receiver(post_delete, sender=SalaryGradeChange)
+def invalidate_rse_dashboards(sender, **kwargs):
+    """ Employment of RSEs affects the team capacity """
+    dashboard_cache.invalidate('rses')
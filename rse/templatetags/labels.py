@@ -72,7 +72,7 @@ def sum_project_allocation_percentage(project: Project, allocations: QuerySet):
     """
     sum = 0
     for a in allocations:
-        if a.project == project:
+        if a.project_id == project.id:
             sum += a.percentage
     if sum > 0:
         return f"{sum}%"
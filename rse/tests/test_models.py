@@ -1,4 +1,4 @@
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from django.utils import timezone
 
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
@@ -249,6 +249,25 @@ def setup_project_and_allocation_data():
     a5.save()
     
     
+def setup_salary_change_allocation_data():
+    """
+    Create salary grade changes and allocations where costs depend on the start of the costed period (i.e. a promotion
+    part way through an allocation and an RSE starting in July whose first increment is skipped)
+    """
+    # promotion of testuser within the allocation to test_project_2
+    rse = RSE.objects.get(user__username='testuser')
+    SalaryGradeChange(rse=rse, salary_band=SalaryBand.objects.get(grade=1, grade_point=4, year=2018), date=date(2018, 12, 5)).save()
+    p3 = Project.objects.get(name="test_project_2")
+    RSEAllocation(rse=rse, project=p3, percentage=30, start=date(2018, 3, 15), end=date(2019, 2, 10)).save()
+
+    # RSE starting in July allocated beyond the end of the project
+    user = User.objects.create_user(username='testuser5', password='12345')
+    rse5 = RSE(user=user)
+    rse5.employed_until = date(2021, 1, 1)
+    rse5.save()
+    SalaryGradeChange(rse=rse5, salary_band=SalaryBand.objects.get(grade=1, grade_point=2, year=2017), date=date(2018, 7, 15)).save()
+    RSEAllocation(rse=rse5, project=p3, percentage=60, start=date(2018, 7, 15), end=date(2019, 9, 1)).save()
+
 
 ##############
 # Test Cases #
@@ -364,6 +383,60 @@ class SalaryCalculationTests(TestCase):
         self.assertEqual(sb11_2019b.grade_point, 1)
         self.assertEqual(sb11_2019b.year.year, 2019)
 
+    def test_salary_point_estimated(self):
+        """
+        Check that estimated salaries for future years are immutable salary points and that the salary band used for the estimate is not modified.
+        """
+        sb11_2019 = SalaryBand.objects.get(grade=1, grade_point=1, year__year=2019)
+        sp11_2020 = sb11_2019.salary_band_next_financial_year()
+
+        # estimate should be a salary point with 3% inflation
+        self.assertIsInstance(sp11_2020, SalaryPoint)
+        self.assertTrue(sp11_2020.estimated)
+        self.assertEqual(sp11_2020.inflation_years, 1)
+        self.assertAlmostEqual(float(sp11_2020.salary), 1002.0*1.03, places=2)
+        with self.assertRaises(AttributeError):
+            sp11_2020.salary = 0
+
+        # original salary band should not be modified
+        self.assertFalse(sb11_2019.estimated)
+        self.assertEqual(sb11_2019.salary, 1002)
+
+        # increments and further years should compound inflation
+        sp12_2021 = sp11_2020.salary_band_next_financial_year().salary_band_after_increment()
+        self.assertEqual(sp12_2021.grade_point, 2)
+        self.assertEqual(sp12_2021.inflation_years, 2)
+        self.assertAlmostEqual(float(sp12_2021.salary), 2002.0*(1.03**2), places=2)
+
+        # salary points are equal by value
+        self.assertEqual(sp11_2020, sb11_2019.salary_band_next_financial_year())
+
+    def test_salary_band_registry(self):
+        """
+        Check that salary band increments are resolved from the salary band registry and that the registry is cleared when salary data changes.
+        """
+        from rse.costing import salary_band_registry
+
+        sb11_2017 = SalaryBand.objects.select_related('year').get(grade=1, grade_point=1, year__year=2017)
+        salary_band_registry.index  # load registry
+
+        # Increments should not query the database once the registry is loaded
+        with self.assertNumQueries(0):
+            sb12_2017 = sb11_2017.salary_band_after_increment()
+            sb11_2018 = sb11_2017.salary_band_next_financial_year()
+        self.assertEqual(sb12_2017.salary, 2000)
+        self.assertEqual(sb11_2018.salary, 1001)
+
+        # Modifying a returned salary band should not modify the registry
+        sb11_2018.salary = 0
+        self.assertEqual(sb11_2017.salary_band_next_financial_year().salary, 1001)
+
+        # Saving a salary band should clear the registry
+        sb11_2018 = SalaryBand.objects.get(grade=1, grade_point=1, year__year=2018)
+        sb11_2018.salary = 1500
+        sb11_2018.save()
+        self.assertEqual(sb11_2017.salary_band_next_financial_year().salary, 1500)
+
     def test_get_last_grade_change(self):
         """
         Check that salary grade changes are detected.
@@ -527,7 +600,68 @@ class SalaryCalculationTests(TestCase):
         self.assertEqual(sb.year.year, 2019)    # estimated 2020
         self.assertAlmostEqual(float(sb.salary), 2002.0*(1.03**2), places=2)
 
-    
+    def test_salary_projection_cached(self):
+        """
+        Check that salary projections are cached for each salary grade change and that the cache is invalidated when salary data changes
+        """
+        # Get initial test data from DB for testuser3 (single grade change on 1.1 at 1/8/2019)
+        sgc = SalaryGradeChange.objects.filter(rse__user__username="testuser3")[0]
+        sb = sgc.salary_band_at_future_date(date(2030, 8, 1))
+
+        # Later projections should only query the last salary grade change (once for each projection)
+        with self.assertNumQueries(2):
+            self.assertEqual(sgc.salary_band_at_future_date(date(2030, 8, 1)), sb)
+            self.assertEqual(sgc.salary_band_at_future_date(date(2020, 8, 1)).grade_point, 1)
+
+        # Saving a salary grade change should invalidate the projection (i.e. no longer a starting salary skipping the first increment)
+        SalaryGradeChange.objects.create(rse=sgc.rse, salary_band=SalaryBand.objects.get(grade=1, grade_point=1, year__year=2017), date=date(2017, 8, 1))
+        self.assertEqual(sgc.salary_band_at_future_date(date(2020, 8, 1)).grade_point, 2)
+
+        # Saving a salary band should invalidate the projection
+        sb11_2019 = SalaryBand.objects.get(grade=1, grade_point=1, year__year=2019)
+        sb11_2019.salary = 1500
+        sb11_2019.save()
+        sgc = SalaryGradeChange.objects.filter(rse__user__username="testuser3").order_by('-date')[0]
+        self.assertAlmostEqual(float(sgc.salary_band_at_future_date(date(2019, 12, 1)).salary), 1500.0, places=2)
+
+        # Projections are copies so changing one does not change the cached chain
+        sb = sgc.salary_band_at_future_date(date(2019, 12, 1))
+        sb.salary = 0
+        self.assertAlmostEqual(float(sgc.salary_band_at_future_date(date(2019, 12, 1)).salary), 1500.0, places=2)
+
+        # Chains are cleared at the start of each request (salary data may have been changed by another process)
+        from django.core.signals import request_started
+        from rse.costing import salary_chain_cache
+        self.assertTrue(salary_chain_cache._chains)
+        request_started.send(sender=self.__class__)
+        self.assertFalse(salary_chain_cache._chains)
+
+    def test_july_start_first_increment(self):
+        """
+        Check that salary projections and staff costs of a starting salary in July apply the same first increment rule
+        """
+        from rse.costing import skips_first_increment
+        user = User.objects.create_user(username='testuser_july', password='12345')
+        rse = RSE.objects.create(user=user, employed_until=date(2025, 1, 1))
+        sgc = SalaryGradeChange.objects.create(rse=rse, salary_band=SalaryBand.objects.get(grade=1, grade_point=1, year__year=2017), date=date(2018, 7, 15))
+
+        # A July start only skips the first increment once it has been passed
+        self.assertFalse(skips_first_increment(sgc, True, date(2018, 12, 31)))
+        self.assertTrue(skips_first_increment(sgc, True, date(2019, 1, 1)))
+        self.assertFalse(skips_first_increment(sgc, False, date(2019, 1, 1)))
+
+        # Projections from the salary grade change and the salary timeline agree at every date
+        for d in (date(2018, 7, 15), date(2018, 12, 31), date(2019, 1, 1), date(2019, 8, 1), date(2020, 1, 1)):
+            sb = sgc.salary_band_at_future_date(d)
+            self.assertEqual((sb.grade_point, sb.salary), (rse.salary_timeline.salary_band_at(d).grade_point, rse.salary_timeline.salary_band_at(d).salary))
+        self.assertEqual(sgc.salary_band_at_future_date(date(2019, 1, 1)).grade_point, 1)
+        self.assertEqual(sgc.salary_band_at_future_date(date(2020, 1, 1)).grade_point, 2)
+
+        # Costs from a date after the first increment use the projected (skipped) salary band
+        sb = sgc.salary_band_at_future_date(date(2019, 2, 1))
+        self.assertAlmostEqual(float(rse.staff_cost(date(2019, 2, 1), date(2019, 3, 1)).staff_cost), float(SalaryBand.salaryCost(28, sb.salary)), places=2)
+
+
     def test_date_in_financial_year(self):
         """
         Tests to see if a date is in the finical year represented by this salary band
@@ -618,7 +752,70 @@ class SalaryCalculationTests(TestCase):
         # Expected behaviour is that the cost should be 10 months salary with new financial year change in August with no cost after to 1/10/2018
         # I.e.  1000 (2017 G1.1) * 211/365 (days in 2017 FY)
         #       1001 (2018 G1.1) * 62/365 (days in 2018 FY)
-        self.assertAlmostEqual(rse.staff_cost(from_date=date(2018, 1, 1), until_date=date(2020, 10, 1)).staff_cost, Decimal(748.11), places=2) 
+        self.assertAlmostEqual(rse.staff_cost(from_date=date(2018, 1, 1), until_date=date(2020, 10, 1)).staff_cost, Decimal(748.11), places=2)
+
+    # Remove Oncosts in settings
+    @override_settings(ONCOSTS_SALARY_MULTIPLIER=1.0)
+    def test_days_from_budget(self):
+        """
+        Test the number of days an RSE can be charged given a budget
+        """
+        rse = RSE.objects.filter(user__username='testuser')[0]
+
+        # Budget for 1000 (2017 G1.1) * 100/365 at 100% FTE should afford 100 days
+        self.assertEqual(rse.days_from_budget(date(2017, 8, 1), Decimal(1000 * 100 / 365.0) + Decimal(0.001), 100.0), 100)
+        # Half the FTE should afford twice as many days
+        self.assertEqual(rse.days_from_budget(date(2017, 8, 1), Decimal(1000 * 100 / 365.0) + Decimal(0.001), 50.0), 200)
+
+        # Budget spanning increments and financial years should be the inverse of the staff cost
+        budget = rse.staff_cost(from_date=date(2018, 9, 1), until_date=date(2020, 3, 1), percentage=50.0).staff_cost
+        self.assertEqual(rse.days_from_budget(date(2018, 9, 1), budget + Decimal(0.001), 50.0), (date(2020, 3, 1) - date(2018, 9, 1)).days)
+
+        # Budget spanning the salary grade change at 1/8/2018 should use salary band 1.3 after the change
+        # I.e.  1000 (2017 G1.1) * 334/365 (no increment in first year) +
+        #       3001 (2018 G1.3) * 100/365
+        budget = Decimal((1000 * 334 + 3001 * 100) / 365.0) + Decimal(0.001)
+        self.assertEqual(rse.days_from_budget(date(2017, 9, 1), budget, 100.0), 434)
+
+        # No budget affords no days
+        self.assertEqual(rse.days_from_budget(date(2017, 9, 1), 0, 50.0), 0)
+
+        # A salary band without a salary can not be spent
+        sb = SalaryBand.objects.get(grade=1, grade_point=1, year=2017)
+        sb.salary = 0
+        sb.save()
+        rse = RSE.objects.filter(user__username='testuser')[0]
+        with self.assertRaises(ValueError):
+            rse.days_from_budget(date(2017, 8, 1), Decimal(1000), 100.0)
+
+    # Remove Oncosts in settings
+    @override_settings(ONCOSTS_SALARY_MULTIPLIER=1.0)
+    def test_salary_timeline(self):
+        """
+        Test the salary timeline used to calculate RSE staff costs
+        Once built the timeline should not query the database and should give the same costs as the chargeable periods
+        """
+        from rse.costing import SalaryTimeline
+
+        timeline = SalaryTimeline(self.rse)
+
+        with self.assertNumQueries(0):
+            # Same expected values as test_staff_costs
+            self.assertAlmostEqual(timeline.cost(date(2017, 8, 1), date(2018, 8, 1)), Decimal(1000.00), places=2)
+            self.assertAlmostEqual(timeline.cost(date(2018, 7, 1), date(2018, 9, 1)), Decimal(169.95), places=2)
+            self.assertAlmostEqual(timeline.cost(date(2018, 8, 1), date(2019, 8, 1)), Decimal(3581.82), places=2)
+
+            # Breakdown should sum to the total cost
+            salary_value = timeline.staff_cost(date(2017, 8, 1), date(2021, 8, 1), percentage=50.0)
+            self.assertAlmostEqual(sum(item['staff_cost'] for item in salary_value.cost_breakdown), salary_value.staff_cost, places=2)
+
+            # Estimated salary bands (beyond 2019 financial year data)
+            self.assertTrue(salary_value.cost_breakdown[-1]['salary_band'].estimated)
+
+        # Timeline for an RSE without salary data incurs no cost
+        user = User.objects.create_user(username='testuser5', password='12345')
+        rse = RSE.objects.create(user=user, employed_until=date(2025, 1, 1))
+        self.assertEqual(SalaryTimeline(rse).staff_cost(date(2017, 8, 1), date(2018, 8, 1)).staff_cost, 0)
 
 class ProjectAllocationTests(TestCase):
     """
@@ -704,8 +901,454 @@ class ProjectAllocationTests(TestCase):
         p = Project.objects.get(name="test_project_2")
         self.assertIsInstance(p, DirectlyIncurredProject)
         self.assertAlmostEqual(p.staff_budget(), Decimal(5968.87), places=2)
-        
-   
+
+    def test_staff_costs_batch(self):
+        """
+        Tests that batch staff costs for all RSEs give the same costs as the RSE and project models
+        """
+        from rse.costing import StaffCosts
+
+        costs = StaffCosts()
+        projects = list(Project.objects.all())
+        project_allocations = costs.project_allocations(projects)
+
+        # Once loaded no further queries are needed for costs
+        with self.assertNumQueries(0):
+            project_costs = {p: costs.project_salary_value(p, project_allocations[p.id], consider_internal=True).staff_cost for p in projects}
+
+        for p, cost in project_costs.items():
+            for a in project_allocations[p.id]:
+                self.assertIsInstance(a.project, Project)
+            self.assertAlmostEqual(cost, p.staff_cost(consider_internal=True).staff_cost, places=2)
+        for rse in RSE.objects.all():
+            try:
+                cost = rse.staff_cost(date(2018, 1, 1), date(2019, 8, 1)).staff_cost
+            except ValueError:
+                # RSEs without salary data should raise the same error
+                with self.assertRaises(ValueError):
+                    costs.rse_cost(rse, date(2018, 1, 1), date(2019, 8, 1))
+                continue
+            self.assertAlmostEqual(costs.rse_cost(rse, date(2018, 1, 1), date(2019, 8, 1)), cost, places=2)
+
+    def test_staff_costs_for(self):
+        """
+        Tests that bulk project staff costs match the staff costs of each project using a fixed number of queries
+        """
+        projects = list(Project.objects.all())
+        Project.staff_costs_for(projects)
+
+        # rses, salary grade changes and allocations
+        with self.assertNumQueries(3):
+            staff_costs = Project.staff_costs_for(projects, from_date=date(2017, 9, 1), until_date=date(2018, 9, 1), consider_internal=True)
+        for p in projects:
+            cost = p.staff_cost(from_date=date(2017, 9, 1), until_date=date(2018, 9, 1), consider_internal=True)
+            self.assertAlmostEqual(staff_costs[p.id].staff_cost, cost.staff_cost, places=2)
+            self.assertEqual(len(staff_costs[p.id].cost_breakdown), len(cost.cost_breakdown))
+            self.assertEqual([a.id for a in staff_costs[p.id].allocation_breakdown], [a.id for a in cost.allocation_breakdown])
+
+    def test_scheduled_working_days_to_today_for(self):
+        """
+        Tests that bulk scheduled working days match the working days of each projects allocations using a single query
+        """
+        projects = list(Project.objects.all())
+        now = timezone.now().date()
+        for rse in (None, RSE.objects.get(user__username='testuser')):
+            with self.assertNumQueries(1):
+                scheduled = Project.scheduled_working_days_to_today_for(projects, rse=rse)
+            for p in projects:
+                allocations = RSEAllocation.objects.filter(project=p, start__lte=now)
+                if rse:
+                    allocations = allocations.filter(rse=rse)
+                self.assertAlmostEqual(scheduled[p.id], sum(a.working_days(p.start, now) for a in allocations))
+                self.assertAlmostEqual(p.scheduled_working_days_to_today(rse=rse), scheduled[p.id])
+        self.assertGreater(sum(scheduled.values()), 0)
+
+    def test_rse_with_capacity(self):
+        """
+        Tests that annotated RSE employment and capacity match the per RSE values and are loaded in a single query
+        """
+        at = date(2018, 3, 1)
+        with self.assertNumQueries(1):
+            rses = list(RSE.objects.with_capacity(at).select_related('user'))
+            employed_from = {rse.id: rse.employed_from for rse in rses}
+        for rse in rses:
+            capacity = sum(a.percentage for a in RSEAllocation.objects.filter(rse=rse, start__lte=at, end__gt=at, project__status='F'))
+            self.assertAlmostEqual(rse.capacity, capacity)
+            self.assertEqual(employed_from[rse.id], RSE.objects.get(id=rse.id).employed_from)
+        self.assertTrue(any(rse.capacity > 0 for rse in rses))
+        # default is the capacity today
+        for rse in RSE.objects.with_capacity():
+            self.assertAlmostEqual(rse.capacity, rse.current_capacity)
+
+    def test_dashboard_counts(self):
+        """
+        Tests that the single query dashboard counts match separate counts of projects
+        """
+        Project.objects.filter(name="test_project_2").update(status=Project.REVIEW)
+        for now in (date(2017, 6, 1), date(2018, 3, 1), date(2019, 1, 15), date(2020, 1, 1)):
+            soon = now + timedelta(days=90)
+            with self.assertNumQueries(1):
+                counts = Project.objects.dashboard_counts(now, soon)
+            not_funded = Q(status=Project.PREPARATION) | Q(status=Project.REVIEW)
+            self.assertEqual(counts, {
+                'active_funded_projects': Project.objects.filter(start__lte=now, end__gt=now, status=Project.FUNDED).count(),
+                'review_projects': Project.objects.filter(status=Project.REVIEW).count(),
+                'outstanding_invoices': ServiceProject.objects.filter(internal=False, invoice_received=None).count(),
+                'warning_starting_not_funded': Project.objects.filter(not_funded).filter(start__gt=now, start__lte=soon).count(),
+                'warning_service_started_not_invoiced': ServiceProject.objects.filter(internal=False, start__lte=now, end__gt=now, invoice_received=None).count(),
+                'danger_started_not_funded': Project.objects.filter(not_funded).filter(start__lte=now, end__gte=now).count(),
+                'danger_service_ended_not_invoiced': ServiceProject.objects.filter(status=Project.FUNDED, internal=False, end__lt=now, invoice_received=None).count(),
+            })
+        self.assertEqual(counts['outstanding_invoices'], 1)
+        self.assertEqual(counts['danger_service_ended_not_invoiced'], 1)
+
+    def test_dashboard_snapshots(self):
+        """
+        Tests that home page snapshots are cached and only invalidated by changes which affect them
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from rse.dashboard import admin_snapshot, dashboard_cache, rse_snapshot
+        dashboard_cache.clear()
+        now = date(2018, 3, 1)
+        rse = RSE.objects.get(user__username='testuser')
+
+        snapshot = admin_snapshot(now)
+        rse_snapshot(rse, now)
+        with self.assertNumQueries(0):
+            self.assertEqual(admin_snapshot(now), snapshot)
+            rse_snapshot(rse, now)
+        self.assertEqual(snapshot['outstanding_invoices'], 1)
+
+        # an allocation of another RSE invalidates the admin snapshot only
+        a = RSEAllocation.objects.filter(rse__user__username='testuser3').first()
+        a.save()
+        with self.assertNumQueries(0):
+            rse_snapshot(rse, now)
+        with CaptureQueriesContext(connection) as queries:
+            admin_snapshot(now)
+        self.assertGreater(len(queries), 0)
+
+        # projects invalidate all snapshots
+        p = ServiceProject.objects.get()
+        p.invoice_received = now
+        p.save()
+        self.assertEqual(admin_snapshot(now)['outstanding_invoices'], 0)
+        with self.assertNumQueries(0):
+            admin_snapshot(now)
+        allocations = rse_snapshot(rse, now)['active_allocations']
+        self.assertEqual(len(allocations), RSEAllocation.objects.filter(rse=rse, start__lte=now, end__gte=now, project__status='F').count())
+        with self.assertNumQueries(0):
+            self.assertEqual([a.project.name for a in rse_snapshot(rse, now)['active_allocations']], [a.project.name for a in allocations])
+
+    def test_rse_employment_filters(self):
+        """
+        Tests that the annotated RSE employment and employment query set filters match the RSE properties
+        """
+        with self.assertNumQueries(1):
+            rses = list(RSE.objects.all())
+            employed_from = {rse.id: rse.employed_from for rse in rses}
+            current_employment = {rse.id for rse in rses if rse.current_employment}
+        for rse in rses:
+            sgcs = SalaryGradeChange.objects.filter(rse=rse).order_by('date')
+            self.assertEqual(employed_from[rse.id], sgcs[0].date if sgcs else None)
+
+        # RSEs constructed directly (i.e. not annotated) query their employment
+        unannotated = {rse.id: RSE(id=rse.id, user=rse.user, employed_until=rse.employed_until) for rse in rses}
+        self.assertEqual(set(RSE.objects.current_employment().values_list('id', flat=True)), current_employment)
+        self.assertEqual(set(RSE.objects.current_employment(False).values_list('id', flat=True)), {rse.id for rse in rses} - current_employment)
+        for from_date, until_date in ((date(2017, 1, 1), date(2018, 1, 1)), (date(2019, 1, 1), date(2020, 1, 1)), (date(2030, 1, 1), date(2031, 1, 1))):
+            expected = {rse_id for rse_id, rse in unannotated.items() if rse.employed_in_period(from_date, until_date)}
+            self.assertEqual(set(RSE.objects.employed_in_period(from_date, until_date).values_list('id', flat=True)), expected)
+        for year in range(2016, 2021):
+            expected = {rse_id for rse_id, rse in unannotated.items() if rse.employed_in_financial_year(year)}
+            self.assertEqual(set(RSE.objects.employed_in_financial_year(year).values_list('id', flat=True)), expected)
+
+    def test_stacked_commitment_summary(self):
+        """
+        Tests that stacked commitment series have a point at every allocation date and accept raw tuples and lists
+        """
+        allocations = RSEAllocation.objects.filter(rse__user__username='testuser')
+        from_date, until_date = date(2017, 8, 1), date(2019, 8, 1)
+        summary = RSEAllocation.stacked_commitment_summary(allocations, from_date, until_date)
+
+        # allocation spanning full 2017 financial year has points at its start, the starts of other allocations and its end
+        a = allocations.get(start=date(2017, 8, 1), end=date(2018, 7, 31))
+        self.assertEqual(summary[a], [{"x": date(2017, 8, 1), "y": 50}, {"x": date(2017, 9, 1), "y": 50}, {"x": date(2018, 1, 1), "y": 50}, {"x": date(2018, 7, 31), "y": 0}])
+
+        tuples = allocations.values_list('id', 'start', 'end', 'percentage')
+        self.assertEqual(RSEAllocation.stacked_commitment_summary(tuples, from_date, until_date), {a.id: points for a, points in summary.items()})
+
+        # lists of allocations (e.g. grouped by RSE) and lists of lists are combined
+        self.assertEqual(RSEAllocation.stacked_commitment_summary(list(allocations), from_date, until_date), summary)
+        self.assertEqual(RSEAllocation.stacked_commitment_summary([list(allocations[:1]), list(allocations[1:])], from_date, until_date), summary)
+
+    def test_commitment_summary(self):
+        """
+        Tests that commitment summaries store changes in active allocations and reconstruct them when iterated
+        """
+        allocations = RSEAllocation.objects.filter(rse__user__username='testuser').order_by('id')
+        a1, a2, a3, a4 = allocations
+        summary = RSEAllocation.commitment_summary(allocations)
+
+        self.assertEqual(summary.dates, [date(2017, 8, 1), date(2017, 9, 1), date(2018, 1, 1), date(2018, 7, 31), date(2018, 9, 1), date(2019, 2, 1)])
+        self.assertEqual(summary.added[0], [a1, a2, a3])
+        self.assertEqual(summary.removed[1], [a3])
+        self.assertEqual(list(summary)[2], (date(2018, 1, 1), 120, [a1, a2, a4]))
+        self.assertEqual(list(summary)[-1], (date(2019, 2, 1), 0, []))
+
+        # percentage of each project at each date
+        percentages = list(summary.project_percentages([a1.project, a3.project, a4.project]))
+        self.assertEqual(percentages[0], (date(2017, 8, 1), 150, [100, 50, 0]))
+        self.assertEqual(percentages[3], (date(2018, 7, 31), 70, [50, 0, 20]))
+
+    def test_commitment_matrix(self):
+        """
+        Tests the weekly commitment of RSEs accumulated from raw allocation tuples
+        """
+        allocations = RSEAllocation.objects.values_list('rse', 'start', 'end', 'percentage')
+        # weeks from Monday 2018.7.30 until 2018.9.10
+        weeks, matrix = RSEAllocation.commitment_matrix(allocations, date(2018, 8, 1), date(2018, 9, 8))
+        self.assertEqual(weeks, [date(2018, 7, 30) + timedelta(days=7 * w) for w in range(6)])
+
+        # testuser: 50% until 2018.7.31 (exclusive) and 50% until 2018.9.1 with 20% throughout. The first week is averaged
+        # from 2018.8.1 and the last week until 2018.9.8 (exclusive)
+        rse = RSE.objects.get(user__username='testuser')
+        self.assertEqual(matrix[rse.id], [70, 70, 70, 70, round((50 * 5 + 20 * 7) / 7, 2), 20])
+        rse3 = RSE.objects.get(user__username='testuser3')
+        self.assertEqual(matrix[rse3.id], [90] * 6)
+
+        # days after the until date do not reduce the final week
+        weeks, matrix = RSEAllocation.commitment_matrix(allocations, date(2018, 8, 1), date(2018, 9, 1))
+        self.assertEqual(weeks[-1], date(2018, 8, 27))
+        self.assertEqual(matrix[rse.id][-1], 70)
+
+    def test_monthly_fte(self):
+        """
+        Tests that the monthly FTE of each key is the average daily allocated FTE of each month within the date range
+        """
+        allocations = RSEAllocation.objects.order_by('rse', 'project').values_list('rse', 'project', 'start', 'end', 'percentage')
+        from_date, until_date = date(2017, 8, 15), date(2019, 7, 31)
+        months, rows = RSEAllocation.monthly_fte((((rse, project), start, end, percentage) for rse, project, start, end, percentage in allocations), from_date, until_date)
+        self.assertEqual(months[0], date(2017, 8, 1))
+        self.assertEqual(months[-1], date(2019, 7, 1))
+        self.assertEqual(len(months), 24)
+
+        rows = dict(rows)
+        self.assertTrue(any(any(fte) for fte in rows.values()))
+        self.assertEqual(set(rows.keys()), set((rse, project) for rse, project, _, _, _ in allocations))
+        for (rse, project), fte in rows.items():
+            for i, month in enumerate(months):
+                month_start = max(month, from_date)
+                month_end = months[i + 1] if i + 1 < len(months) else until_date + timedelta(days=1)
+                days = [month_start + timedelta(days=d) for d in range((month_end - month_start).days)]
+                expected = sum(percentage for r, p, start, end, percentage in allocations for d in days if r == rse and p == project and start <= d < end) / 100.0 / len(days)
+                self.assertAlmostEqual(fte[i], expected, places=3)
+
+    def test_streamed_report(self):
+        """
+        Tests that batched project staff cost rows match the staff costs of the projects and are streamed as CSV and JSON lines
+        """
+        import json
+        from rse.views.reporting import project_staffcosts_rows
+        from rse.views.helper import stream_report
+
+        projects = Project.objects.all()
+        from_date, until_date = date(2017, 8, 1), date(2019, 7, 31)
+        staff_costs = Project.staff_costs_for(projects, from_date=from_date, until_date=until_date)
+        errors = []
+        rows = list(project_staffcosts_rows(projects.iterator(), from_date, until_date, report=lambda level, message: errors.append(message), batch_size=2))
+        self.assertEqual([p.id for p, _ in rows], [p.id for p in projects])
+        for p, p_costs in rows:
+            self.assertAlmostEqual(p_costs.staff_cost, staff_costs[p.id].staff_cost)
+        self.assertEqual(errors, [])
+
+        columns = ['project_id', 'staff_cost']
+        values = [[p.id, round(p_costs.staff_cost, 2)] for p, p_costs in rows]
+        response = stream_report('csv', columns, values, 'report')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="report.csv"')
+        self.assertEqual(b''.join(response.streaming_content).decode().splitlines(), ['project_id,staff_cost'] + [f'{i},{c}' for i, c in values])
+        response = stream_report('jsonl', columns, values, 'report')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(lines, [{'project_id': i, 'staff_cost': str(c)} for i, c in values])
+
+    def test_salary_value_merge(self):
+        """
+        Tests that salary values merged in bulk keep the staff cost and breakdown of each allocation
+        """
+        allocations = list(RSEAllocation.objects.filter(rse__user__username='testuser'))
+        values = [a.staff_cost() for a in allocations]
+
+        salary_value = SalaryValue()
+        salary_value.merge(values, allocations)
+        self.assertAlmostEqual(salary_value.staff_cost, sum(v.staff_cost for v in values), places=2)
+
+        # breakdown as parallel arrays with allocation ids
+        arrays = salary_value.breakdown_arrays()
+        self.assertEqual(set(len(a) for a in arrays.values()), {sum(len(v.cost_breakdown) for v in values)})
+        self.assertEqual(arrays['allocation'], [a.id for a, v in zip(allocations, values) for _ in v.cost_breakdown])
+        self.assertEqual(arrays['staff_cost'], [item['staff_cost'] for v in values for item in v.cost_breakdown])
+
+        # breakdown by allocation
+        for (allocation, breakdown), a, v in zip(salary_value.allocation_breakdown.items(), allocations, values):
+            self.assertEqual(allocation.id, a.id)
+            self.assertEqual(allocation.rse, a.rse)
+            self.assertEqual(breakdown, v.cost_breakdown)
+
+    def test_cost_ledger(self):
+        """
+        Tests that the cost ledger holds the full cost of each allocation and that batch costs over periods crossing salary
+        grade changes, financial years and increments are the same as the staff costs of the models
+        """
+        from rse.costing import StaffCosts, cost_ledger
+        setup_salary_change_allocation_data()
+
+        def staff_cost(model, *args, **kwargs):
+            try:
+                return model.staff_cost(*args, **kwargs).staff_cost
+            except ValueError:
+                return None
+
+        # allocations are costed when saved
+        allocations = list(RSEAllocation.objects.order_by('id'))
+        ledger_costs = cost_ledger.allocation_costs(RSE.objects.values_list('id', flat=True))
+        for a in allocations:
+            self.assertAlmostEqual(ledger_costs[a.id], staff_cost(a), places=2)
+
+        projects = list(Project.objects.all())
+        periods = [
+            (Project.min_start_date(), Project.max_end_date()),
+            (date(2018, 3, 15), date(2019, 2, 10)),     # a single allocation
+            (date(2018, 3, 1), date(2018, 12, 20)),     # ends after the promotion
+            (date(2018, 12, 1), date(2019, 1, 15)),     # promotion and increment
+            (date(2019, 1, 1), date(2019, 12, 31)),     # after the promotion and first increment
+            (date(2018, 7, 31), date(2018, 8, 2)),      # financial year change
+            (date(2018, 9, 1), date(2019, 3, 1)),       # first increment of the July start
+        ]
+        for from_date, until_date in periods:
+            costs = StaffCosts()
+            allocation_costs = costs.allocation_costs(costs.allocations(), from_date, until_date)
+            for a in allocations:
+                self.assertAlmostEqual(allocation_costs[a.id], staff_cost(a, from_date, until_date), places=2, msg=f'{a} from {from_date} until {until_date}')
+            project_costs = costs.project_costs(projects, from_date, until_date)
+            for p in projects:
+                self.assertAlmostEqual(project_costs[p.id], staff_cost(p, from_date, until_date, consider_internal=True), places=2, msg=f'{p} from {from_date} until {until_date}')
+
+        # ledger totals are only used for allocations within the period
+        a = allocations[-1]
+        AllocationCost.objects.filter(allocation=a).update(cost=0)
+        costs = StaffCosts()
+        self.assertEqual(costs.allocation_costs([a], a.start, a.end)[a.id], 0)
+        self.assertAlmostEqual(costs.allocation_costs([a], a.start, a.end - timedelta(days=1))[a.id], staff_cost(a, a.start, a.end - timedelta(days=1)), places=2)
+
+        # a salary band change removes costs of allocations after the start of its year and costs are then from the salary
+        # timelines without writing to the ledger
+        count = AllocationCost.objects.count()
+        salary_band = SalaryBand.objects.get(grade=1, grade_point=2, year=2017)
+        salary_band.salary = 2500
+        salary_band.save()
+        self.assertFalse(AllocationCost.objects.filter(allocation=a).exists())
+        self.assertLess(AllocationCost.objects.count(), count)
+        count = AllocationCost.objects.count()
+        a = RSEAllocation.objects.get(id=a.id)
+        self.assertAlmostEqual(StaffCosts().allocation_costs([a], a.start, a.end)[a.id], staff_cost(a), places=2)
+        self.assertEqual(AllocationCost.objects.count(), count)
+        cost_ledger.ensure()
+        self.assertAlmostEqual(cost_ledger.allocation_costs([a.rse_id])[a.id], staff_cost(a), places=2)
+
+        # a salary grade change costs the allocations of the RSE after the change again
+        a = allocations[0]
+        change_date = a.start + timedelta(days=60)
+        salary_band = SalaryBand.objects.filter(year__lte=change_date.year).order_by('-salary').first()
+        SalaryGradeChange.objects.create(rse=a.rse, salary_band=salary_band, date=change_date)
+        a = RSEAllocation.objects.get(id=a.id)
+        self.assertAlmostEqual(cost_ledger.allocation_costs([a.rse_id])[a.id], staff_cost(a), places=2)
+
+        # rows of an allocation are only written once (e.g. if costed by concurrent requests)
+        count = AllocationCost.objects.count()
+        AllocationCost.objects.bulk_create(cost_ledger.allocation_rows(a, a.rse.salary_timeline), ignore_conflicts=True)
+        self.assertEqual(AllocationCost.objects.count(), count)
+
+    def test_rebuild_costs(self):
+        """
+        Tests that the rebuild costs command rebuilds the cost ledger in place and verifies it against live staff costs
+        """
+        from io import StringIO
+        from django.core.management import call_command
+        setup_salary_change_allocation_data()
+
+        call_command('rebuild_costs', workers=1, stdout=StringIO())
+        rows = AllocationCost.objects.count()
+        ids = set(AllocationCost.objects.values_list('id', flat=True))
+        self.assertGreater(rows, RSEAllocation.objects.count())
+
+        # rebuilding again updates the existing rows
+        out = StringIO()
+        call_command('rebuild_costs', workers=1, stdout=out)
+        self.assertEqual(set(AllocationCost.objects.values_list('id', flat=True)), ids)
+        self.assertIn('allocations/sec', out.getvalue())
+
+        out = StringIO()
+        call_command('rebuild_costs', workers=1, verify=True, stdout=out)
+        self.assertIn('All ledger costs match staff costs', out.getvalue())
+
+        # only allocations without costs are costed after a salary band changes
+        salary_band = SalaryBand.objects.get(grade=1, grade_point=1, year=2018)
+        salary_band.salary = 1500
+        salary_band.save()
+        missing = RSEAllocation.objects.filter(costs__isnull=True).count()
+        self.assertGreater(missing, 0)
+        out = StringIO()
+        call_command('rebuild_costs', workers=1, missing=True, stdout=out)
+        self.assertIn(f'Costed {missing} allocations', out.getvalue())
+        self.assertFalse(RSEAllocation.objects.filter(costs__isnull=True).exists())
+        out = StringIO()
+        call_command('rebuild_costs', workers=1, verify=True, stdout=out)
+        self.assertIn('All ledger costs match staff costs', out.getvalue())
+
+    def test_archive_allocations(self):
+        """
+        Tests that the archive allocations command moves only old deleted allocations to the history table and that recent
+        allocation changes are found in both tables
+        """
+        from io import StringIO
+        from django.core.management import call_command, CommandError
+
+        live, recent, old = RSEAllocation.objects.all()[:3]
+        # allocations are deleted by flagging them
+        RSEAllocation.objects.filter(id=recent.id).update(deleted_date=timezone.now())
+        RSEAllocation.objects.filter(id=old.id).update(created_date=timezone.now() - timedelta(days=5 * 365), deleted_date=timezone.now() - timedelta(days=4 * 365))
+        count = RSEAllocation.objects.all(deleted=True).count()
+
+        # a dry run moves nothing
+        out = StringIO()
+        call_command('archive_allocations', years=3, dry_run=True, stdout=out)
+        self.assertIn('1 allocations', out.getvalue())
+        self.assertEqual(RSEAllocation.objects.all(deleted=True).count(), count)
+
+        call_command('archive_allocations', years=3, batch_size=1, stdout=StringIO())
+        self.assertEqual(RSEAllocation.objects.all(deleted=True).count(), count - 1)
+        self.assertFalse(RSEAllocation.objects.all(deleted=True).filter(id=old.id).exists())
+        history = RSEAllocationHistory.objects.get(id=old.id)
+        self.assertEqual((history.rse_id, history.project_id, history.percentage, history.start, history.end), (old.rse_id, old.project_id, old.percentage, old.start, old.end))
+        self.assertTrue(RSEAllocation.objects.filter(id=live.id).exists())
+
+        # changes since a date include both live and archived allocations
+        changes = {a.id for a in RSEAllocation.changes_since(timezone.now() - timedelta(days=30))}
+        self.assertIn(recent.id, changes)
+        self.assertNotIn(old.id, changes)
+        changes = {a.id for a in RSEAllocation.changes_since(timezone.now() - timedelta(days=6 * 365))}
+        self.assertIn(old.id, changes)
+        self.assertIn(live.id, changes)
+
+        # an allocation already in the history table aborts the batch without removing it
+        RSEAllocation.objects.all(deleted=True).filter(id=recent.id).update(deleted_date=timezone.now() - timedelta(days=4 * 365))
+        RSEAllocationHistory.objects.create(id=recent.id, rse_id=recent.rse_id, project_id=recent.project_id, percentage=recent.percentage, start=recent.start, end=recent.end, created_date=recent.created_date, deleted_date=timezone.now())
+        with self.assertRaises(CommandError):
+            call_command('archive_allocations', years=3, stdout=StringIO())
+        self.assertTrue(RSEAllocation.objects.all(deleted=True).filter(id=recent.id).exists())
+
+
 class EdgeCasesDivByZeros(TestCase):
 
     def setUp(self):
@@ -121,6 +121,9 @@ urlpatterns = [
     # RSE team commitment view all
     re_path(r'^commitment$', rses.commitment, name='commitment'),
 
+    # RSE team commitment by week (JSON for capacity heatmaps)
+    re_path(r'^commitment/heatmap$', rses.commitment_heatmap, name='commitment_heatmap'),
+
     # RSE salary grade change view
     re_path(r'^rse/(?P<rse_username>[\w.@+-]+)/salary$', rses.rse_salary, name='rse_salary'),
 
@@ -166,6 +169,9 @@ urlpatterns = [
     # View current cost distribution (staff charging)
     re_path(r'^costdistributions$', reporting.costdistributions, name='costdistributions'),
 
+    # Export monthly cost distribution (staff charging) as CSV
+    re_path(r'^costdistributions/export$', reporting.costdistributions_export, name='costdistributions_export'),
+
     # View projected cost distribution (for an individual)
     re_path(r'^costdistribution/(?P<rse_username>[\w.@+-]+)$', reporting.costdistribution, name='costdistribution'),
 
@@ -1,5 +1,8 @@
+import csv
+import itertools as it
+import json
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, Iterable, Iterator, List
 from decimal import Decimal
 
 from django.utils import timezone
@@ -15,13 +18,18 @@ from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.mixins import UserPassesTestMixin
 from django.contrib import messages
 from django.contrib.auth.forms import AdminPasswordChangeForm
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+import logging
 
 
 from rse.models import *
 from rse.forms import *
 
+logger = logging.getLogger(__name__)
+
 
 #########################
 ### Helper Functions ####
@@ -79,4 +87,58 @@ def create_default_filter_range():
         curr_year = datetime.now().year
         curr_fy = FinancialYear(year=curr_year)
         
-    return f'{curr_fy.start_date()} - {curr_fy.end_date()}'
\ No newline at end of file
+    return f'{curr_fy.start_date()} - {curr_fy.end_date()}'
+
+
+class Echo():
+    """ Pseudo buffer which returns written values so that CSV rows can be streamed (see `stream_csv`) """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def stream_csv(rows: Iterable[Iterable], filename: str) -> StreamingHttpResponse:
+    """
+    CSV file download which is written lazily row by row as the response is streamed (the rows are never all held in memory)
+    """
+    writer = csv.writer(Echo())
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+# formats of streamed reports (see `stream_report`)
+REPORT_FORMATS = ('csv', 'jsonl')
+
+
+def stream_report(report_format: str, columns: List[str], rows: Iterable[Iterable], filename: str) -> StreamingHttpResponse:
+    """
+    Report download which is written lazily row by row as the response is streamed. Rows are lists of values for each
+    column and are written as CSV (with a header of the column names) or as JSON lines (an object for each row).
+    """
+    if report_format == 'jsonl':
+        lines = (json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n' for row in rows)
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="{filename}.jsonl"'
+        return response
+    return stream_csv(it.chain([columns], rows), f'{filename}.csv')
+
+
+def currency(value) -> Decimal:
+    """ Currency value (e.g. staff cost) of a report rounded to pence """
+    return round(Decimal(value), 2)
+
+
+def log_report_message(level: int, message: str):
+    """ Logs a report error or warning which can not be shown as a message (i.e. in streamed reports) """
+    logger.log(level, message)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """ Splits an iterable into lists of (at most) a size so that it can be processed in batches """
+    iterator = iter(iterable)
+    while True:
+        batch = list(it.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -1,12 +1,13 @@
-from datetime import datetime, timedelta
-from typing import Dict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Iterator, Tuple
 
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 from django.views.generic.edit import DeleteView
 from django.urls import reverse_lazy
 from django.db.models import Q
-from django.http import HttpRequest, HttpResponse, HttpResponseRedirect, Http404, HttpResponseServerError
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, Http404, HttpResponseServerError
 from django.shortcuts import get_object_or_404, render
 from django.db.models import Max, Min, ProtectedError 
 from django.db import IntegrityError
@@ -19,6 +20,7 @@ from django.conf import settings
 
 
 from rse.models import *
+from rse.costing import StaffCosts
 from rse.forms import *
 from rse.views.helper import *
  
@@ -42,9 +44,8 @@ def allocations_recent(request: HttpRequest) -> HttpResponse:
             recent = form.cleaned_data['from_date']
     view_dict['form'] = form
             
-    # get recent allocations
-    q = Q(created_date__gte=recent) | Q(deleted_date__gte=recent)
-    allocations = RSEAllocation.objects.all(deleted=True).filter(q)
+    # get recent allocations (including any archived deleted allocations)
+    allocations = RSEAllocation.changes_since(recent)
     view_dict['allocations'] = allocations
 
     return render(request, 'allocations_recent.html', view_dict)
@@ -84,16 +85,67 @@ def costdistributions(request: HttpRequest) -> HttpResponse:
     allocation_unique_projects = Project.objects.filter(id__in=allocation_unique_project_ids)
     view_dict['projects'] = allocation_unique_projects
         
-    # Gett the allocations per active RSE
+    # Gett the allocations per active RSE (allocations are fetched once and grouped by RSE)
+    costs = StaffCosts()
+    grouped_allocations = costs.rse_allocations(q)
     rse_allocations = {}
-    for rse in RSE.objects.all() :
-        if rse.current_employment:
-            r_a = allocations.filter(rse=rse)
-            rse_allocations[rse] = r_a
+    for rse in costs.rses.values():
+        if costs.timelines[rse.id].current_employment:
+            rse_allocations[rse] = grouped_allocations[rse.id]
     view_dict['rse_allocations'] = rse_allocations
 	
     return render(request, 'costdistributions.html', view_dict)
 
+@user_passes_test(lambda u: u.is_superuser)
+def costdistributions_export(request: HttpRequest) -> HttpResponse:
+    """
+    Monthly team cost distribution for finance as a streamed CSV file with the FTE of each RSE on each chargeable project
+    in each month. Defaults to funded projects within the current financial year.
+    """
+    req_get_copy = request.GET.copy()
+    req_get_copy['status'] = req_get_copy.get('status') or 'F'
+    req_get_copy['rse_in_employment'] = req_get_copy.get('rse_in_employment') or 'All'
+    if req_get_copy.get('filter_range') is None:
+        req_get_copy['filter_range'] = create_default_filter_range()
+    form = FilterProjectForm(req_get_copy)
+    if not form.is_valid():
+        return HttpResponseBadRequest(form.errors.as_text())
+
+    # Construct q query for allocation query
+    from_date, until_date = form.cleaned_data["filter_range"]
+    q = Q(end__gt=from_date) & Q(start__lte=until_date)
+
+    # apply status type query
+    status = form.cleaned_data["status"]
+    if status in 'PRFX':
+        q &= Q(project__status=status)
+    elif status == 'L':
+        q &= Q(project__status='F')|Q(project__status='R')
+    elif status == 'U':
+        q &= Q(project__status='F')|Q(project__status='R')|Q(project__status='P')
+
+    # filter to only include chargable service projects (or any directly incurred projects)
+    q &= Q(project__serviceproject__charged=True) | Q(project__directlyincurredproject__isnull=False)
+
+    # Filter by employment status (see `RSE.current_employment`)
+    rse_in_employment = form.cleaned_data["rse_in_employment"]
+    if rse_in_employment != 'All':
+        q &= Q(rse__in=RSE.objects.current_employment(rse_in_employment == 'Yes'))
+
+    # allocations are streamed from a single query ordered by RSE and project (so only the allocations of one row are held)
+    allocations = (RSEAllocation.objects.filter(q)
+                   .order_by('rse__user__last_name', 'rse__user__first_name', 'rse', 'project__name', 'project')
+                   .values_list('rse__user__first_name', 'rse__user__last_name', 'rse', 'project__name', 'project__proj_costing_id', 'project', 'start', 'end', 'percentage'))
+    keyed_allocations = ((a[:6], a[6], a[7], a[8]) for a in allocations.iterator())
+    months, fte_rows = RSEAllocation.monthly_fte(keyed_allocations, from_date, until_date)
+
+    def rows():
+        yield ['RSE', 'Project', 'Project Code'] + [month.strftime('%Y-%m') for month in months]
+        for (first_name, last_name, _, project_name, proj_costing_id, _), fte in fte_rows:
+            yield [f'{first_name} {last_name}', project_name, proj_costing_id or ''] + fte
+
+    return stream_csv(rows(), f'cost_distribution_{from_date}_{until_date}.csv')
+
 @user_passes_test(lambda u: u.is_superuser)
 def costdistribution(request: HttpRequest, rse_username: str) -> HttpResponse:
 
@@ -143,13 +195,71 @@ def costdistribution(request: HttpRequest, rse_username: str) -> HttpResponse:
     allocation_unique_projects = Project.objects.filter(id__in=allocation_unique_project_ids)
     view_dict['projects'] = allocation_unique_projects
         
-    # Get a commitment summary for the RSE
+    # Get a commitment summary for the RSE with the allocated percentage of each project
     commitments = RSEAllocation.commitment_summary(allocations, from_date, until_date)
-    view_dict['commitments'] = commitments # (tuple of date, total FTE effort, [allocations])
+    view_dict['commitments'] = commitments.project_percentages(allocation_unique_projects) # (tuple of date, total FTE effort, [project percentages])
 
     return render(request, 'costdistribution.html', view_dict)
 
 
+# staff cost fields of each RSE in the staff costs report
+RSE_STAFF_COST_FIELDS = ('staff_salary', 'recovered_staff_cost', 'internal_project_staff_cost', 'non_recovered_cost', 'staff_liability')
+
+
+def rses_staffcosts_rows(rses: RSEQuerySet, q: Q, from_date: date, until_date: date, report: Callable[[int, str], None]) -> Iterator[Tuple[RSE, Dict[str, Decimal]]]:
+    """
+    Staff costs of each RSE (see `RSE_STAFF_COST_FIELDS`) for allocations matching a query within a period. Salary data
+    and allocations are loaded in bulk but the costs of each RSE are only calculated as its row is reached. Errors and
+    warnings are passed to `report` with their message level.
+    """
+    # salary timelines and allocations for the RSEs are loaded in bulk
+    costs = StaffCosts(rses.select_related('user'))
+    timelines = costs.timelines
+    rses = list(costs.rses.values())
+
+    rse_allocations = costs.rse_allocations(q)
+    # allocation costs (from the cost ledger or salary timelines) are costed as `RSEAllocation.staff_cost` over the period
+    allocation_costs = costs.allocation_costs((a for allocations in rse_allocations.values() for a in allocations), from_date=from_date, until_date=until_date)
+
+    for rse in rses:
+        # get any allocations for rse
+        allocations = rse_allocations[rse.id]
+        
+        try:
+            staff_salary = costs.rse_cost(rse, from_date=from_date, until_date=until_date)
+        except ValueError:
+            # no salary data fro date range so warn and calculate from first available point
+            try:
+                first_sgc = timelines[rse.id].first_salary_date()
+                staff_salary = costs.rse_cost(rse, from_date=first_sgc, until_date=until_date)
+                report(messages.WARNING, f'WARNING: RSE user {rse} does not have salary data until {first_sgc} and will incur no cost until this point.')
+            except ValueError:
+                staff_salary = 0
+                report(messages.ERROR, f'ERROR: RSE user {rse} does not have any salary information and will incur no cost.')
+        
+        recovered_staff_cost = 0
+        internal_project_staff_cost = 0
+        
+        for a in allocations:
+            # staff cost
+            value = allocation_costs[a.id]
+            if value is None:
+                value = 0
+                report(messages.ERROR, f'ERROR: RSE user {a.rse} does not have salary data for allocation on project {a.project} starting at {from_date} so will incur no cost.')
+            
+            # sum staff cost from allocation
+            if (a.project.internal):    # internal
+                internal_project_staff_cost += value
+                
+            # allocated or chargeable service
+            elif isinstance(a.project, DirectlyIncurredProject) or (isinstance(a.project, ServiceProject) and a.project.charged == True): 
+                recovered_staff_cost += value
+        
+        non_recovered_cost =  staff_salary - recovered_staff_cost
+        staff_liability =  staff_salary - recovered_staff_cost - internal_project_staff_cost
+        yield rse, {'staff_salary': staff_salary, 'recovered_staff_cost': recovered_staff_cost, 'internal_project_staff_cost': internal_project_staff_cost, 'non_recovered_cost': non_recovered_cost, 'staff_liability': staff_liability}
+
+
 @user_passes_test(lambda u: u.is_superuser)
 def rses_staffcosts(request: HttpRequest) -> HttpResponse:
     """
@@ -199,63 +309,33 @@ def rses_staffcosts(request: HttpRequest) -> HttpResponse:
     # save the form
     view_dict['form'] = form
 
-    rses_costs = {}
-    total_staff_salary = total_recovered_staff_cost = total_internal_project_staff_cost = total_non_recovered_cost = total_staff_liability = 0
-    
-    rses = RSE.objects.all()
+    # RSEs employed in the period
+    rses = RSE.objects.employed_in_period(from_date, until_date)
     
     # Filter RSEs by employment status
     if rse_in_employment != 'All':
         in_employment = True if rse_in_employment == 'Yes' else False
-        filtered_rses_id = [rse.id for rse in rses if rse.current_employment == in_employment]
-        rses = rses.filter(id__in=filtered_rses_id)
+        rses = rses.current_employment(in_employment)
 
-    for rse in (rse for rse in rses if rse.employed_in_period(from_date, until_date)):
-        # get any allocations for rse
-        allocations = RSEAllocation.objects.filter(rse=rse).filter(q)
-        
-        try:
-            staff_salary = rse.staff_cost(from_date=from_date, until_date=until_date).staff_cost
-        except ValueError:
-            # no salary data fro date range so warn and calculate from first available point
-            try:
-                first_sgc = rse.firstSalaryGradeChange().salary_band.year.start_date()
-                staff_salary = rse.staff_cost(from_date=first_sgc, until_date=until_date).staff_cost
-                messages.add_message(request, messages.WARNING, f'WARNING: RSE user {rse} does not have salary data until {first_sgc} and will incur no cost until this point.')
-            except ValueError:
-                staff_salary = 0
-                messages.add_message(request, messages.ERROR, f'ERROR: RSE user {rse} does not have any salary information and will incur no cost.')
-        
-        recovered_staff_cost = 0
-        internal_project_staff_cost = 0
-        
-        for a in allocations:
-            # staff cost
-            try:
-                value = a.staff_cost(start=from_date, end=until_date).staff_cost
-            
-            except ValueError:
-                value = 0
-                messages.add_message(request, messages.ERROR, f'ERROR: RSE user {a.rse} does not have salary data for allocation on project {a.project} starting at {from_date} so will incur no cost.')
-            
-            # sum staff cost from allocation
-            if (a.project.internal):    # internal
-                internal_project_staff_cost += value
-                
-            # allocated or chargeable service
-            elif isinstance(a.project, DirectlyIncurredProject) or (isinstance(a.project, ServiceProject) and a.project.charged == True): 
-                recovered_staff_cost += value
-        
-        non_recovered_cost =  staff_salary - recovered_staff_cost
-        staff_liability =  staff_salary - recovered_staff_cost - internal_project_staff_cost
-        rses_costs[rse] = {'staff_salary': staff_salary, 'recovered_staff_cost': recovered_staff_cost, 'internal_project_staff_cost': internal_project_staff_cost, 'non_recovered_cost': non_recovered_cost, 'staff_liability': staff_liability}
+    # streamed download of the report (costs are calculated as each RSE row is reached)
+    report_format = request.GET.get('format')
+    if report_format in REPORT_FORMATS:
+        rows = rses_staffcosts_rows(rses, q, from_date, until_date, report=log_report_message)
+        return stream_report(report_format, ['rse', 'username'] + list(RSE_STAFF_COST_FIELDS),
+                             ([str(rse), rse.user.username] + [currency(data[f]) for f in RSE_STAFF_COST_FIELDS] for rse, data in rows),
+                             f'rses_staffcosts_{from_date}_{until_date}')
+
+    rses_costs = {}
+    total_staff_salary = total_recovered_staff_cost = total_internal_project_staff_cost = total_non_recovered_cost = total_staff_liability = 0
+    for rse, data in rses_staffcosts_rows(rses, q, from_date, until_date, report=lambda level, message: messages.add_message(request, level, message)):
+        rses_costs[rse] = data
         
         # sum totals
-        total_staff_salary += staff_salary
-        total_recovered_staff_cost += recovered_staff_cost
-        total_internal_project_staff_cost += internal_project_staff_cost
-        total_non_recovered_cost += non_recovered_cost
-        total_staff_liability += staff_liability
+        total_staff_salary += data['staff_salary']
+        total_recovered_staff_cost += data['recovered_staff_cost']
+        total_internal_project_staff_cost += data['internal_project_staff_cost']
+        total_non_recovered_cost += data['non_recovered_cost']
+        total_staff_liability += data['staff_liability']
 
     view_dict['rse_costs'] = rses_costs
 
@@ -327,12 +407,13 @@ def rse_staffcost(request: HttpRequest, rse_username) -> HttpResponse:
     project_costs = {}
     recovered_staff_cost = 0
     internal_project_staff_cost = 0
+    # staff costs of the rse for all projects
+    project_values = Project.staff_costs_for(projects, from_date=from_date, until_date=until_date, rse=rse, consider_internal=True)
     # group costs by project
     for p in projects:
         # Get all staff costs for the project and rse
-        try:
-            staff_cost = p.staff_cost(from_date=from_date, until_date=until_date, rse=rse, consider_internal=True)
-        except ValueError:
+        staff_cost = project_values[p.id]
+        if staff_cost is None:
             staff_cost = SalaryValue()
             messages.add_message(request, messages.ERROR, f'ERROR: Project {p} has allocations with missing salary data for {rse} in the time period starting at {from_date}.')
         # only include projects with staff effort
@@ -374,6 +455,45 @@ def serviceoutstanding(request: HttpRequest) -> HttpResponse:
 
     return render(request, 'serviceoutstanding.html', view_dict)
 
+def serviceincome_rows(projects: Iterable[ServiceProject], from_date: date, until_date: date, report: Callable[[int, str], None]) -> Iterator[Tuple[ServiceProject, Dict[str, Decimal]]]:
+    """
+    Income (value), staff cost and surplus of each service project within a period. Costs of each project are only
+    calculated as its row is reached. Errors are passed to `report` with their message level.
+    """
+    for p in projects:
+        # project has a value if invoice received in accounting period
+        value = 0 
+        if p.invoice_received and p.invoice_received > from_date and p.invoice_received <= until_date:  # test if the invoice received was within specified period
+            value = p.value()
+        # project has a staff cost if it has been charged
+        staff_cost = 0
+        if p.charged == True:
+            try:
+                p_costs = p.staff_cost(from_date=from_date, until_date=until_date)
+            except ValueError:
+                p_costs = SalaryValue()
+                report(messages.ERROR, f'ERROR: Project {p} has allocations with missing RSE salary data in the time period starting at {from_date}.')
+            staff_cost = p_costs.staff_cost
+        # surplus is the balance in the accounting period
+        surplus = value - staff_cost
+        yield p, {'value': value, 'staff_cost': staff_cost, 'surplus': surplus}
+
+
+def project_staffcosts_rows(projects: Iterable[Project], from_date: date, until_date: date, report: Callable[[int, str], None], consider_internal: bool = False, batch_size: int = 100) -> Iterator[Tuple[Project, SalaryValue]]:
+    """
+    Staff costs of each project within a period (see `Project.staff_costs_for`). Costs are calculated for batches of
+    projects as they are reached. Errors are passed to `report` with their message level.
+    """
+    for batch in batched(projects, batch_size):
+        staff_costs = Project.staff_costs_for(batch, from_date=from_date, until_date=until_date, consider_internal=consider_internal)
+        for p in batch:
+            p_costs = staff_costs[p.id]
+            if p_costs is None:
+                p_costs = SalaryValue()
+                report(messages.ERROR, f'ERROR: Project {p} has allocations with missing RSE salary data in the time period starting at {from_date}.')
+            yield p, p_costs
+
+
 @user_passes_test(lambda u: u.is_superuser)
 def serviceincome(request: HttpRequest) -> HttpResponse:
     """
@@ -413,32 +533,25 @@ def serviceincome(request: HttpRequest) -> HttpResponse:
     q &= Q(internal=False)
     projects = ServiceProject.objects.filter(q)
 
+    # streamed download of the report (costs are calculated as each project row is reached)
+    report_format = request.GET.get('format')
+    if report_format in REPORT_FORMATS:
+        rows = serviceincome_rows(projects.iterator(), from_date, until_date, report=log_report_message)
+        return stream_report(report_format, ['project_id', 'project', 'proj_costing_id', 'value', 'staff_cost', 'surplus'],
+                             ([p.id, p.name, p.proj_costing_id, currency(data['value']), currency(data['staff_cost']), currency(data['surplus'])] for p, data in rows),
+                             f'serviceincome_{from_date}_{until_date}')
+
     # Get costs associated with each project
     project_costs = {}
     total_value = 0
     total_staff_cost = 0
     total_surplus = 0
-    for p in projects:
-        # project has a value if invoice received in accounting period
-        value = 0 
-        if p.invoice_received and p.invoice_received > from_date and p.invoice_received <= until_date:  # test if the invoice received was within specified period
-            value = p.value()
-        # project has a staff cost if it has been charged
-        staff_cost = 0
-        if p.charged == True:
-            try:
-                p_costs = p.staff_cost(from_date=from_date, until_date=until_date)
-            except ValueError:
-                staff_cost = SalaryValue()
-                messages.add_message(request, messages.ERROR, f'ERROR: Project {p} has allocations with missing RSE salary data in the time period starting at {from_date}.')
-            staff_cost = p_costs.staff_cost
-        # surplus is the balance in the accounting period
-        surplus = value - staff_cost
+    for p, data in serviceincome_rows(projects, from_date, until_date, report=lambda level, message: messages.add_message(request, level, message)):
         # add project and project costs to dictionary and calculate sums
-        project_costs[p] = {'value': value, 'staff_cost': staff_cost, 'surplus': surplus}
-        total_value += value
-        total_staff_cost += staff_cost
-        total_surplus +=  surplus
+        project_costs[p] = data
+        total_value += data['value']
+        total_staff_cost += data['staff_cost']
+        total_surplus += data['surplus']
     # Add project data and sums to view dict
     view_dict['project_costs'] = project_costs
     view_dict['total_value'] = total_value
@@ -490,16 +603,19 @@ def projects_income_summary(request: HttpRequest) -> HttpResponse:
     q &= Q(instance_of=DirectlyIncurredProject) | Q(Q(instance_of=ServiceProject) & Q(serviceproject__charged=True))
     projects = Project.objects.filter(q)
 
+    # streamed download of the report (costs are calculated as each batch of project rows is reached)
+    report_format = request.GET.get('format')
+    if report_format in REPORT_FORMATS:
+        rows = project_staffcosts_rows(projects.iterator(), from_date, until_date, report=log_report_message)
+        return stream_report(report_format, ['project_id', 'project', 'proj_costing_id', 'staff_cost', 'overhead'],
+                             ([p.id, p.name, p.proj_costing_id, currency(p_costs.staff_cost), currency(p.overhead_value(from_date=from_date, until_date=until_date))] for p, p_costs in rows),
+                             f'projects_income_summary_{from_date}_{until_date}')
+
     # Get costs associated with each allocated project
     project_costs = {}
     total_staff_cost = 0
     total_overhead = 0
-    for p in projects:
-        try:
-            p_costs = p.staff_cost(from_date=from_date, until_date=until_date)
-        except ValueError:
-            p_costs = SalaryValue()
-            messages.add_message(request, messages.ERROR, f'ERROR: Project {p} has allocations with missing RSE salary data in the time period starting at {from_date}.')
+    for p, p_costs in project_staffcosts_rows(projects, from_date, until_date, report=lambda level, message: messages.add_message(request, level, message)):
         staff_cost = p_costs.staff_cost
         overhead = p.overhead_value(from_date=from_date, until_date=until_date)
         # add project and project costs to dictionary and calculate sums
@@ -542,9 +658,8 @@ def project_staffcosts(request: HttpRequest, project_id: int) -> HttpResponse:
     view_dict['form'] = form
 
     # Get the project costs
-    try:
-        costs = project.staff_cost(from_date=from_date, until_date=until_date, consider_internal=True)
-    except ValueError:
+    costs = Project.staff_costs_for([project], from_date=from_date, until_date=until_date, consider_internal=True)[project.id]
+    if costs is None:
         costs = SalaryValue()
         messages.add_message(request, messages.ERROR, f'ERROR: Project {project} has allocations with missing RSE salary data in the time period starting at {from_date}.')
     view_dict['costs'] = costs
@@ -564,7 +679,7 @@ def project_remaining_days(request: HttpRequest, project_id: int, rse_id: int, s
         rse = RSE.objects.get(id=rse_id)
         project = DirectlyIncurredProject.objects.get(id=project_id)
     except ObjectDoesNotExist:
-        JsonResponse({'days': 0})
+        return JsonResponse({'days': 0})
 
     # get start date as a date
     start_date = datetime.strptime(start, '%d-%m-%Y').date()
@@ -578,7 +693,7 @@ def project_remaining_days(request: HttpRequest, project_id: int, rse_id: int, s
             staff_cost += a.staff_cost().staff_cost
         except ValueError:
             staff_cost = 0
-            messages.add_message(request, messages.ERROR, f'ERROR: RSE user {a.rse} does not have salary data for allocation on project {a.project} starting at {from_date} so will incur no cost.')
+            messages.add_message(request, messages.ERROR, f'ERROR: RSE user {a.rse} does not have salary data for allocation on project {a.project} starting at {a.start} so will incur no cost.')
     remaining_budget = project.staff_budget() - staff_cost
 
     # get the remaining FTE days for rse given remaining budget
@@ -628,15 +743,18 @@ def projects_internal_summary(request: HttpRequest) -> HttpResponse:
     q &= Q(internal=True)
     projects = Project.objects.filter(q)
 
+    # streamed download of the report (costs are calculated as each batch of project rows is reached)
+    report_format = request.GET.get('format')
+    if report_format in REPORT_FORMATS:
+        rows = project_staffcosts_rows(projects.iterator(), from_date, until_date, report=log_report_message, consider_internal=True)
+        return stream_report(report_format, ['project_id', 'project', 'proj_costing_id', 'staff_cost'],
+                             ([p.id, p.name, p.proj_costing_id, currency(p_costs.staff_cost)] for p, p_costs in rows),
+                             f'projects_internal_summary_{from_date}_{until_date}')
+
     # Get costs associated with each internal project
     project_costs = {}
     total_staff_cost = 0
-    for p in projects:
-        try:
-            p_costs = p.staff_cost(from_date=from_date, until_date=until_date, consider_internal=True)
-        except ValueError:
-            p_costs = SalaryValue()
-            messages.add_message(request, messages.ERROR, f'ERROR: Project {p} has allocations with missing RSE salary data in the time period starting at {from_date}.')
+    for p, p_costs in project_staffcosts_rows(projects, from_date, until_date, report=lambda level, message: messages.add_message(request, level, message), consider_internal=True):
         staff_cost = p_costs.staff_cost
         # add project and project costs to dictionary and calculate sums
         project_costs[p] = {'staff_cost': staff_cost}
@@ -691,15 +809,19 @@ def financial_summary(request: HttpRequest) -> HttpResponse:
     overheads = 0
     service_income = 0
     
+    # salary timelines for RSEs employed in the period and for RSEs allocated to the projects are loaded in bulk
+    costs = StaffCosts(RSE.objects.employed_in_period(from_date, until_date).select_related('user'))
+    project_costs = StaffCosts(RSE.objects.filter(rseallocation__project__in=projects).distinct()).project_costs(projects, from_date=from_date, until_date=until_date)
+
     # Salary Costs (all RSEs)
-    for rse in (rse for rse in RSE.objects.all() if rse.employed_in_period(from_date, until_date)): # for all currently employed RSEs
+    for rse in costs.rses.values(): # for all RSEs employed in the period
         try:
-            salary_costs += rse.staff_cost(from_date=from_date, until_date=until_date).staff_cost
+            salary_costs += costs.rse_cost(rse, from_date=from_date, until_date=until_date)
         except ValueError:
             # no salary data fro date range so warn and calculate from first available point
             try:
-                first_sgc = rse.firstSalaryGradeChange().salary_band.year.start_date()
-                salary_costs += rse.staff_cost(from_date=first_sgc, until_date=until_date).staff_cost
+                first_sgc = costs.timelines[rse.id].first_salary_date()
+                salary_costs += costs.rse_cost(rse, from_date=first_sgc, until_date=until_date)
                 messages.add_message(request, messages.WARNING, f'WARNING: RSE user {rse} does not have salary data until {first_sgc} and will incur no cost until this point.')
             except ValueError:
                 messages.add_message(request, messages.ERROR, f'ERROR: RSE user {rse} does not have any salary information and will incur no cost.')
@@ -710,15 +832,14 @@ def financial_summary(request: HttpRequest) -> HttpResponse:
         project_recovered_costs = 0
         # Internal Project Costs
         if (p.internal):
-            try:
-                internal_project_staff_costs += p.staff_cost(from_date=from_date, until_date=until_date, consider_internal=True).staff_cost
-            except ValueError:
+            if project_costs[p.id] is not None:
+                internal_project_staff_costs += project_costs[p.id]
+            else:
                 messages.add_message(request, messages.ERROR, f'ERROR: Project {p} has allocations with missing RSE salary data in the time period starting at {from_date}.')
         # Recovered Staff Costs (allocated or charged service projects)
         elif isinstance(p, DirectlyIncurredProject) or (isinstance(p, ServiceProject) and p.charged == True):  
-            try:
-                project_recovered_costs = p.staff_cost(from_date=from_date, until_date=until_date).staff_cost
-            except ValueError:
+            project_recovered_costs = project_costs[p.id]
+            if project_recovered_costs is None:
                 project_recovered_costs = 0
                 messages.add_message(request, messages.ERROR, f'ERROR: Project {p} has allocations with missing RSE salary data in the time period starting at {from_date}.')
             recovered_staff_costs += project_recovered_costs
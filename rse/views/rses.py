@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, List
 
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
@@ -105,7 +105,8 @@ def rses(request: HttpRequest) -> HttpResponse:
     Filters to be handled client side with DataTables
     """
     
-    rses = RSE.objects.all()
+    # employment is annotated by the RSE manager
+    rses = RSE.objects.select_related('user')
 
     # calculate grade point (only displayed for superusers)
     for rse in rses:
@@ -229,30 +230,27 @@ def commitment(request: HttpRequest) -> HttpResponse:
     else:
         form = FilterProjectForm()
         
-    # Get RSE allocations grouped by RSE based off Q filter and save the form
-    allocations = RSEAllocation.objects.filter(q)
+    # Get RSE allocations (with their RSEs and projects) based off Q filter and save the form. RSEs are annotated with
+    # the start of their employment so that employment status does not need a query for each RSE
+    first_grade_change = SalaryGradeChange.objects.filter(rse=OuterRef('rse')).order_by('date').values('date')[:1]
+    allocations = RSEAllocation.objects.filter(q).select_related('rse__user', 'project').annotate(rse_employed_from=Subquery(first_grade_change))
     view_dict['form'] = form
-    
-    # Filter by employment status
-    if rse_in_employment != 'All':
-        in_employment = True if rse_in_employment == 'Yes' else False
-        
-        # remove allocations from RSEs doesn't meet the criteria
-        unique_rses_id = set([allocation.rse.id for allocation in allocations if allocation.rse.current_employment == in_employment])
-        allocations = allocations.filter(rse__id__in=unique_rses_id)
-   
-        
-    # Get unique RSE ids allocated to project and build list of (RSE, [RSEAllocation]) objects for commitment graph
-    allocation_unique_rses = allocations.values('rse').distinct()
-
-    stacked_commitment_data = []
-    rse_allocations = {}
 
-    for a in allocation_unique_rses:
-        r_a = allocations.filter(rse__id=a['rse'])
-        rse = RSE.objects.get(id=a['rse'])
-        rse_allocations[rse] = r_a
-        stacked_commitment_data.append((rse, RSEAllocation.stacked_commitment_summary(r_a, from_date, until_date)))
+    # Group allocations by RSE and build list of (RSE, [RSEAllocation]) objects for commitment graph
+    rses = {}  # type: Dict[int, RSE]
+    rse_allocations = {}  # type: Dict[RSE, List[RSEAllocation]]
+    for a in allocations:
+        rse = rses.get(a.rse_id)
+        if rse is None:
+            rse = rses[a.rse_id] = a.rse
+            rse.employed_from = a.rse_employed_from
+        # Filter by employment status (remove allocations from RSEs that don't meet the criteria)
+        if rse_in_employment != 'All' and rse.current_employment != (rse_in_employment == 'Yes'):
+            continue
+        a.rse = rse
+        rse_allocations.setdefault(rse, []).append(a)
+
+    stacked_commitment_data = [(rse, RSEAllocation.stacked_commitment_summary(r_a, from_date, until_date)) for rse, r_a in rse_allocations.items()]
 
     num_allocations = 1 if len(rse_allocations) < 1 else len(rse_allocations)
     stacked_commitment_summary = RSEAllocation.stacked_commitment_summary(rse_allocations.values(),
@@ -268,3 +266,53 @@ def commitment(request: HttpRequest) -> HttpResponse:
 
     return render(request, 'commitments.html', view_dict)
 
+
+@login_required
+def commitment_heatmap(request: HttpRequest) -> JsonResponse:
+    """
+    JSON matrix of the committed FTE percentage of each RSE by week for team capacity heatmaps.
+    Uses the same filters (and defaults) as the commitment view. All allocations are fetched with a single query.
+    """
+    req_get_copy = request.GET.copy()
+    req_get_copy['status'] = req_get_copy.get('status') or 'F'
+    req_get_copy['rse_in_employment'] = req_get_copy.get('rse_in_employment') or 'Yes'
+    if req_get_copy.get('filter_range') is None:
+        req_get_copy['filter_range'] = create_default_filter_range()
+
+    form = FilterProjectForm(req_get_copy)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    from_date, until_date = form.cleaned_data["filter_range"]
+    q = Q(end__gte=from_date) & Q(start__lte=until_date)
+
+    # apply status type query
+    status = form.cleaned_data["status"]
+    if status in 'PRFX':
+        q &= Q(project__status=status)
+    elif status == 'L':
+        q &= Q(project__status='F')|Q(project__status='R')
+    elif status == 'U':
+        q &= Q(project__status='F')|Q(project__status='R')|Q(project__status='P')
+
+    # Filter by employment status (see `RSE.current_employment`)
+    rse_in_employment = form.cleaned_data["rse_in_employment"]
+    if rse_in_employment != 'All':
+        q &= Q(rse__in=RSE.objects.current_employment(rse_in_employment == 'Yes'))
+
+    rses = {}
+    allocations = []
+    for rse_id, first_name, last_name, start, end, percentage in RSEAllocation.objects.filter(q).order_by('rse__user__last_name', 'rse__user__first_name', 'rse').values_list(
+            'rse', 'rse__user__first_name', 'rse__user__last_name', 'start', 'end', 'percentage'):
+        rses.setdefault(rse_id, f"{first_name} {last_name}")
+        allocations.append((rse_id, start, end, percentage))
+    weeks, matrix = RSEAllocation.commitment_matrix(allocations, from_date, until_date)
+
+    return JsonResponse({
+        'from_date': from_date,
+        'until_date': until_date,
+        'weeks': weeks,
+        'rses': [{'id': rse_id, 'name': name} for rse_id, name in rses.items()],
+        'commitment': [matrix[rse_id] for rse_id in rses],
+    })
+
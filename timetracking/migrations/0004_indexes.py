@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetracking', '0003_alter_timesheetentry_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='timesheetentry',
+            index=models.Index(fields=['rse', 'date'], name='timesheet_rse_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='timesheetentry',
+            index=models.Index(fields=['project', 'date'], name='timesheet_project_date_idx'),
+        ),
+    ]
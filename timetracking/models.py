@@ -1,9 +1,45 @@
+from __future__ import annotations
+
 from django.db import models
+from django.db.models import Case, ExpressionWrapper, F, Sum, Value, When
 from rse.models import *
-from datetime import datetime, date
+from datetime import datetime, date, time, timedelta
 from django.conf import settings
 
 
+class TimeSheetEntryQuerySet(models.QuerySet):
+    """
+    Query set for time sheet entries with aggregation of recorded working days in the database
+    """
+
+    def with_duration(self) -> TimeSheetEntryQuerySet:
+        """
+        Annotates entries with their duration (`working_duration`) which is the working hours per day for all day entries
+        or the difference of the start and end times. Time subtraction is a duration on all database backends.
+        """
+        return self.annotate(working_duration=Case(
+            When(all_day=True, then=Value(timedelta(hours=settings.WORKING_HOURS_PER_DAY))),
+            default=ExpressionWrapper(F('end_time') - F('start_time'), output_field=models.DurationField()),
+            output_field=models.DurationField()))
+
+    @staticmethod
+    def duration_to_working_days(duration: Optional[timedelta]) -> float:
+        """ Converts a total duration of entries into working days """
+        if duration is None:
+            return 0
+        return duration.total_seconds() / (60*60*settings.WORKING_HOURS_PER_DAY)
+
+    def working_days(self) -> float:
+        """ Queryset equivalent of `TimeSheetEntry.working_days` computed with a single aggregate query """
+        duration = self.with_duration().aggregate(duration=Sum('working_duration'))['duration']
+        return self.duration_to_working_days(duration)
+
+    def working_days_by_project(self) -> Dict[int, float]:
+        """ Recorded working days of the entries grouped by project id (projects without entries are not included) """
+        durations = self.with_duration().order_by().values('project').annotate(duration=Sum('working_duration')).values_list('project', 'duration')
+        return {project_id: self.duration_to_working_days(duration) for project_id, duration in durations}
+
+
 class TimeSheetEntry(models.Model):
     """
     Represents a single time sheet entry (either full day or hourly)
@@ -15,6 +51,15 @@ class TimeSheetEntry(models.Model):
     start_time = models.TimeField(blank=True, null=True)
     end_time = models.TimeField(blank=True, null=True)
 
+    objects = TimeSheetEntryQuerySet.as_manager()
+
+    class Meta:
+        """ Time sheet entries are filtered by RSE or project and a date range """
+        indexes = [
+            models.Index(fields=['rse', 'date'], name='timesheet_rse_date_idx'),
+            models.Index(fields=['project', 'date'], name='timesheet_project_date_idx'),
+        ]
+
     def duration(self):
         """ duration is is based off the global WORKING_HOURS_PER_DAY value (if all day event) or the actual hours if hourly entry """
         if self.all_day:
@@ -33,12 +78,15 @@ class TimeSheetEntry(models.Model):
 
         # Loop through time sheet entries and accumulate
         for tse in tses:
-            date = tse.date
-            # accumulate time
-            if tse.all_day:
-                timesheet_days_sum += 1
-            else:
-                timesheet_days_sum += (datetime.combine(date.today(), tse.end_time) - datetime.combine(date.today(), tse.start_time)).seconds / (60*60*settings.WORKING_HOURS_PER_DAY) # convert hours to fractional days
+            timesheet_days_sum += TimeSheetEntry.entry_working_days(tse.all_day, tse.start_time, tse.end_time)
 
         return timesheet_days_sum
+
+    @staticmethod
+    def entry_working_days(all_day: bool, start_time: time, end_time: time) -> float:
+        """ Working days of a single time sheet entry (hourly entries are converted to fractional days) """
+        if all_day:
+            return 1
+        else:
+            return (datetime.combine(date.today(), end_time) - datetime.combine(date.today(), start_time)).seconds / (60*60*settings.WORKING_HOURS_PER_DAY) # convert hours to fractional days
  
\ No newline at end of file
@@ -0,0 +1,74 @@
+from datetime import date, time, timedelta
+
+from django.test import TestCase
+
+from rse.tests.test_models import setup_project_and_allocation_data
+from timetracking.models import *
+from timetracking.timeseries import ProjectTimeSeries
+from timetracking.views import daterange
+
+
+class ProjectTimeSeriesTests(TestCase):
+    """
+    Test case for project time series of expected, allocated and recorded working days
+    """
+
+    def setUp(self):
+        setup_project_and_allocation_data()
+
+        # time sheet entries (all day and hourly) for every RSE on every project
+        for p in Project.objects.all():
+            for i, rse in enumerate(RSE.objects.all()):
+                for d in range(0, (p.end - p.start).days, 11 + i):
+                    all_day = d % 2 == 0
+                    TimeSheetEntry(project=p, rse=rse, date=p.start + timedelta(days=d), all_day=all_day,
+                                   start_time=time(9, 0), end_time=time(11 + i, 30)).save()
+
+    def test_series(self):
+        """
+        Tests that the series match the working days of the allocations and time sheet entries of each period
+        """
+        for p in Project.objects.all():
+            for rse in (None, RSE.objects.get(user__username='testuser')):
+                allocations = RSEAllocation.objects.filter(project=p)
+                tses = TimeSheetEntry.objects.filter(project=p)
+                if rse:
+                    allocations = allocations.filter(rse=rse)
+                    tses = tses.filter(rse=rse)
+
+                # allocations and time sheet entries are loaded in two queries
+                with self.assertNumQueries(2):
+                    time_series = ProjectTimeSeries(p, rse=rse)
+                for granularity in ('day', 'week', 'month'):
+                    with self.assertNumQueries(0):
+                        project_days, allocated_days, timesheet_days = time_series.series(daterange(p.start, p.end, delta=granularity))
+                    allocated_days_sum = timesheet_days_sum = 0
+                    for i, (start_date, end_date, _) in enumerate(daterange(p.start, p.end, delta=granularity)):
+                        allocated_days_sum += sum(a.working_days(start_date, end_date) for a in allocations.filter(start__lte=end_date, end__gt=start_date))
+                        timesheet_days_sum += TimeSheetEntry.working_days(tses.filter(date__gte=start_date, date__lt=end_date))
+                        self.assertEqual(allocated_days[i + 1][0], end_date)
+                        self.assertAlmostEqual(allocated_days[i + 1][1], allocated_days_sum)
+                        self.assertAlmostEqual(timesheet_days[i + 1][1], timesheet_days_sum)
+                    self.assertEqual(len(project_days), i + 2)
+                    self.assertAlmostEqual(float(project_days[-1][1]), float(p.working_days * (end_date - p.start).days / (p.end - p.start).days))
+
+                # summary values
+                for at in (p.start, p.start + timedelta(days=100), p.end, date(2030, 1, 1)):
+                    self.assertAlmostEqual(time_series.scheduled_to_date(at), sum(a.working_days(p.start, at) for a in allocations.filter(start__lte=at)))
+                    self.assertAlmostEqual(time_series.recorded(p.start, at, inclusive=True), TimeSheetEntry.working_days(tses.filter(date__gte=p.start, date__lte=at)))
+                self.assertAlmostEqual(time_series.recorded(), TimeSheetEntry.working_days(tses))
+                self.assertGreater(time_series.recorded(), 0)
+
+    def test_recorded_working_days(self):
+        """
+        Tests that recorded working days aggregated in the database match the working days of the entries
+        """
+        tses = TimeSheetEntry.objects.filter(date__lt=date(2018, 6, 1))
+        working_days = TimeSheetEntry.working_days(tses)
+        with self.assertNumQueries(1):
+            self.assertAlmostEqual(tses.working_days(), working_days)
+        with self.assertNumQueries(1):
+            recorded = tses.working_days_by_project()
+        for p in Project.objects.all():
+            self.assertAlmostEqual(recorded[p.id], TimeSheetEntry.working_days(tses.filter(project=p)))
+        self.assertEqual(TimeSheetEntry.objects.none().working_days(), 0)
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import itertools as it
+from bisect import bisect_left, bisect_right
+from datetime import date
+from typing import Iterable, List, Tuple
+
+from rse.models import RSE, Project, RSEAllocation
+from timetracking.models import TimeSheetEntry
+
+
+class ProjectTimeSeries():
+    """
+    Expected (project), scheduled (allocations) and recorded (time sheets) working days of a project over time.
+    Allocations and time sheet entries of the project (optionally for a single RSE) are loaded once. Time sheet entries are
+    held as a sorted array of dates with a prefix sum of working days so that the working days recorded in any period are
+    found with two binary searches. Allocated working days in a period are found from the overlap of each allocation with it.
+    """
+
+    def __init__(self, project: Project, rse: RSE = None):
+        self.project = project
+        allocations = RSEAllocation.objects.filter(project=project)
+        tses = TimeSheetEntry.objects.filter(project=project)
+        if rse is not None:
+            allocations = allocations.filter(rse=rse)
+            tses = tses.filter(rse=rse)
+        self.allocations = list(allocations.values_list('start', 'end', 'percentage'))
+
+        entries = sorted((d, TimeSheetEntry.entry_working_days(all_day, start_time, end_time)) for d, all_day, start_time, end_time in tses.values_list('date', 'all_day', 'start_time', 'end_time'))
+        self.dates = [d for d, _ in entries]
+        self.recorded_sums = list(it.accumulate((days for _, days in entries), initial=0))
+
+    def recorded(self, from_date: date = None, until_date: date = None, inclusive: bool = False) -> float:
+        """
+        Working days recorded on time sheets from a date until a date (exclusive unless `inclusive`).
+        Equivalent to `TimeSheetEntry.working_days` of the entries within the period.
+        """
+        i = 0 if from_date is None else bisect_left(self.dates, from_date)
+        if until_date is None:
+            j = len(self.dates)
+        else:
+            j = bisect_right(self.dates, until_date) if inclusive else bisect_left(self.dates, until_date)
+        return self.recorded_sums[j] - self.recorded_sums[i] if j > i else 0
+
+    def scheduled_to_date(self, at: date) -> float:
+        """ Working days scheduled by allocations from the project start up to a date (see `Project.scheduled_working_days_to_today`) """
+        scheduled = 0
+        for start, end, percentage in self.allocations:
+            if start <= at:
+                # allocated days need to be converted into equivalent working days (see `RSEAllocation.working_days`)
+                scheduled += Project.fte_days_to_working_days((min(end, at) - max(start, self.project.start)).days) * percentage / 100.0
+        return scheduled
+
+    def series(self, periods: Iterable[Tuple[date, date, int]]) -> Tuple[List[list], List[list], List[list]]:
+        """
+        Cumulative expected, allocated and recorded working days at the end of each of a series of consecutive periods
+        (start, end, duration in days) from the project start (e.g. from `timetracking.views.daterange`). Each series is a
+        list of [date, working days] pairs starting with zero days at the project start.
+        """
+        periods = list(periods)
+        ends = [end for _, end, _ in periods]
+
+        # allocated working days in each period from the overlap of each allocation with the periods it is active in
+        allocated = [0] * len(periods)
+        for start, end, percentage in self.allocations:
+            # first period ending on or after the allocation start (allocations are active if start <= period end and end > period start)
+            for i in range(bisect_left(ends, start), len(periods)):
+                period_start, period_end, _ = periods[i]
+                if period_start >= end:
+                    break
+                allocated[i] += Project.fte_days_to_working_days((min(end, period_end) - max(start, period_start)).days) * percentage / 100.0
+
+        # average fractional day for project (varies for service projects)
+        working_day = self.project.working_days / (self.project.end - self.project.start).days
+        project_days_sum = allocated_days_sum = timesheet_days_sum = 0
+        project_days = [[self.project.start, 0]]
+        allocated_days = [[self.project.start, 0]]
+        timesheet_days = [[self.project.start, 0]]
+        for (period_start, period_end, duration), allocated_in_period in zip(periods, allocated):
+            project_days_sum += working_day*duration
+            project_days.append([period_end, project_days_sum])
+            allocated_days_sum += allocated_in_period
+            allocated_days.append([period_end, allocated_days_sum])
+            timesheet_days_sum += self.recorded(period_start, period_end)
+            timesheet_days.append([period_end, timesheet_days_sum])
+
+        return project_days, allocated_days, timesheet_days
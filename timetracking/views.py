@@ -4,7 +4,7 @@ from typing import Dict
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse_lazy
-from django.db.models import Q
+from django.db.models import F, Q
 from django.http import HttpRequest, HttpResponse, HttpResponseRedirect, Http404, HttpResponseServerError
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import user_passes_test
@@ -20,6 +20,7 @@ from django.conf import settings
 from django.views.generic.edit import DeleteView
 
 from timetracking.forms import *
+from timetracking.timeseries import ProjectTimeSeries
 from rse.forms import *
 
 
@@ -319,15 +320,11 @@ def time_project(request: HttpRequest, project_id: int) -> HttpResponse:
         form = ProjectTimeViewOptionsForm(request.GET, project=project)
         if form.is_valid():
             granularity = form.cleaned_data['granularity'] 
-            # load data depending on RSE selection
+            # select RSE
             if form.cleaned_data['rse'] == "":
-                allocations = RSEAllocation.objects.filter(project=project)
-                tses = TimeSheetEntry.objects.filter(project=project)
                 view_dict['rse_name'] = f"RSE Team (all RSEs)"
             else:
                 rse = get_object_or_404(RSE, id=form.cleaned_data['rse'])
-                allocations = RSEAllocation.objects.filter(rse=rse, project=project)
-                tses = TimeSheetEntry.objects.filter(rse=rse, project=project)
                 view_dict['rse_name'] = f"{rse.user.first_name} {rse.user.last_name}"
     else:
         # default granularity for unbound form (i.e. first load without form submission)
@@ -338,48 +335,16 @@ def time_project(request: HttpRequest, project_id: int) -> HttpResponse:
             granularity = 'week'
         else:
             granularity = 'month'
-        # create unbound form (this is the only way to use initial value for a choice field) and load data
+        # create unbound form (this is the only way to use initial value for a choice field)
         form = ProjectTimeViewOptionsForm(project=project, initial={'granularity': granularity})
-        allocations = RSEAllocation.objects.filter(project=project)
-        tses = TimeSheetEntry.objects.filter(project=project)
         view_dict['rse_name'] = f"RSE Team (all RSEs)"
 
     view_dict['form'] = form
     
 
-    # project expected days
-    project_days = []
-    project_days_sum = 0
-    working_day = project.working_days / (project.end - project.start).days  # average fractional day for project (varies for service projects)
-    # project allocated days
-    allocated_days = []
-    allocated_days_sum = 0
-    # rse time sheet hours
-    timesheet_days = []
-    timesheet_days_sum = 0
-
-    # 0 day
-    project_days.append([project.start, 0])
-    allocated_days.append([project.start, 0])
-    timesheet_days.append([project.start, 0])
-
-    # iterate through days on project to build datasets for graphing
-    for start_date, end_date, duration in daterange(project.start, project.end, delta=granularity):
-        # project expected days
-        project_days_sum += working_day*duration
-        project_days.append([end_date, project_days_sum])
-        
-        # project allocated days by allocations which are active on current
-        active = allocations.filter(start__lte=end_date, end__gt=start_date)
-        for a in active:
-            # allocated day need to be converted into equivalent working days
-            allocated_days_sum += a.working_days(start_date, end_date)
-        allocated_days.append([end_date, allocated_days_sum])
-
-        # timesheet entries
-        tses_for_day = tses.filter(date__gte=start_date, date__lt=end_date)
-        timesheet_days_sum += TimeSheetEntry.working_days(tses=tses_for_day)
-        timesheet_days.append([end_date, timesheet_days_sum])
+    # allocations and time sheet entries are loaded once and binned by date to build datasets for graphing
+    time_series = ProjectTimeSeries(project, rse=rse)
+    project_days, allocated_days, timesheet_days = time_series.series(daterange(project.start, project.end, delta=granularity))
 
     # add datasets to dict
     view_dict['allocated_days'] = allocated_days
@@ -387,15 +352,16 @@ def time_project(request: HttpRequest, project_id: int) -> HttpResponse:
     view_dict['timsheet_days'] = timesheet_days
 
     # Summary data
-    view_dict['today_expected'] = project.scheduled_working_days_to_today(rse=rse)
-    view_dict['today_delivered'] = TimeSheetEntry.working_days(tses=tses.filter(date__gte=project.start, date__lte=timezone.now().date()))
+    now = timezone.now().date()
+    view_dict['today_expected'] = time_series.scheduled_to_date(now)
+    view_dict['today_delivered'] = time_series.recorded(project.start, now, inclusive=True)
     view_dict['today_remaining'] = view_dict['today_expected'] - view_dict['today_delivered']
     try:
         view_dict['today_percent'] = view_dict['today_delivered']*100.0 / view_dict['today_expected']
     except ZeroDivisionError:
         view_dict['today_percent'] = 0
     view_dict['total_expected'] = project.working_days
-    view_dict['total_delivered'] =  TimeSheetEntry.working_days(tses)
+    view_dict['total_delivered'] =  time_series.recorded()
     view_dict['total_remaining'] = view_dict['total_expected'] - view_dict['total_delivered']
     view_dict['total_percent'] = view_dict['total_delivered'] * 100.0 / float(view_dict['total_expected']) # no need to catch div by 0 as total_expected can not be 0
 
@@ -417,12 +383,16 @@ def time_projects(request: HttpRequest) -> HttpResponse:
        
     # funded projects only
     now = timezone.now().date()
-    projects = Project.objects.filter(status=Project.FUNDED)
+    projects = list(Project.objects.filter(status=Project.FUNDED))
+
+    # scheduled days and recorded days from the start of each project to today are each computed with a single query
+    scheduled = Project.scheduled_working_days_to_today_for(projects)
+    recorded = TimeSheetEntry.objects.filter(project__status=Project.FUNDED, date__gte=F('project__start'), date__lte=now).working_days_by_project()
 
     #append recorded and scheduled days
     for p in projects:
-        p.scheduled = p.scheduled_working_days_to_today()
-        p.recorded = TimeSheetEntry.working_days(tses=TimeSheetEntry.objects.filter(project=p, date__gte=p.start, date__lte=timezone.now().date()))
+        p.scheduled = scheduled[p.id]
+        p.recorded = recorded.get(p.id, 0)
         try:
             p.progress = p.recorded/p.scheduled*100
         except ZeroDivisionError: